@@ -0,0 +1,266 @@
+"""
+AIP archives
+
+Lists, reads and extracts single members of the archives AIPs are stored in,
+so only the needed parts of an AIP have to be written to disk. Tar archives,
+compressed or not, are read with the tarfile module and any other format with
+7z, which needs to be installed.
+"""
+import collections
+import contextlib
+import datetime
+import subprocess
+import tarfile
+import tempfile
+
+# Size of the chunks read from the archives
+CHUNK_SIZE = 1024 * 1024
+
+Member = collections.namedtuple("Member", "name size is_dir mtime")
+Member.__doc__ = """Entry of an archive. mtime is in seconds since the epoch, or
+None if unknown."""
+
+
+class ArchiveError(Exception):
+    """Error reading an archive."""
+
+
+def open_archive(path):
+    """Return a TarArchive or SevenZipArchive to read the archive in path."""
+    if tarfile.is_tarfile(path):
+        return TarArchive(path)
+    return SevenZipArchive(path)
+
+
+class TarArchive:
+    """Tar archive, read with the tarfile module."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def members(self):
+        """Return the list of Member tuples in the archive."""
+        with tarfile.open(self.path) as tar:
+            return [
+                Member(info.name, info.size, info.isdir(), info.mtime) for info in tar
+            ]
+
+    @contextlib.contextmanager
+    def open(self, name):
+        """Open a member of the archive as a binary file object."""
+        with tarfile.open(self.path) as tar:
+            try:
+                member = tar.extractfile(name)
+            except KeyError:
+                raise ArchiveError(f"{name} not found in {self.path}")
+            if member is None:
+                raise ArchiveError(f"{name} is not a file in {self.path}")
+            yield member
+
+    def iter_files(self, names):
+        """Yield (Member, file object) pairs for the members with the given
+        names, in the order they are stored, reading the archive once.
+        """
+        names = set(names)
+        try:
+            with tarfile.open(self.path) as tar:
+                for info in tar:
+                    if info.name in names and info.isfile():
+                        member = Member(info.name, info.size, False, info.mtime)
+                        yield member, tar.extractfile(info)
+        except (OSError, tarfile.TarError) as err:
+            raise ArchiveError(err)
+
+    def extract(self, names, directory):
+        """Extract the members with the given names to directory."""
+        names = set(names)
+        with tarfile.open(self.path) as tar:
+            members = [info for info in tar if info.name in names]
+            kwargs = {}
+            if hasattr(tarfile, "data_filter"):
+                # Extraction filters were added in Python 3.8.17
+                kwargs["filter"] = "data"
+            try:
+                tar.extractall(directory, members=members, **kwargs)
+            except (OSError, tarfile.TarError) as err:
+                raise ArchiveError(err)
+
+
+class SevenZipArchive:
+    """Archive in any of the formats supported by 7z."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def members(self):
+        """Return the list of Member tuples in the archive."""
+        command = ["7z", "l", "-slt", "-sccUTF-8", self.path]
+        try:
+            output = subprocess.check_output(command, stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError) as err:
+            raise ArchiveError(f"Could not list {self.path}: {err}")
+        # The technical listing starts with the properties of the archive,
+        # followed by a block of "Key = Value" lines per member.
+        listing = output.decode("utf-8").split("----------", 1)
+        if len(listing) < 2:
+            return []
+        members = []
+        for block in listing[1].strip().split("\n\n"):
+            properties = dict(
+                line.split(" = ", 1) for line in block.splitlines() if " = " in line
+            )
+            if "Path" not in properties:
+                continue
+            members.append(
+                Member(
+                    properties["Path"],
+                    int(properties.get("Size") or 0),
+                    properties.get("Folder") == "+",
+                    parse_7z_date(properties.get("Modified")),
+                )
+            )
+        return members
+
+    @contextlib.contextmanager
+    def open(self, name):
+        """Open a member of the archive as a binary file object, streamed
+        from a 7z process.
+        """
+        command = ["7z", "e", "-so", "-spd", self.path, name]
+        try:
+            process = subprocess.Popen(
+                command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+            )
+        except OSError as err:
+            raise ArchiveError(f"Could not read {self.path}: {err}")
+        try:
+            yield process.stdout
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+        if returncode:
+            raise ArchiveError(f"Could not read {name} from {self.path}")
+
+    def iter_files(self, names):
+        """Yield (Member, file object) pairs for the members with the given
+        names, in the order they are stored, streamed from a single 7z
+        process. Each file object must be used before getting the next one.
+        """
+        names = set(names)
+        members = [m for m in self.members() if m.name in names and not m.is_dir]
+        # 7z reads the whole archive when the list of members is empty
+        if not members:
+            return
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".txt") as f:
+            f.write("\n".join(member.name for member in members))
+            f.flush()
+            # 7z writes the members to stdout one after the other, in the
+            # order they are stored, which is the order of the listing
+            command = [
+                "7z",
+                "e",
+                "-so",
+                "-spd",
+                "-scsUTF-8",
+                f"-i@{f.name}",
+                self.path,
+            ]
+            try:
+                process = subprocess.Popen(
+                    command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+                )
+            except OSError as err:
+                raise ArchiveError(f"Could not read {self.path}: {err}")
+            try:
+                for member in members:
+                    reader = _SizedReader(process.stdout, member.size)
+                    yield member, reader
+                    reader.drain()
+                    if reader.remaining:
+                        raise ArchiveError(f"{member.name} is truncated in {self.path}")
+            except BaseException:
+                process.kill()
+                raise
+            finally:
+                process.stdout.close()
+                returncode = process.wait()
+            if returncode:
+                raise ArchiveError(f"Could not read {self.path}")
+
+    def extract(self, names, directory):
+        """Extract the members with the given names to directory."""
+        # 7z extracts the whole archive when the list of members is empty
+        names = list(names)
+        if not names:
+            return
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".txt") as f:
+            f.write("\n".join(names))
+            f.flush()
+            command = [
+                "7z",
+                "x",
+                "-bd",
+                "-y",
+                "-spd",
+                "-scsUTF-8",
+                f"-o{directory}",
+                f"-i@{f.name}",
+                self.path,
+            ]
+            try:
+                subprocess.check_output(command, stderr=subprocess.STDOUT)
+            except (OSError, subprocess.CalledProcessError) as err:
+                raise ArchiveError(f"Could not extract from {self.path}: {err}")
+
+
+class _SizedReader:
+    """File object reading the next size bytes of a stream."""
+
+    def __init__(self, stream, size):
+        self.stream = stream
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stream.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def drain(self):
+        while self.remaining and self.read(CHUNK_SIZE):
+            pass
+
+
+def parse_7z_date(value):
+    """Convert a date from a 7z listing, in local time, to a timestamp."""
+    if not value:
+        return None
+    try:
+        return datetime.datetime.strptime(value[:19], "%Y-%m-%d %H:%M:%S").timestamp()
+    except ValueError:
+        return None
+
+
+def find_aip_mets(members, aip_uuid):
+    """Return the name of the AIP METS file in the list of Member tuples,
+    i.e. "<AIP name>-<UUID>/data/METS.<UUID>.xml", or None.
+    """
+    for member in members:
+        parts = member.name.split("/")
+        if (
+            len(parts) == 3
+            and parts[1] == "data"
+            and parts[2] == f"METS.{aip_uuid}.xml"
+            and not member.is_dir
+        ):
+            return member.name
+    return None
+
+
+def aip_root(mets_name):
+    """Return the top directory of the AIP from the name of its METS file."""
+    return mets_name.split("/")[0]
@@ -0,0 +1,254 @@
+"""
+AIP cache
+
+Keeps the AIP archives downloaded from the Storage Service in a directory
+shared by the DIP workflows, so the work on an AIP downloaded recently starts
+without downloading it again. Archives are stored by AIP UUID and SHA-256
+checksum, as <directory>/<uuid>/<checksum>/<filename>, and are hardlinked in
+and out of the workspaces, or copied when the cache is on another filesystem,
+so removing a workspace or the archive in it never removes the cached one.
+
+The cache is bounded in size: the least recently used archives are removed
+when a new one makes it go over the bound. Adding an archive of an AIP
+replaces its older versions.
+
+The cache does not know when an AIP changes in the Storage Service, e.g. when
+it is reingested. aips/create_dip.py only takes an archive from it when its
+size is the one the Storage Service reports for the AIP, and downloads it
+again otherwise. A reingest that leaves the size of the archive unchanged
+is not noticed, and its DIPs are built from the old archive until it is
+evicted or removed with invalidate().
+"""
+import collections
+import logging
+import os
+import shutil
+import time
+import uuid as uuidlib
+
+from transfers import fileutils
+
+LOGGER = logging.getLogger("dip_workflow")
+
+# Algorithm of the checksums of the archives, the one of the DIP checkpoints
+ALGORITHM = "sha256"
+
+# Seconds after which the temporary folder of an archive being added is
+# considered abandoned by a process that crashed
+TMP_MAX_AGE = 24 * 60 * 60
+
+CacheEntry = collections.namedtuple("CacheEntry", "uuid checksum path size used")
+CacheEntry.__doc__ = """Archive of an AIP in the cache.
+
+``checksum`` is the SHA-256 hex digest of the archive at ``path``, ``size`` is
+in bytes and ``used`` is the time the archive was last added or fetched, in
+seconds since the epoch.
+"""
+
+
+class AipCache:
+    """Size-bounded cache of AIP archives in a directory.
+
+    The instances only hold the location and bound of the cache, so they can
+    be passed to other processes, and several processes can use the same
+    directory at the same time.
+
+    :param str directory: absolute path to the cache directory, created if
+                          it doesn't exist
+    :param int max_size: bytes the archives can take, or None for no bound
+    """
+
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size or None
+        os.makedirs(directory, exist_ok=True)
+
+    def entries(self, uuid=None):
+        """Return the CacheEntry tuples of the archives in the cache, or of
+        the ones of an AIP, the most recently used first.
+        """
+        entries = []
+        uuids = [uuid] if uuid else _list_dirs(self.directory)
+        for aip_uuid in uuids:
+            aip_dir = os.path.join(self.directory, aip_uuid)
+            for checksum in _list_dirs(aip_dir):
+                entry = _read_entry(aip_uuid, checksum, os.path.join(aip_dir, checksum))
+                if entry:
+                    entries.append(entry)
+        entries.sort(key=lambda entry: entry.used, reverse=True)
+        return entries
+
+    def lookup(self, uuid):
+        """Return the CacheEntry of the latest archive of an AIP, or None if
+        it is not in the cache.
+        """
+        entries = self.entries(uuid)
+        return entries[0] if entries else None
+
+    def fetch(self, uuid, directory, size=None):
+        """Place the latest archive of an AIP in directory.
+
+        :param int size: size in bytes the archive must have, e.g. the one
+                         reported by the Storage Service, or None to take it
+                         whatever its size
+        :returns: CacheEntry of the archive, with the path to it in
+                  directory, or None if the AIP is not in the cache or its
+                  archive is not the expected size
+        """
+        entry = self.lookup(uuid)
+        if entry is None:
+            return None
+        if size is not None and entry.size != size:
+            LOGGER.info("Cached AIP %s is outdated, not using it", uuid)
+            return None
+        path = os.path.join(directory, os.path.basename(entry.path))
+        methods = [fileutils.HARDLINK, fileutils.REFLINK, fileutils.COPY]
+        try:
+            fileutils.stage_file(entry.path, path, methods)
+        except OSError as err:
+            # E.g. evicted by another process
+            LOGGER.warning("Could not use cached AIP %s: %s", entry.path, err)
+            return None
+        _touch(os.path.dirname(entry.path))
+        return entry._replace(path=path, used=time.time())
+
+    def add(self, uuid, path, checksum=None):
+        """Add the archive of an AIP to the cache, replacing its older
+        versions, and evict the least recently used archives over the bound.
+
+        :param str checksum: SHA-256 checksum of the archive, computed while
+                             adding it if not given
+        :returns: CacheEntry of the archive in the cache, or None if it is
+                  larger than the cache
+        :raises OSError: if the archive could not be added
+        """
+        size = os.path.getsize(path)
+        if self.max_size is not None and size > self.max_size:
+            LOGGER.info("AIP %s is larger than the cache, not caching it", uuid)
+            return None
+        aip_dir = os.path.join(self.directory, uuid)
+        os.makedirs(aip_dir, exist_ok=True)
+        # Added under a temporary name and renamed, so the other processes
+        # never see a partial archive
+        tmp_dir = os.path.join(aip_dir, f".{uuidlib.uuid4()}")
+        os.mkdir(tmp_dir)
+        try:
+            methods = [fileutils.HARDLINK, fileutils.REFLINK, fileutils.COPY]
+            _, computed = fileutils.stage_file(
+                path,
+                os.path.join(tmp_dir, os.path.basename(path)),
+                methods,
+                None if checksum else ALGORITHM,
+            )
+            checksum = checksum or computed
+            entry_dir = os.path.join(aip_dir, checksum)
+            try:
+                os.rename(tmp_dir, entry_dir)
+            except OSError:
+                if not os.path.isdir(entry_dir):
+                    raise
+                # Added by another process meanwhile
+                _touch(entry_dir)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        for old in _list_dirs(aip_dir):
+            if old != checksum:
+                LOGGER.debug("Removing older cached archive of AIP %s", uuid)
+                shutil.rmtree(os.path.join(aip_dir, old), ignore_errors=True)
+        entry = _read_entry(uuid, checksum, entry_dir)
+        self.evict(keep=entry.path if entry else None)
+        return entry
+
+    def invalidate(self, uuid):
+        """Remove the archives of an AIP from the cache."""
+        aip_dir = os.path.join(self.directory, uuid)
+        if os.path.isdir(aip_dir):
+            LOGGER.info("Removing cached archives of AIP %s", uuid)
+            shutil.rmtree(aip_dir, ignore_errors=True)
+
+    def evict(self, keep=None):
+        """Remove the least recently used archives until the cache is within
+        its bound, and the temporary folders abandoned.
+
+        :param str keep: path to an archive not to remove
+        :returns: list of the CacheEntry tuples of the archives removed
+        """
+        _remove_abandoned(self.directory)
+        if self.max_size is None:
+            return []
+        entries = self.entries()
+        total = sum(entry.size for entry in entries)
+        evicted = []
+        for entry in reversed(entries):
+            if total <= self.max_size:
+                break
+            if entry.path == keep:
+                continue
+            LOGGER.info("Evicting cached archive of AIP %s", entry.uuid)
+            shutil.rmtree(os.path.dirname(entry.path), ignore_errors=True)
+            total -= entry.size
+            evicted.append(entry)
+        return evicted
+
+
+def _list_dirs(directory):
+    """Return the names of the folders in a cache directory, without the
+    temporary ones.
+    """
+    try:
+        with os.scandir(directory) as entries:
+            return [
+                entry.name
+                for entry in entries
+                if entry.is_dir(follow_symlinks=False)
+                and not entry.name.startswith(".")
+            ]
+    except FileNotFoundError:
+        return []
+
+
+def _read_entry(uuid, checksum, entry_dir):
+    """Return the CacheEntry of the archive in entry_dir, or None if it was
+    removed.
+    """
+    try:
+        used = os.stat(entry_dir).st_mtime
+        with os.scandir(entry_dir) as files:
+            for f in files:
+                if f.is_file(follow_symlinks=False):
+                    return CacheEntry(uuid, checksum, f.path, f.stat().st_size, used)
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def _touch(entry_dir):
+    """Mark the archive in entry_dir as used now."""
+    try:
+        os.utime(entry_dir)
+    except FileNotFoundError:
+        pass
+
+
+def _remove_abandoned(directory):
+    """Remove the temporary folders of the archives whose addition was
+    interrupted long ago.
+    """
+    now = time.time()
+    for aip_uuid in _list_dirs(directory):
+        aip_dir = os.path.join(directory, aip_uuid)
+        try:
+            with os.scandir(aip_dir) as entries:
+                names = [entry.name for entry in entries]
+        except FileNotFoundError:
+            continue
+        for name in names:
+            if not name.startswith("."):
+                continue
+            path = os.path.join(aip_dir, name)
+            try:
+                abandoned = now - os.stat(path).st_mtime > TMP_MAX_AGE
+            except FileNotFoundError:
+                continue
+            if abandoned:
+                shutil.rmtree(path, ignore_errors=True)
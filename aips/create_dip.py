@@ -12,20 +12,39 @@ generated alongside the objects folder containing only a reference to the ZIP fi
 (without AMD or DMD sections).
 """
 import argparse
+import collections
+import concurrent.futures
 import csv
+import hashlib
 import logging.config  # Has to be imported separately
 import os
 import shutil
 import subprocess
 import sys
+import time
 import uuid
+import zipfile
 
-import amclient
+import lxml.etree
 import metsrw
 
+from aips import archive
+from aips import cache
+from aips import download
+from aips import mets_index
+from transfers import defaults
+from transfers import utils
+
 THIS_DIR = os.path.abspath(os.path.dirname(__file__))
 LOGGER = logging.getLogger("dip_workflow")
 
+# Compression methods of the ZIP file of zipped-objects DIPs. Already
+# compressed media gains little from "deflated" and is faster to "store".
+ZIP_COMPRESSION = {"deflated": zipfile.ZIP_DEFLATED, "stored": zipfile.ZIP_STORED}
+ZIP_CHUNK_SIZE = 1024 * 1024
+
+OriginalFile = collections.namedtuple("OriginalFile", "path relpath lastmodified")
+
 
 def setup_logger(log_file, log_level="INFO"):
     """Configures the logger to output to console and log file"""
@@ -68,9 +87,160 @@ def main(
     output_dir,
     mets_type="atom",
     dip_type="zipped-objects",
+    originals_only=False,
+    zip_compression="deflated",
+    direct=False,
+    move_workers=1,
+    download_streams=4,
+    aip_cache=None,
+    resume=None,
+    on_stage=None,
 ):
+    """
+    Creates a DIP from an AIP in the Storage Service.
+
+    :param aip_cache: aips.cache.AipCache to take the AIP from and add it to
+                      once downloaded, or None to always download it
+    :param dict resume: checkpoint of an interrupted DIP creation of the AIP,
+                        with the last "stage" completed and its "aip_file",
+                        "checksum", "aip_dir" or "dip_path" outputs. The
+                        stages whose outputs are still usable are skipped
+    :param on_stage: function called with the name of each stage completed,
+                     "downloaded", "extracted" or "built", and its outputs
+                     as keyword arguments
+    :returns: absolute path to the created DIP folder or an int higher than 0
+              on error
+    """
     LOGGER.info("Starting DIP creation from AIP: %s", aip_uuid)
+    if on_stage is None:
+        on_stage = _ignore_stage
+
+    stage = resume_stage(resume or {})
+    if stage == "built":
+        LOGGER.info("Reusing DIP: %s", resume["dip_path"])
+        return resume["dip_path"]
+    if stage:
+        LOGGER.info("Resuming DIP creation after the %s stage", stage)
+        aip_file = resume["aip_file"]
+        workspace = os.path.dirname(aip_file)
+    else:
+        downloaded = download_aip(
+            ss_url,
+            ss_user,
+            ss_api_key,
+            aip_uuid,
+            tmp_dir,
+            output_dir,
+            download_streams,
+            aip_cache,
+        )
+        if isinstance(downloaded, int):
+            return downloaded
+        workspace, aip_file, checksum = downloaded
+        on_stage("downloaded", aip_file=aip_file, checksum=checksum)
+
+    if direct and stage != "extracted":
+        if dip_type == "zipped-objects":
+            dip_dir = build_dip_from_archive(
+                aip_file, aip_uuid, workspace, output_dir, mets_type, zip_compression
+            )
+            if not isinstance(dip_dir, int):
+                on_stage("built", dip_path=dip_dir)
+            return dip_dir
+        LOGGER.warning("Only zipped-objects DIPs can be created from the archive")
+
+    if stage == "extracted":
+        aip_dir = resume["aip_dir"]
+    else:
+        LOGGER.info("Extracting AIP")
+        aip_dir = extract_aip(aip_file, aip_uuid, workspace, originals_only)
+
+        if not aip_dir:
+            return 5
+        on_stage("extracted", aip_dir=aip_dir)
+
+    dip_dir = build_dip(
+        aip_dir,
+        aip_uuid,
+        workspace,
+        output_dir,
+        mets_type,
+        dip_type,
+        zip_compression,
+        move_workers,
+    )
+    if not isinstance(dip_dir, int):
+        on_stage("built", dip_path=dip_dir)
+    return dip_dir
+
 
+def _ignore_stage(stage, **outputs):
+    pass
+
+
+def resume_stage(resume):
+    """
+    Returns the last stage of an interrupted DIP creation whose output can be
+    reused: "built" if the DIP folder exists, "extracted" if the extracted AIP
+    folder exists, "downloaded" if the AIP archive exists and its SHA-256
+    checksum matches, or None to start over.
+
+    :param dict resume: checkpoint of the DIP creation, see main()
+    """
+    stage = resume.get("stage")
+    if stage == "built" and resume.get("dip_path"):
+        if os.path.isdir(resume["dip_path"]):
+            return "built"
+        LOGGER.warning("DIP folder not found: %s", resume["dip_path"])
+    if stage in ("built", "extracted") and resume.get("aip_dir"):
+        if os.path.isdir(resume["aip_dir"]):
+            return "extracted"
+        LOGGER.warning("Extracted AIP folder not found: %s", resume["aip_dir"])
+    if stage in ("built", "extracted", "downloaded") and resume.get("aip_file"):
+        if not os.path.isfile(resume["aip_file"]):
+            LOGGER.warning("Downloaded AIP not found: %s", resume["aip_file"])
+        elif file_checksum(resume["aip_file"]) != resume.get("checksum"):
+            LOGGER.warning("Checksum mismatch of downloaded AIP, downloading again")
+        else:
+            return "downloaded"
+    return None
+
+
+def file_checksum(path):
+    """Returns the SHA-256 checksum of a file."""
+    checksum = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(ZIP_CHUNK_SIZE), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def download_aip(
+    ss_url,
+    ss_user,
+    ss_api_key,
+    aip_uuid,
+    tmp_dir,
+    output_dir,
+    download_streams=4,
+    aip_cache=None,
+):
+    """
+    Downloads an AIP from the Storage Service to an empty workspace directory.
+
+    The AIP is downloaded in chunks, download_streams at the same time, and
+    the partial download of an interrupted attempt is kept in the workspace
+    and resumed, see aips.download. With an aip_cache, the AIP is taken from
+    it when it's there with the size reported by the Storage Service, and
+    added to it after the download, see aips.cache.
+
+    :param str tmp_dir: absolute path to the directory to create the workspace in
+    :param str output_dir: absolute path to the directory to place the DIP in,
+                           checked before the download
+    :returns: tuple of the absolute paths to the workspace directory and the
+              AIP and the SHA-256 checksum of the AIP, computed while it was
+              downloaded, or an int higher than 0 on error
+    """
     if not os.path.isdir(tmp_dir):
         LOGGER.error("%s is not a valid temporary directory", tmp_dir)
         return 1
@@ -79,63 +249,158 @@ def main(
         LOGGER.error("%s is not a valid output directory", output_dir)
         return 2
 
-    # Create empty workspace directory
-    tmp_dir = os.path.join(tmp_dir, aip_uuid)
-    if os.path.exists(tmp_dir):
-        LOGGER.warning("Workspace directory already exists, overwriting")
-        shutil.rmtree(tmp_dir)
+    # Create empty workspace directory, keeping any partial download
+    workspace = os.path.join(tmp_dir, aip_uuid)
     try:
-        os.makedirs(tmp_dir)
+        if os.path.exists(workspace):
+            LOGGER.warning("Workspace directory already exists, overwriting")
+            clear_workspace(workspace)
+        else:
+            os.makedirs(workspace)
     except OSError:
-        LOGGER.error("Could not create workspace directory: %s", tmp_dir)
+        LOGGER.error("Could not create workspace directory: %s", workspace)
         return 3
 
+    if aip_cache:
+        # The cached archive may be of an AIP reingested since then
+        size = download.package_size(ss_url, ss_user, ss_api_key, aip_uuid)
+        cached = (
+            aip_cache.fetch(aip_uuid, workspace, size) if size is not None else None
+        )
+        if cached:
+            LOGGER.info("Using cached AIP: %s", cached.checksum)
+            return workspace, cached.path, cached.checksum
+
     LOGGER.info("Downloading AIP from Storage Service")
 
-    am_client = amclient.AMClient(
-        aip_uuid=aip_uuid,
-        ss_url=ss_url,
-        ss_user_name=ss_user,
-        ss_api_key=ss_api_key,
-        directory=tmp_dir,
+    package = download.download_package(
+        ss_url, ss_user, ss_api_key, aip_uuid, workspace, streams=download_streams
     )
 
-    aip_file = am_client.download_aip()
-
-    if not aip_file:
+    if not package:
         LOGGER.error("Unable to download AIP")
         return 4
 
-    LOGGER.info("Extracting AIP")
-    aip_dir = extract_aip(aip_file, aip_uuid, tmp_dir)
+    if aip_cache:
+        try:
+            aip_cache.add(aip_uuid, package.path, package.checksum)
+        except OSError as err:
+            LOGGER.warning("Could not add AIP to the cache: %s", err)
+
+    return workspace, package.path, package.checksum
+
+
+def clear_workspace(workspace):
+    """Remove the contents of a workspace directory but the partial
+    downloads and their state files.
+    """
+    for entry in os.scandir(workspace):
+        if entry.name.endswith((download.PART_SUFFIX, download.STATE_SUFFIX)):
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path)
+        else:
+            os.remove(entry.path)
+
 
-    if not aip_dir:
-        return 5
+def build_dip(
+    aip_dir,
+    aip_uuid,
+    workspace,
+    output_dir,
+    mets_type,
+    dip_type,
+    zip_compression="deflated",
+    move_workers=1,
+):
+    """
+    Creates a DIP from an extracted AIP and removes the workspace directory.
 
+    :returns: absolute path to the created DIP folder or 6 on error
+    """
     LOGGER.info("Creating DIP")
-    dip_dir = create_dip(aip_dir, aip_uuid, output_dir, mets_type, dip_type)
+    dip_dir = create_dip(
+        aip_dir,
+        aip_uuid,
+        output_dir,
+        mets_type,
+        dip_type,
+        zip_compression,
+        move_workers,
+    )
 
     if not dip_dir:
         LOGGER.error("Unable to create DIP")
         return 6
 
     # Remove workspace directory
-    shutil.rmtree(tmp_dir)
+    shutil.rmtree(workspace)
 
     LOGGER.info("DIP created in: %s", dip_dir)
 
     return dip_dir
 
 
-def extract_aip(aip_file, aip_uuid, tmp_dir):
+def build_dip_from_archive(
+    aip_file,
+    aip_uuid,
+    workspace,
+    output_dir,
+    mets_type,
+    zip_compression="deflated",
+):
+    """
+    Creates a zipped-objects DIP straight from an AIP archive and removes the
+    workspace directory. Extracts the AIP if it can't be read that way.
+
+    :returns: absolute path to the created DIP folder or an int higher than 0
+              on error
+    """
+    LOGGER.info("Creating DIP from AIP archive")
+    dip_dir = create_dip_from_archive(
+        aip_file, aip_uuid, output_dir, mets_type, zip_compression
+    )
+
+    if not dip_dir:
+        LOGGER.warning("Could not create DIP from AIP archive, extracting AIP")
+        aip_dir = extract_aip(aip_file, aip_uuid, workspace)
+        if not aip_dir:
+            return 5
+        return build_dip(
+            aip_dir,
+            aip_uuid,
+            workspace,
+            output_dir,
+            mets_type,
+            "zipped-objects",
+            zip_compression,
+        )
+
+    # Remove workspace directory
+    shutil.rmtree(workspace)
+
+    LOGGER.info("DIP created in: %s", dip_dir)
+
+    return dip_dir
+
+
+def extract_aip(aip_file, aip_uuid, tmp_dir, originals_only=False):
     """
     Extracts an AIP to a folder.
 
     :param str aip_file: absolute path to an AIP
     :param str aip_uuid: UUID from the AIP
     :param str tmp_dir: absolute path to a directory to place the extracted AIP
+    :param bool originals_only: extract only the files used in the DIP, see
+                                extract_aip_originals()
     :returns: absolute path to the extracted AIP folder
     """
+    if originals_only:
+        aip_dir = extract_aip_originals(aip_file, aip_uuid, tmp_dir)
+        if aip_dir:
+            return aip_dir
+        LOGGER.warning("Extracting the whole AIP")
+
     command = ["7z", "x", "-bd", "-y", f"-o{tmp_dir}", aip_file]
     try:
         subprocess.check_output(command, stderr=subprocess.STDOUT)
@@ -167,7 +432,70 @@ def extract_aip(aip_file, aip_uuid, tmp_dir):
     return extract_aip(extracted_entry, aip_uuid, tmp_dir)
 
 
-def create_dip(aip_dir, aip_uuid, output_dir, mets_type, dip_type):
+def extract_aip_originals(aip_file, aip_uuid, tmp_dir):
+    """
+    Extracts only the METS file, the original files and the
+    submissionDocumentation folder of an AIP to a folder, reading the list
+    of original files from the METS file in the archive.
+
+    :param str aip_file: absolute path to an AIP
+    :param str aip_uuid: UUID from the AIP
+    :param str tmp_dir: absolute path to a directory to place the extracted AIP
+    :returns: absolute path to the extracted AIP folder, or None if the AIP
+              could not be extracted this way
+    """
+    try:
+        aip_archive = archive.open_archive(aip_file)
+        members = aip_archive.members()
+        mets_name = archive.find_aip_mets(members, aip_uuid)
+        if not mets_name:
+            LOGGER.warning("Could not find AIP METS file in %s", aip_file)
+            return
+        with aip_archive.open(mets_name) as mets_file:
+            originals = [
+                record.path
+                for record in mets_index.iter_mets(mets_file)
+                if record.use == "original" and record.path and record.uuid
+            ]
+    except (archive.ArchiveError, lxml.etree.XMLSyntaxError) as err:
+        LOGGER.warning("Could not read AIP METS file: %s", err)
+        return
+
+    root = archive.aip_root(mets_name)
+    sub_doc = f"{root}/data/objects/submissionDocumentation/"
+    names = {mets_name}
+    names.update(f"{root}/data/{path}" for path in originals)
+    names = [
+        member.name
+        for member in members
+        if not member.is_dir
+        and (member.name in names or member.name.startswith(sub_doc))
+    ]
+    LOGGER.info("Extracting %s files from AIP", len(names))
+    try:
+        aip_archive.extract(names, tmp_dir)
+    except archive.ArchiveError as err:
+        LOGGER.error("Could not extract AIP, error: %s", err)
+        return
+
+    # Remove extracted file to avoid multiple entries with the same UUID
+    try:
+        os.remove(aip_file)
+    except OSError:
+        pass
+
+    return os.path.join(tmp_dir, root)
+
+
+def create_dip(
+    aip_dir,
+    aip_uuid,
+    output_dir,
+    mets_type,
+    dip_type,
+    zip_compression="deflated",
+    move_workers=1,
+):
     """
     Creates a DIP from an uncompressed AIP.
 
@@ -176,6 +504,10 @@ def create_dip(aip_dir, aip_uuid, output_dir, mets_type, dip_type):
     :param str output_dir: absolute path to a directory to place the DIP
     :param str mets_type: type of METS to generate within DIP
     :param str dip_type: type of DIP to generate
+    :param str zip_compression: compression of the ZIP file of zipped-objects
+                                DIPs, one of ZIP_COMPRESSION
+    :param int move_workers: number of threads moving the original files to
+                             avalon-manifest DIPs
     :returns: absolute path to the created DIP folder
     """
     aip_dir_name = os.path.basename(aip_dir)
@@ -183,194 +515,419 @@ def create_dip(aip_dir, aip_uuid, output_dir, mets_type, dip_type):
 
     if dip_type == "avalon-manifest":
         dip_dir = os.path.join(output_dir, aip_name, aip_uuid)
-        to_zip_dir = dip_dir
     else:
         dip_dir = os.path.join(output_dir, aip_dir_name)
         objects_dir = os.path.join(dip_dir, "objects")
-        to_zip_dir = os.path.join(objects_dir, aip_name)
+
+    aip_mets_file = f"{aip_dir}/data/METS.{aip_uuid}.xml"
+    if not os.path.exists(aip_mets_file):
+        LOGGER.error("Could not find AIP METS file")
+        return
 
     if os.path.exists(dip_dir):
         LOGGER.warning("DIP folder already exists, overwriting")
         shutil.rmtree(dip_dir)
 
-    os.makedirs(to_zip_dir)
+    data_dir = os.path.join(aip_dir, "data")
+    original_files = get_original_files(
+        mets_index.iter_mets(aip_mets_file),
+        lambda path: os.path.exists(os.path.join(data_dir, path)),
+    )
 
-    if dip_type != "avalon-manifest":
-        move_sub_doc(aip_dir, to_zip_dir)
+    if dip_type == "avalon-manifest":
+        os.makedirs(dip_dir)
+        move_original_files(original_files, data_dir, dip_dir, move_workers)
 
-    LOGGER.info("Moving METS file")
-    aip_mets_file = f"{aip_dir}/data/METS.{aip_uuid}.xml"
-    if not os.path.exists(aip_mets_file):
-        LOGGER.error("Could not find AIP METS file")
+        # Update Manifest file with UUIDs
+        update_avalon_manifest(dip_dir, aip_uuid)
+        return dip_dir
+
+    # Write the original files, with their original file name and last
+    # modified date, and a copy of the submissionDocumentation folder and
+    # the METS file in a ZIP file inside the objects folder
+    os.makedirs(objects_dir)
+    LOGGER.info("Creating ZIP file inside objects")
+    with zipfile.ZipFile(
+        os.path.join(objects_dir, f"{aip_name}.zip"),
+        "w",
+        compression=ZIP_COMPRESSION[zip_compression],
+    ) as dip_zip:
+        add_sub_doc(dip_zip, aip_dir, aip_name)
+        write_zip_file(dip_zip, aip_mets_file, f"{aip_name}/METS.{aip_uuid}.xml")
+        for original_file in original_files:
+            LOGGER.info("Adding file: %s", original_file.relpath)
+            write_zip_file(
+                dip_zip,
+                os.path.join(data_dir, original_file.path),
+                f"{aip_name}/{original_file.relpath}",
+                original_file.lastmodified,
+            )
+
+    # Modify or copy METS file for DIP based on mets_type argument
+    dip_mets_file = os.path.join(dip_dir, f"METS.{aip_uuid}.xml")
+    if mets_type == "atom":
+        create_dip_mets(aip_mets_file, aip_dir_name, aip_name, dip_mets_file)
+    elif mets_type == "storage-service":
+        copy_aip_mets(aip_mets_file, dip_mets_file)
+
+    return dip_dir
+
+
+def create_dip_from_archive(
+    aip_file, aip_uuid, output_dir, mets_type, zip_compression="deflated"
+):
+    """
+    Creates a zipped-objects DIP streaming the METS file, the original files
+    and the submissionDocumentation folder from an AIP archive into the DIP
+    ZIP file, without extracting the AIP.
+
+    :param str aip_file: absolute path to an AIP archive
+    :param str aip_uuid: UUID from the AIP
+    :param str output_dir: absolute path to a directory to place the DIP
+    :param str mets_type: type of METS to generate within DIP
+    :param str zip_compression: compression of the ZIP file, one of
+                                ZIP_COMPRESSION
+    :returns: absolute path to the created DIP folder, or None
+    """
+    try:
+        aip_archive = archive.open_archive(aip_file)
+        members = aip_archive.members()
+    except archive.ArchiveError as err:
+        LOGGER.warning("Could not read AIP archive: %s", err)
+        return
+    mets_name = archive.find_aip_mets(members, aip_uuid)
+    if not mets_name:
+        LOGGER.warning("Could not find AIP METS file in %s", aip_file)
+        return
+
+    aip_dir_name = archive.aip_root(mets_name)
+    aip_name = aip_dir_name[:-37]
+    data_prefix = f"{aip_dir_name}/data/"
+    sub_doc_prefix = f"{data_prefix}objects/submissionDocumentation/"
+    names = {member.name for member in members if not member.is_dir}
+    mets_mtime = next(member.mtime for member in members if member.name == mets_name)
+
+    dip_dir = os.path.join(output_dir, aip_dir_name)
+    if os.path.exists(dip_dir):
+        LOGGER.warning("DIP folder already exists, overwriting")
+        shutil.rmtree(dip_dir)
+    objects_dir = os.path.join(dip_dir, "objects")
+    os.makedirs(objects_dir)
+
+    # Copy the AIP METS file to the DIP folder, where it is read from
+    dip_mets_file = os.path.join(dip_dir, f"METS.{aip_uuid}.xml")
+    try:
+        with aip_archive.open(mets_name) as src, open(dip_mets_file, "wb") as dst:
+            shutil.copyfileobj(src, dst, ZIP_CHUNK_SIZE)
+        original_files = {
+            data_prefix + original_file.path: original_file
+            for original_file in get_original_files(
+                mets_index.iter_mets(dip_mets_file),
+                lambda path: data_prefix + path in names,
+            )
+        }
+    except (archive.ArchiveError, lxml.etree.XMLSyntaxError) as err:
+        LOGGER.warning("Could not read AIP METS file: %s", err)
+        shutil.rmtree(dip_dir)
         return
-    to_zip_mets_file = f"{to_zip_dir}/METS.{aip_uuid}.xml"
-    shutil.move(aip_mets_file, to_zip_mets_file)
-
-    mets = metsrw.METSDocument.fromfile(to_zip_mets_file)
-    namespaces = metsrw.utils.NAMESPACES.copy()
-    premis_map = metsrw.plugins.premisrw.utils.PREMIS_VERSIONS_MAP
-    fsentries = mets.all_files()
-    for fsentry in fsentries:
-        if fsentry.use != "original" or not fsentry.path or not fsentry.file_uuid:
+    sub_doc_names = {name for name in names if name.startswith(sub_doc_prefix)}
+    if not sub_doc_names:
+        LOGGER.warning("submissionDocumentation folder not found")
+
+    LOGGER.info("Creating ZIP file inside objects")
+    try:
+        with zipfile.ZipFile(
+            os.path.join(objects_dir, f"{aip_name}.zip"),
+            "w",
+            compression=ZIP_COMPRESSION[zip_compression],
+        ) as dip_zip:
+            write_zip_file(
+                dip_zip, dip_mets_file, f"{aip_name}/METS.{aip_uuid}.xml", mets_mtime
+            )
+            for member, src in aip_archive.iter_files(
+                original_files.keys() | sub_doc_names
+            ):
+                if member.name in original_files:
+                    original_file = original_files[member.name]
+                    LOGGER.info("Adding file: %s", original_file.relpath)
+                    arcname = f"{aip_name}/{original_file.relpath}"
+                    timestamp = original_file.lastmodified
+                else:
+                    sub_doc_path = member.name[len(sub_doc_prefix) :]
+                    arcname = f"{aip_name}/submissionDocumentation/{sub_doc_path}"
+                    timestamp = None
+                if timestamp is None:
+                    timestamp = member.mtime
+                info = archive_zip_info(arcname, member.size, timestamp)
+                write_zip_stream(dip_zip, src, info)
+    except archive.ArchiveError as err:
+        LOGGER.error("Could not read AIP archive: %s", err)
+        shutil.rmtree(dip_dir)
+        return
+
+    # The copy of the AIP METS file is kept for the storage-service METS type
+    if mets_type == "atom":
+        create_dip_mets(dip_mets_file, aip_dir_name, aip_name, dip_mets_file)
+
+    return dip_dir
+
+
+def get_original_files(records, exists):
+    """
+    Yields the original files of an AIP found in the METS file.
+
+    :param records: FileRecord tuples from the index of the AIP METS file
+    :param exists: function called with the path of a file relative to the
+                   AIP data folder that returns whether it is in the AIP
+    :returns: OriginalFile tuples with the path of the file relative to the
+              AIP data folder, the relative path from its premis:originalName
+              and the last modified timestamp from FITS, if found
+    """
+    for record in records:
+        if record.use != "original" or not record.path or not record.uuid:
             continue
 
-        LOGGER.info("Moving file: %s", fsentry.path)
-        aip_file_path = os.path.join(os.path.join(aip_dir, "data"), fsentry.path)
-        if not os.path.exists(aip_file_path):
-            LOGGER.warning("Could not find file in AIP")
+        if not exists(record.path):
+            LOGGER.warning("Could not find file in AIP: %s", record.path)
             continue
 
-        if not len(fsentry.amdsecs):
+        if not record.amdsec:
             LOGGER.warning("Missing amdSec in METS file")
             continue
 
-        amdsec = fsentry.amdsecs[0]
-        for item in amdsec.subsections:
-            if item.subsection == "techMD":
-                techmd = item
-        if not techmd:
+        if not record.techmd_type:
             LOGGER.warning("techMD section could not be found")
             continue
 
-        if techmd.contents.mdtype != "PREMIS:OBJECT":
+        if record.techmd_type != "PREMIS:OBJECT":
             LOGGER.warning("premis:object could not be found")
             continue
 
-        premis = techmd.contents.document
-        update_premis_ns(premis, namespaces, premis_map)
-
-        original_name = get_premis_original_name(premis, namespaces)
-        if not original_name:
+        if not record.original_name:
             LOGGER.warning("Could not get original file name from premis:originalName")
             continue
 
-        original_relpath = get_original_relpath(original_name)
+        original_relpath = get_original_relpath(record.original_name)
         if not original_relpath:
             continue
 
-        # Move original file with original file name and create parent folders
-        dip_file_path = os.path.join(to_zip_dir, original_relpath)
-        dip_dir_path = os.path.dirname(dip_file_path)
-        if not os.path.exists(dip_dir_path):
-            os.makedirs(dip_dir_path)
+        if record.lastmodified is None:
+            LOGGER.warning("fits/fileinfo/fslastmodified not found")
 
-        shutil.move(aip_file_path, dip_file_path)
+        yield OriginalFile(record.path, original_relpath, record.lastmodified)
 
-        if dip_type != "avalon-manifest":
-            try:
-                set_fslastmodified(premis, namespaces, dip_file_path)
-            except Exception:
-                LOGGER.warning("fits/fileinfo/fslastmodified not found")
 
-    # Modify or copy METS file for DIP based on mets_type argument
-    dip_mets_file = os.path.join(dip_dir, f"METS.{aip_uuid}.xml")
-
-    if dip_type == "avalon-manifest":
-        # Update Manifest file with UUIDs
-        update_avalon_manifest(dip_dir, aip_uuid)
-        os.remove(to_zip_mets_file)
-    else:
-        if mets_type == "atom":
-            create_dip_mets(aip_dir, aip_name, fsentries, mets, dip_mets_file)
-        elif mets_type == "storage-service":
-            copy_aip_mets(to_zip_mets_file, dip_mets_file)
-        compress_zip_folder(to_zip_dir)
-        shutil.rmtree(to_zip_dir)
-
-    return dip_dir
+def move_original_files(original_files, data_dir, dip_dir, workers=1):
+    """
+    Moves the original files of an extracted AIP to a DIP folder, with their
+    original file name. The parent folders are created once, before the files
+    are moved by a pool of threads, as each move is a full copy when the AIP
+    and the DIP are in different filesystems.
+
+    :param original_files: OriginalFile tuples
+    :param str data_dir: absolute path to the AIP data folder
+    :param str dip_dir: absolute path to the DIP folder
+    :param int workers: number of threads moving files
+    :returns: number of files that could not be moved
+    """
+    original_files = list(original_files)
+    for dirname in {os.path.dirname(file.relpath) for file in original_files}:
+        os.makedirs(os.path.join(dip_dir, dirname), exist_ok=True)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        moved = executor.map(
+            move_original_file,
+            original_files,
+            [data_dir] * len(original_files),
+            [dip_dir] * len(original_files),
+        )
+        return list(moved).count(False)
 
 
-def create_dip_mets(aip_dir, aip_name, fsentries, mets, dip_mets_file):
-    """Creates DIP METS file for AtoM/default upload."""
+def move_original_file(original_file, data_dir, dip_dir):
+    """Moves an original file to a DIP folder and returns whether it could."""
+    LOGGER.info("Moving file: %s", original_file.relpath)
+    try:
+        shutil.move(
+            os.path.join(data_dir, original_file.path),
+            os.path.join(dip_dir, original_file.relpath),
+        )
+    except (OSError, shutil.Error) as err:
+        LOGGER.warning("Could not move file %s: %s", original_file.path, err)
+        return False
+    return True
 
-    LOGGER.info("Creating DIP METS file for AtoM/default upload.")
-    objects_entry = None
-    for fsentry in fsentries:
-        # Do not delete AIP entry
-        if (
-            fsentry.label == os.path.basename(aip_dir)
-            and fsentry.type.lower() == "directory"
-        ):
-            continue
 
-        # Do not delete objects entry and save it for parenting
-        if fsentry.label == "objects" and fsentry.type.lower() == "directory":
-            objects_entry = fsentry
-            continue
+def create_dip_mets(aip_mets_file, aip_dir_name, aip_name, dip_mets_file):
+    """Creates DIP METS file for AtoM/default upload.
 
-        # Delete all the others
-        mets.remove_entry(fsentry)
+    The METS file only describes the AIP and objects directories, with their
+    metadata from the AIP METS file, and the ZIP file, so it is written from
+    those entries instead of removing all the others from the AIP METS file.
+    """
 
-    if not objects_entry:
-        LOGGER.error("Could not find objects entry in METS file")
+    LOGGER.info("Creating DIP METS file for AtoM/default upload.")
+    try:
+        header, divs = mets_index.read_directory_divs(
+            aip_mets_file, (aip_dir_name, "objects")
+        )
+        if len(divs) < 2:
+            LOGGER.error("Could not find objects entry in METS file")
+            return
+        section_ids = set()
+        for div in divs:
+            section_ids.update(div.get("DMDID", "").split())
+            section_ids.update(div.get("ADMID", "").split())
+        sections = list(mets_index.iter_sections(aip_mets_file, section_ids))
+    except lxml.etree.XMLSyntaxError as err:
+        LOGGER.error("Could not read AIP METS file: %s", err)
         return
 
+    mets_ns = metsrw.utils.lxmlns("mets")
+    root = lxml.etree.Element(
+        f"{mets_ns}mets",
+        nsmap={
+            "xsi": metsrw.utils.NAMESPACES["xsi"],
+            "xlink": metsrw.utils.NAMESPACES["xlink"],
+            "mets": metsrw.utils.NAMESPACES["mets"],
+        },
+        attrib={
+            f"{metsrw.utils.lxmlns('xsi')}schemaLocation": metsrw.utils.SCHEMA_LOCATIONS
+        },
+    )
+    now = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime())
+    if header is None:
+        header = lxml.etree.Element(f"{mets_ns}metsHdr", CREATEDATE=now)
+    else:
+        header.set("LASTMODDATE", now)
+    root.append(header)
+    # Keep the dmdSecs before the amdSecs, in the AIP METS file order
+    sections.sort(key=lambda section: section.tag != f"{mets_ns}dmdSec")
+    root.extend(sections)
+    # Drop the whitespace copied after the elements to pretty print them
+    for element in root:
+        element.tail = None
+
     # Create new entry for ZIP file
-    entry = metsrw.FSEntry(
-        label=f"{aip_name}.zip",
-        path=f"objects/{aip_name}.zip",
-        file_uuid=str(uuid.uuid4()),
+    file_uuid = str(uuid.uuid4())
+    file_grp = lxml.etree.SubElement(
+        lxml.etree.SubElement(root, f"{mets_ns}fileSec"),
+        f"{mets_ns}fileGrp",
+        USE="original",
+    )
+    file_element = lxml.etree.SubElement(
+        file_grp,
+        f"{mets_ns}file",
+        ID=f"file-{file_uuid}",
+        GROUPID=f"Group-{file_uuid}",
+    )
+    lxml.etree.SubElement(
+        file_element,
+        f"{mets_ns}FLocat",
+        {
+            f"{metsrw.utils.lxmlns('xlink')}href": f"objects/{aip_name}.zip",
+            "LOCTYPE": "OTHER",
+            "OTHERLOCTYPE": "SYSTEM",
+        },
     )
 
-    # Add new entry to objects directory
-    objects_entry.add_child(entry)
+    # Add it to the objects directory of the physical structMap
+    parent = lxml.etree.SubElement(
+        root,
+        f"{mets_ns}structMap",
+        TYPE="physical",
+        ID="structMap_1",
+        LABEL="Archivematica default",
+    )
+    for div in divs:
+        parent = lxml.etree.SubElement(parent, f"{mets_ns}div", div)
+    entry = lxml.etree.SubElement(
+        parent, f"{mets_ns}div", TYPE="Item", LABEL=f"{aip_name}.zip"
+    )
+    lxml.etree.SubElement(entry, f"{mets_ns}fptr", FILEID=f"file-{file_uuid}")
 
     # Create DIP METS file
     try:
-        mets.write(dip_mets_file, fully_qualified=True, pretty_print=True)
+        lxml.etree.ElementTree(root).write(
+            dip_mets_file, xml_declaration=True, encoding="UTF-8", pretty_print=True
+        )
     except Exception:
         LOGGER.error("Could not create DIP METS file")
         return
 
 
-def copy_aip_mets(to_zip_mets_file, dip_mets_file):
+def copy_aip_mets(aip_mets_file, dip_mets_file):
     """Copies AIP's METS file."""
 
     LOGGER.info("Copying AIP's METS file.")
     try:
-        shutil.copy(to_zip_mets_file, dip_mets_file)
+        shutil.copy(aip_mets_file, dip_mets_file)
     except Exception:
         LOGGER.error("Could not create DIP METS file")
         return
 
 
-def compress_zip_folder(to_zip_dir):
-    """Compresses to_zip_dir inside the DIP objects folder"""
+def add_sub_doc(dip_zip, aip_dir, aip_name):
+    """Adds the submissionDocumentation folder to the DIP ZIP file"""
 
-    LOGGER.info("Compressing ZIP folder inside objects")
-    command = ["7z", "a", "-tzip", f"{to_zip_dir}.zip", to_zip_dir]
-    try:
-        subprocess.check_output(command, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-        LOGGER.error("Could not compress ZIP folder, error: %s", e.output)
+    LOGGER.info("Adding submissionDocumentation folder")
+    aip_sub_doc = f"{aip_dir}/data/objects/submissionDocumentation"
+    if not os.path.exists(aip_sub_doc):
+        LOGGER.warning("submissionDocumentation folder not found")
         return
+    for dirpath, _, filenames in os.walk(aip_sub_doc):
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            relpath = os.path.relpath(path, aip_sub_doc).replace(os.sep, "/")
+            write_zip_file(
+                dip_zip, path, f"{aip_name}/submissionDocumentation/{relpath}"
+            )
+
+
+def write_zip_file(dip_zip, path, arcname, timestamp=None):
+    """Writes a file to a ZIP file, streamed in chunks.
+
+    :param dip_zip: ZipFile open for writing
+    :param str path: absolute path to the file
+    :param str arcname: name of the file in the ZIP file
+    :param int timestamp: last modified date to set in the ZIP file, in
+                          seconds since the epoch. The file's if None
+    """
+    info = zipfile.ZipInfo.from_file(path, arcname, strict_timestamps=False)
+    if timestamp is not None:
+        info.date_time = zip_date_time(timestamp)
+    with open(path, "rb") as src:
+        write_zip_stream(dip_zip, src, info)
 
 
-def move_sub_doc(aip_dir, to_zip_dir):
-    """Moves submissionDocumentation folder"""
+def write_zip_stream(dip_zip, src, info):
+    """Writes a file object to a ZIP file in chunks, as the entry described
+    by the ZipInfo info.
+    """
+    info.compress_type = dip_zip.compression
+    with dip_zip.open(info, "w") as dst:
+        shutil.copyfileobj(src, dst, ZIP_CHUNK_SIZE)
 
-    LOGGER.info("Moving submissionDocumentation folder")
-    aip_sub_doc = f"{aip_dir}/data/objects/submissionDocumentation"
-    if os.path.exists(aip_sub_doc):
-        to_zip_sub_doc = os.path.join(to_zip_dir, "submissionDocumentation")
-        shutil.move(aip_sub_doc, to_zip_sub_doc)
-    else:
-        LOGGER.warning("submissionDocumentation folder not found")
 
+def archive_zip_info(arcname, size, timestamp=None):
+    """Returns the ZipInfo of a file read from an archive.
 
-def set_fslastmodified(premis, namespaces, dip_file_path):
-    """Obtain and set the fslastmodified date to the moved files"""
+    :param int size: size of the file, to use ZIP64 if needed
+    :param timestamp: last modified date of the file, now if None
+    """
+    if timestamp is None:
+        timestamp = time.time()
+    info = zipfile.ZipInfo(arcname, zip_date_time(timestamp))
+    info.external_attr = 0o644 << 16
+    info.file_size = size
+    return info
 
-    fslastmodified = premis.findtext(
-        "premis:objectCharacteristics/premis:objectCharacteristicsExtension/fits:fits/fits:fileinfo/fits:fslastmodified",
-        namespaces=namespaces,
-    )
-    if not fslastmodified:
-        LOGGER.warning("fits/fileinfo/fslastmodified not found")
 
-    # Convert from miliseconds to seconds
-    timestamp = int(fslastmodified) // 1000
-    os.utime(dip_file_path, (timestamp, timestamp))
+def zip_date_time(timestamp):
+    """Converts a timestamp to a ZIP date_time tuple, in local time like the
+    dates written by ZipFile.write(). ZIP files can't store dates before 1980.
+    """
+    return max(time.localtime(timestamp)[:6], (1980, 1, 1, 0, 0, 0))
 
 
 def update_avalon_manifest(dip_dir, aip_uuid):
@@ -407,28 +964,6 @@ def update_avalon_manifest(dip_dir, aip_uuid):
         LOGGER.error("Manifest file could not be found!")
 
 
-def update_premis_ns(premis, namespaces, premis_map):
-    """Update PREMIS namespace based on version attribute"""
-    premis_version = premis.get("version", "2.2")
-    try:
-        namespaces["premis"] = premis_map[premis_version]["namespaces"]["premis"]
-    except KeyError:
-        LOGGER.warning(
-            "Could not update namespace for PREMIS version: %s" % premis_version
-        )
-
-
-def get_premis_original_name(premis, namespaces):
-    """Get the original file name from a premis:originalName"""
-
-    original_name = premis.findtext("premis:originalName", namespaces=namespaces)
-    if not original_name:
-        LOGGER.warning("premis:originalName could not be found")
-        return None
-
-    return original_name
-
-
 def get_original_relpath(original_name):
     """Get the relative file path from a premis:originalName"""
 
@@ -496,6 +1031,76 @@ if __name__ == "__main__":
         default="zipped-objects",
         help="Structure DIP for specific systems. Default: zipped-objects.",
     )
+    parser.add_argument(
+        "--zip-compression",
+        choices=list(ZIP_COMPRESSION),
+        default="deflated",
+        help="Compression of the ZIP file in zipped-objects DIPs, use stored for already compressed media. Default: deflated.",
+    )
+    parser.add_argument(
+        "--direct",
+        action="store_true",
+        help="Create zipped-objects DIPs reading the files straight from the AIP archive, without extracting it.",
+    )
+    parser.add_argument(
+        "--originals-only",
+        action="store_true",
+        help="Extract only the original files, submissionDocumentation and METS file from the AIP.",
+    )
+    parser.add_argument(
+        "--move-workers",
+        metavar="N",
+        type=int,
+        default=1,
+        help="Number of threads moving the original files to avalon-manifest DIPs. Default: 1.",
+    )
+    parser.add_argument(
+        "--download-streams",
+        metavar="N",
+        type=int,
+        default=4,
+        help="Number of chunks of the AIP downloaded at the same time. Default: 4.",
+    )
+    parser.add_argument(
+        "--aip-cache",
+        metavar="PATH",
+        help="Absolute path to a directory to keep the downloaded AIPs in and take them from, instead of downloading them again.",
+    )
+    parser.add_argument(
+        "--aip-cache-size",
+        metavar="MB",
+        type=int,
+        default=0,
+        help="Space the AIPs in --aip-cache can take, the least recently used ones are removed to stay within it. Default: 0, no limit.",
+    )
+    parser.add_argument(
+        "--http-timeout",
+        metavar="SECONDS",
+        type=float,
+        default=defaults.DEFAULT_HTTP_TIMEOUT,
+        help="Seconds to wait for a response of the SS. Default: 120.",
+    )
+    parser.add_argument(
+        "--http-retries",
+        metavar="N",
+        type=int,
+        default=defaults.DEFAULT_HTTP_RETRIES,
+        help="Retries of the SS requests on connection errors and 502, 503 or 504 responses. Default: 3.",
+    )
+    parser.add_argument(
+        "--http-backoff",
+        metavar="SECONDS",
+        type=float,
+        default=defaults.DEFAULT_HTTP_BACKOFF,
+        help="Backoff factor between the retries, doubled on every retry. Default: 0.5.",
+    )
+    parser.add_argument(
+        "--http-pool-size",
+        metavar="N",
+        type=int,
+        default=defaults.DEFAULT_HTTP_POOL_SIZE,
+        help="Connections to the SS kept open. Default: 10.",
+    )
     # Logging
     parser.add_argument(
         "--log-file", metavar="FILE", help="Location of log file", default=None
@@ -530,6 +1135,13 @@ if __name__ == "__main__":
 
     setup_logger(args.log_file, log_level)
 
+    utils.configure_client(
+        timeout=args.http_timeout,
+        retries=args.http_retries,
+        backoff_factor=args.http_backoff,
+        pool_size=args.http_pool_size,
+    )
+
     ret = main(
         ss_url=args.ss_url,
         ss_user=args.ss_user,
@@ -539,6 +1151,14 @@ if __name__ == "__main__":
         output_dir=args.output_dir,
         mets_type=args.mets_type,
         dip_type=args.dip_type,
+        originals_only=args.originals_only,
+        zip_compression=args.zip_compression,
+        direct=args.direct,
+        move_workers=args.move_workers,
+        download_streams=args.download_streams,
+        aip_cache=cache.AipCache(args.aip_cache, args.aip_cache_size * 1024 * 1024)
+        if args.aip_cache
+        else None,
     )
 
     # The main function returns the DIP's path on success
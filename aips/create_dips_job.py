@@ -10,21 +10,50 @@ Optionally, uploads those DIPs to AtoM or the Storage Service using
 the scripts from `dips` and deletes the local copy.
 """
 import argparse
+import concurrent.futures
+import datetime
+import functools
 import logging.config  # Has to be imported separately
 import os
+import shutil
+import socket
 import sys
+import threading
 
-import amclient
 from sqlalchemy import exc
+from sqlalchemy import or_
+from sqlalchemy.dialects.sqlite import insert
 
+from aips import cache
 from aips import create_dip
 from aips import models
+from aips import pipeline
 from dips import atom_upload
 from dips import storage_service_upload
+from transfers import defaults
+from transfers import utils
 
 THIS_DIR = os.path.abspath(os.path.dirname(__file__))
 LOGGER = logging.getLogger("dip_workflow")
 
+# Database session of the worker processes, see init_worker().
+WORKER_SESSION = None
+
+# Stages of the staged pipeline, see run_pipeline().
+STAGES = ("download", "extract", "build", "upload")
+
+# Serializes the use of the database session by the pipeline threads.
+DB_LOCK = threading.Lock()
+
+# Statuses of the AIPs to create DIPs from
+AIP_STATUSES = ("UPLOADED", "VERIFIED")
+
+# Seconds between two checks of the deposit queue when no deposit is due
+DEPOSIT_POLL_INTERVAL = 5
+
+# Seconds before retrying a failed deposit, doubled after each attempt
+DEPOSIT_RETRY_DELAY = 60
+
 
 def setup_logger(log_file, log_level="INFO"):
     """Configures the logger to output to console and log file"""
@@ -78,9 +107,32 @@ def main(
     atom_password,
     atom_slug,
     rsync_target,
+    upload_backend="rsync",
+    upload_streams=1,
+    bwlimit=None,
+    deposit_workers=0,
+    deposit_attempts=5,
+    download_streams=4,
+    aip_cache=None,
+    workers=1,
+    originals_only=False,
+    zip_compression="deflated",
+    direct=False,
+    staged=False,
+    stage_workers=None,
+    min_free_space=0,
+    resume_after=None,
+    full_scan=False,
+    full_scan_interval=24,
+    page_size=100,
+    http_settings=None,
 ):
     LOGGER.info("Processing AIPs in SS location: %s", location_uuid)
 
+    # Calls to the SS made by this process and the workers share one client
+    if http_settings:
+        utils.configure_client(**http_settings)
+
     # Idempotently create database and Aip table and create session
     try:
         session = models.init(database_file)
@@ -88,115 +140,826 @@ def main(
         LOGGER.error("Could not create database in: %s", database_file)
         return 1
 
-    # Get UPLOADED and VERIFIED AIPs from the SS
+    # Add the AIPs new to the SS to the local catalogue
     try:
-        am_client = amclient.AMClient(
+        am_client = utils.AMClient(
             ss_url=ss_url, ss_user_name=ss_user, ss_api_key=ss_api_key
         )
-        # There is an issue in the SS API that avoids
-        # filtering the results by location. See:
-        # https://github.com/artefactual/archivematica-storage-service/issues/298
-        aips = am_client.aips({"status__in": "UPLOADED,VERIFIED"})
+        sync_catalogue(session, am_client, full_scan, page_size, full_scan_interval)
     except Exception as e:
         LOGGER.error(e)
         return 2
 
     # Get only AIPs from the specified location and origin pipeline
-    aip_uuids = filter_aips(aips, location_uuid, origin_pipeline_uuid)
+    aip_uuids = catalogue_aips(session, location_uuid, origin_pipeline_uuid)
+
+    # Make the AtoM deposits in the background, starting with the ones left
+    # by previous jobs
+    deposit_queue = None
+    if upload_type == "atom-upload" and deposit_workers:
+        deposit_queue = DepositQueue(
+            session,
+            atom_url,
+            atom_email,
+            atom_password,
+            workers=deposit_workers,
+            max_attempts=deposit_attempts,
+            resume_after=resume_after,
+        )
+        deposit_queue.start()
+
+    dip_args = {
+        "ss_url": ss_url,
+        "ss_user": ss_user,
+        "ss_api_key": ss_api_key,
+        "tmp_dir": tmp_dir,
+        "output_dir": output_dir,
+        "delete_local_copy": delete_local_copy,
+        "upload_type": upload_type,
+        "pipeline_uuid": pipeline_uuid,
+        "cp_location_uuid": cp_location_uuid,
+        "ds_location_uuid": ds_location_uuid,
+        "shared_directory": shared_directory,
+        "atom_url": atom_url,
+        "atom_email": atom_email,
+        "atom_password": atom_password,
+        "atom_slug": atom_slug,
+        "rsync_target": rsync_target,
+        "upload_backend": upload_backend,
+        "upload_streams": upload_streams,
+        "bwlimit": bwlimit,
+        "deposit_later": deposit_queue is not None,
+        "download_streams": download_streams,
+        "aip_cache": aip_cache,
+        "originals_only": originals_only,
+        "zip_compression": zip_compression,
+        "direct": direct,
+        "resume_after": resume_after,
+    }
 
     # Create DIPs for those AIPs
-    for uuid in aip_uuids:
+    if staged:
+        stage_workers = dict(dict.fromkeys(STAGES, 1), **(stage_workers or {}))
+        LOGGER.info("Processing AIPs in a staged pipeline: %s", stage_workers)
+        run_pipeline(session, aip_uuids, dip_args, stage_workers, min_free_space)
+    elif workers > 1:
+        LOGGER.info("Processing AIPs with %s workers", workers)
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_worker,
+            initargs=(database_file, http_settings),
+        ) as executor:
+            futures = {
+                executor.submit(process_aip_in_worker, uuid, dip_args): uuid
+                for uuid in aip_uuids
+            }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception:
+                    LOGGER.exception("Could not process AIP: %s", futures[future])
+    else:
+        for uuid in aip_uuids:
+            process_aip(session, uuid, **dip_args)
+
+    if deposit_queue:
+        LOGGER.info("Waiting for the AtoM deposits")
+        deposit_queue.close()
+
+    LOGGER.info("All AIPs have been processed")
+
+
+def claim_aip(session, uuid, resume_after=None):
+    """Record an AIP in the database before processing it, or take over an
+    AIP left unfinished by an interrupted job.
+
+    An unfinished AIP is taken over when the process that owned it is not
+    running on this host anymore or, if resume_after is set, when it has not
+    been updated for resume_after seconds.
+
+    :returns: dict of the checkpoint of the AIP to resume from, see
+              create_dip.main(), or None if the AIP has been or is being
+              processed by another worker or host sharing the database.
+    """
+    owner = get_owner()
+    now = datetime.datetime.utcnow()
+    with DB_LOCK:
         try:
             # To avoid race conditions while checking for an existing AIP
             # and saving it, create the row directly and check for an
             # integrity error exception (the uuid is a unique column)
-            db_aip = models.Aip(uuid=uuid)
+            db_aip = models.Aip(uuid=uuid, owner=owner, updated=now)
             session.add(db_aip)
             session.commit()
+            return {"uuid": uuid, "stage": None}
         except exc.IntegrityError:
             session.rollback()
+
+        db_aip = session.query(models.Aip).filter_by(uuid=uuid).one_or_none()
+        if db_aip is None or db_aip.finished or not is_abandoned(db_aip, resume_after):
             LOGGER.debug("Skipping AIP (already processed/processing): %s", uuid)
-            continue
+            return None
+
+        # Only one job takes over the AIP, the one that updates the owner
+        # it was read with
+        taken = (
+            session.query(models.Aip)
+            .filter_by(uuid=uuid, owner=db_aip.owner, updated=db_aip.updated)
+            .update({"owner": owner, "updated": now}, synchronize_session=False)
+        )
+        session.commit()
+        if not taken:
+            LOGGER.debug("Skipping AIP (already processing): %s", uuid)
+            return None
+        LOGGER.info("Resuming AIP after the %s stage: %s", db_aip.stage, uuid)
+        return {
+            "uuid": uuid,
+            "stage": db_aip.stage,
+            "aip_file": db_aip.aip_file,
+            "checksum": db_aip.checksum,
+            "aip_dir": db_aip.aip_dir,
+            "dip_path": db_aip.dip_path,
+        }
+
+
+def save_checkpoint(session, uuid, stage=None, finished=False, **outputs):
+    """Record the last stage completed for an AIP and its outputs.
+
+    :param str stage: one of models.STAGES
+    :param bool finished: whether the processing of the AIP ended
+    """
+    values = dict(outputs, updated=datetime.datetime.utcnow())
+    if stage:
+        values["stage"] = stage
+    if finished:
+        values["finished"] = True
+    with DB_LOCK:
+        session.query(models.Aip).filter_by(uuid=uuid).update(
+            values, synchronize_session=False
+        )
+        session.commit()
+
+
+def get_owner():
+    """Return the owner of the AIPs processed by this process."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def is_abandoned(db_aip, resume_after=None):
+    """Return whether the process processing an unfinished AIP is gone."""
+    if resume_after is not None and (
+        db_aip.updated is None
+        or datetime.datetime.utcnow() - db_aip.updated
+        > datetime.timedelta(seconds=resume_after)
+    ):
+        return True
+    host, _, pid = (db_aip.owner or "").rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit():
+        # The owner can't be checked from this host
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def process_aip(
+    session,
+    uuid,
+    ss_url,
+    ss_user,
+    ss_api_key,
+    tmp_dir,
+    output_dir,
+    delete_local_copy,
+    upload_type,
+    pipeline_uuid,
+    cp_location_uuid,
+    ds_location_uuid,
+    shared_directory,
+    atom_url,
+    atom_email,
+    atom_password,
+    atom_slug,
+    rsync_target,
+    upload_backend="rsync",
+    upload_streams=1,
+    bwlimit=None,
+    deposit_later=False,
+    download_streams=4,
+    aip_cache=None,
+    originals_only=False,
+    zip_compression="deflated",
+    direct=False,
+    resume_after=None,
+):
+    """Claim an AIP, create its DIP and upload it if requested, recording
+    each stage completed to resume from it if the job is interrupted.
+    """
+    checkpoint = claim_aip(session, uuid, resume_after)
+    if not checkpoint:
+        return
 
-        mets_type = "atom"
-        if upload_type == "ss-upload":
-            mets_type = "storage-service"
+    mets_type = "atom"
+    if upload_type == "ss-upload":
+        mets_type = "storage-service"
 
-        dip_path = create_dip.main(
+    dip_path = create_dip.main(
+        ss_url=ss_url,
+        ss_user=ss_user,
+        ss_api_key=ss_api_key,
+        aip_uuid=uuid,
+        tmp_dir=tmp_dir,
+        output_dir=output_dir,
+        mets_type=mets_type,
+        originals_only=originals_only,
+        zip_compression=zip_compression,
+        direct=direct,
+        download_streams=download_streams,
+        aip_cache=aip_cache,
+        resume=checkpoint,
+        on_stage=functools.partial(save_checkpoint, session, uuid),
+    )
+
+    # Do not try upload on creation error
+    if isinstance(dip_path, int):
+        LOGGER.error("Could not create DIP from AIP: %s", uuid)
+        save_checkpoint(session, uuid, finished=True)
+        return
+
+    upload_dip(
+        uuid,
+        dip_path,
+        ss_url=ss_url,
+        ss_user=ss_user,
+        ss_api_key=ss_api_key,
+        delete_local_copy=delete_local_copy,
+        upload_type=upload_type,
+        pipeline_uuid=pipeline_uuid,
+        cp_location_uuid=cp_location_uuid,
+        ds_location_uuid=ds_location_uuid,
+        shared_directory=shared_directory,
+        atom_url=atom_url,
+        atom_email=atom_email,
+        atom_password=atom_password,
+        atom_slug=atom_slug,
+        rsync_target=rsync_target,
+        upload_backend=upload_backend,
+        upload_streams=upload_streams,
+        bwlimit=bwlimit,
+        deposit_later=deposit_later,
+        session=session,
+    )
+    save_checkpoint(session, uuid, "uploaded" if upload_type else None, finished=True)
+
+
+def upload_dip(
+    uuid,
+    dip_path,
+    ss_url,
+    ss_user,
+    ss_api_key,
+    delete_local_copy,
+    upload_type,
+    pipeline_uuid,
+    cp_location_uuid,
+    ds_location_uuid,
+    shared_directory,
+    atom_url,
+    atom_email,
+    atom_password,
+    atom_slug,
+    rsync_target,
+    upload_backend="rsync",
+    upload_streams=1,
+    bwlimit=None,
+    deposit_later=False,
+    session=None,
+    **kwargs,
+):
+    """Upload a DIP to the Storage Service or AtoM, based on upload_type.
+
+    With deposit_later, the DIP is only sent to the AtoM host and its deposit
+    is added to the queue of the database of session, see DepositQueue.
+    """
+    if upload_type == "ss-upload":
+        storage_service_upload.main(
             ss_url=ss_url,
             ss_user=ss_user,
             ss_api_key=ss_api_key,
+            pipeline_uuid=pipeline_uuid,
+            cp_location_uuid=cp_location_uuid,
+            ds_location_uuid=ds_location_uuid,
+            shared_directory=shared_directory,
+            dip_path=dip_path,
             aip_uuid=uuid,
-            tmp_dir=tmp_dir,
-            output_dir=output_dir,
-            mets_type=mets_type,
+            delete_local_copy=delete_local_copy,
         )
+    elif upload_type == "atom-upload":
+        result = atom_upload.main(
+            atom_url=atom_url,
+            atom_email=atom_email,
+            atom_password=atom_password,
+            atom_slug=atom_slug,
+            rsync_target=rsync_target,
+            dip_path=dip_path,
+            delete_local_copy=delete_local_copy,
+            upload_backend=upload_backend,
+            upload_streams=upload_streams,
+            bwlimit=bwlimit,
+            deposit_dip=not deposit_later,
+        )
+        if deposit_later and not result:
+            enqueue_deposit(session, uuid, dip_path, atom_slug, delete_local_copy)
 
-        # Do not try upload on creation error
-        if isinstance(dip_path, int):
-            LOGGER.error("Could not create DIP from AIP: %s", uuid)
-            continue
 
-        if upload_type == "ss-upload":
-            storage_service_upload.main(
-                ss_url=ss_url,
-                ss_user=ss_user,
-                ss_api_key=ss_api_key,
-                pipeline_uuid=pipeline_uuid,
-                cp_location_uuid=cp_location_uuid,
-                ds_location_uuid=ds_location_uuid,
-                shared_directory=shared_directory,
-                dip_path=dip_path,
-                aip_uuid=uuid,
-                delete_local_copy=delete_local_copy,
+def enqueue_deposit(session, uuid, dip_path, atom_slug, delete_local_copy=False):
+    """Add the AtoM deposit of a DIP to the queue, replacing any previous
+    deposit of the same AIP.
+    """
+    now = datetime.datetime.utcnow()
+    values = {
+        "dip_path": dip_path,
+        "atom_slug": atom_slug,
+        "delete_local_copy": bool(delete_local_copy),
+        "status": "pending",
+        "attempts": 0,
+        "next_attempt": now,
+        "last_error": None,
+        "owner": None,
+        "updated": now,
+    }
+    statement = (
+        insert(models.Deposit)
+        .values(uuid=uuid, **values)
+        .on_conflict_do_update(index_elements=["uuid"], set_=values)
+    )
+    with DB_LOCK:
+        session.execute(statement)
+        session.commit()
+    LOGGER.info("AtoM deposit queued for AIP: %s", uuid)
+
+
+def claim_deposit(session, resume_after=None):
+    """Take the next deposit due from the queue.
+
+    Deposits taken by a job that is gone are taken over, see is_abandoned().
+
+    :returns: dict of the deposit, or None if no deposit is due
+    """
+    owner = get_owner()
+    now = datetime.datetime.utcnow()
+    with DB_LOCK:
+        deposits = (
+            session.query(models.Deposit)
+            .filter(
+                models.Deposit.status.in_(("pending", "retry")),
+                models.Deposit.next_attempt <= now,
             )
-        elif upload_type == "atom-upload":
-            atom_upload.main(
-                atom_url=atom_url,
-                atom_email=atom_email,
-                atom_password=atom_password,
-                atom_slug=atom_slug,
-                rsync_target=rsync_target,
-                dip_path=dip_path,
-                delete_local_copy=delete_local_copy,
+            .order_by(models.Deposit.next_attempt, models.Deposit.id)
+            .all()
+        )
+        for deposit in deposits:
+            if deposit.owner and not is_abandoned(deposit, resume_after):
+                continue
+            # Only one worker takes the deposit, the one that updates the
+            # owner it was read with
+            taken = (
+                session.query(models.Deposit)
+                .filter_by(id=deposit.id, owner=deposit.owner, updated=deposit.updated)
+                .update({"owner": owner, "updated": now}, synchronize_session=False)
             )
+            session.commit()
+            if taken:
+                return {
+                    "id": deposit.id,
+                    "uuid": deposit.uuid,
+                    "dip_path": deposit.dip_path,
+                    "atom_slug": deposit.atom_slug,
+                    "delete_local_copy": deposit.delete_local_copy,
+                    "attempts": deposit.attempts,
+                }
+        session.commit()
+    return None
 
-    LOGGER.info("All AIPs have been processed")
 
+def finish_deposit(session, deposit, error=None, max_attempts=5):
+    """Record the outcome of an attempt to make a deposit, scheduling a
+    retry if it failed less than max_attempts times.
 
-def filter_aips(aips, location_uuid, origin_pipeline_uuid):
+    :param dict deposit: deposit, as returned by claim_deposit()
+    :param str error: error of the attempt, None if it succeeded
     """
-    Filters a list of AIPs based on a location UUID.
+    now = datetime.datetime.utcnow()
+    attempts = deposit["attempts"] + 1
+    values = {"attempts": attempts, "owner": None, "updated": now}
+    if error is None:
+        values.update(status="deposited", last_error=None)
+    elif attempts < max_attempts:
+        delay = DEPOSIT_RETRY_DELAY * 2 ** (attempts - 1)
+        values.update(
+            status="retry",
+            last_error=error,
+            next_attempt=now + datetime.timedelta(seconds=delay),
+        )
+    else:
+        values.update(status="failed", last_error=error)
+    with DB_LOCK:
+        session.query(models.Deposit).filter_by(id=deposit["id"]).update(
+            values, synchronize_session=False
+        )
+        session.commit()
+    return values["status"]
 
-    :param list aips: list of AIPs from the results of an SS response
-    :param str location_uuid: UUID from the SS location
-    :param str origin_pipeline_uuid: UUID from the origin pipeline
-    :returns: list of UUIDs from the AIPs in that location
+
+class DepositQueue:
+    """Threads making the AtoM deposits of the queue in the database while
+    the job creates the next DIPs. The queue is kept in the database, so the
+    deposits left by a job are made by the next one.
     """
-    location = f"/api/v2/location/{location_uuid}/"
-    filtered_aips = []
 
-    for aip in aips:
-        if "uuid" not in aip:
-            LOGGER.warning("Skipping AIP (missing UUID in SS response)")
-            continue
-        if "current_location" not in aip:
-            LOGGER.debug("Skipping AIP (missing location): %s", aip["uuid"])
-            continue
-        if aip["current_location"] != location:
-            LOGGER.debug("Skipping AIP (different location): %s", aip["uuid"])
+    def __init__(
+        self,
+        session,
+        atom_url,
+        atom_email,
+        atom_password,
+        workers=1,
+        max_attempts=5,
+        resume_after=None,
+    ):
+        """
+        :param int workers: number of deposits made at the same time
+        :param int max_attempts: attempts to make a deposit before it fails
+        :param int resume_after: seconds after which the deposits taken by a
+                                 job on another host are taken over
+        """
+        self.session = session
+        self.atom_url = atom_url
+        self.atom_email = atom_email
+        self.atom_password = atom_password
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.resume_after = resume_after
+        self._closing = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """Start the threads making the deposits."""
+        for number in range(self.workers):
+            thread = threading.Thread(
+                target=self._work, name=f"deposit-{number}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self):
+        """Wait until the deposits due are made and stop the threads. The
+        deposits to retry later are left in the queue.
+        """
+        self._closing.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _work(self):
+        while True:
+            try:
+                deposit = claim_deposit(self.session, self.resume_after)
+            except exc.SQLAlchemyError:
+                LOGGER.exception("Could not read the deposit queue")
+                deposit = None
+            if deposit is not None:
+                self.make_deposit(deposit)
+            elif self._closing.is_set():
+                return
+            else:
+                self._closing.wait(DEPOSIT_POLL_INTERVAL)
+
+    def make_deposit(self, deposit):
+        """Make a deposit taken from the queue and record its outcome."""
+        error = None
+        try:
+            atom_upload.deposit(
+                self.atom_url,
+                self.atom_email,
+                self.atom_password,
+                deposit["atom_slug"],
+                deposit["dip_path"],
+            )
+        except Exception as e:
+            error = str(e) or e.__class__.__name__
+        status = finish_deposit(self.session, deposit, error, self.max_attempts)
+        if error:
+            LOGGER.warning(
+                "Deposit request to AtoM failed (%s) for AIP %s: %s",
+                status,
+                deposit["uuid"],
+                error,
+            )
+            return
+        LOGGER.info("DIP deposited in AtoM: %s", deposit["dip_path"])
+        if deposit["delete_local_copy"]:
+            LOGGER.info("Deleting local DIP.")
+            try:
+                shutil.rmtree(deposit["dip_path"])
+            except (OSError, shutil.Error) as e:
+                LOGGER.warning("DIP removal failed: %s", e)
+
+
+def run_pipeline(session, aip_uuids, dip_args, stage_workers, min_free_space=0):
+    """Process the AIPs in a staged pipeline, where the AIPs are downloaded,
+    extracted, turned into DIPs and uploaded at the same time, e.g. the next
+    AIP is downloaded while the current one is extracted.
+
+    :param dict stage_workers: number of threads of the "download", "extract",
+                               "build" and "upload" stages
+    :param int min_free_space: bytes that must be free in the temporary
+                               directory before starting a download
+    :returns: number of AIPs that went through all the stages
+    """
+    tmp_dir = dip_args["tmp_dir"]
+    output_dir = dip_args["output_dir"]
+    mets_type = "atom"
+    if dip_args["upload_type"] == "ss-upload":
+        mets_type = "storage-service"
+
+    def claimed():
+        # Claim the AIPs as the pipeline takes them
+        for uuid in aip_uuids:
+            checkpoint = claim_aip(session, uuid, dip_args["resume_after"])
+            if checkpoint:
+                checkpoint["stage"] = create_dip.resume_stage(checkpoint)
+                yield checkpoint
+
+    def failed(item):
+        LOGGER.error("Could not create DIP from AIP: %s", item["uuid"])
+        save_checkpoint(session, item["uuid"], finished=True)
+
+    def download(item):
+        if item["stage"]:
+            LOGGER.info("Resuming AIP after the %s stage", item["stage"])
+            item["workspace"] = os.path.dirname(item["aip_file"])
+            return item
+        if min_free_space:
+            pipeline.wait_for_space(tmp_dir, min_free_space, dip_pipeline)
+        LOGGER.info("Starting DIP creation from AIP: %s", item["uuid"])
+        downloaded = create_dip.download_aip(
+            dip_args["ss_url"],
+            dip_args["ss_user"],
+            dip_args["ss_api_key"],
+            item["uuid"],
+            tmp_dir,
+            output_dir,
+            dip_args["download_streams"],
+            dip_args["aip_cache"],
+        )
+        if isinstance(downloaded, int):
+            failed(item)
+            return None
+        item["workspace"], item["aip_file"], checksum = downloaded
+        save_checkpoint(
+            session,
+            item["uuid"],
+            "downloaded",
+            aip_file=item["aip_file"],
+            checksum=checksum,
+        )
+        return item
+
+    def extract(item):
+        if dip_args["direct"] or item["stage"] in ("extracted", "built"):
+            # The build stage reads the archive or the AIP is extracted
+            return item
+        LOGGER.info("Extracting AIP: %s", item["uuid"])
+        item["aip_dir"] = create_dip.extract_aip(
+            item["aip_file"],
+            item["uuid"],
+            item["workspace"],
+            dip_args["originals_only"],
+        )
+        if not item["aip_dir"]:
+            failed(item)
+            shutil.rmtree(item["workspace"], ignore_errors=True)
+            return None
+        save_checkpoint(session, item["uuid"], "extracted", aip_dir=item["aip_dir"])
+        return item
+
+    def build(item):
+        if item["stage"] == "built":
+            return item
+        if dip_args["direct"] and item["stage"] != "extracted":
+            item["dip_path"] = create_dip.build_dip_from_archive(
+                item["aip_file"],
+                item["uuid"],
+                item["workspace"],
+                output_dir,
+                mets_type,
+                dip_args["zip_compression"],
+            )
+        else:
+            item["dip_path"] = create_dip.build_dip(
+                item["aip_dir"],
+                item["uuid"],
+                item["workspace"],
+                output_dir,
+                mets_type,
+                "zipped-objects",
+                dip_args["zip_compression"],
+            )
+        if isinstance(item["dip_path"], int):
+            failed(item)
+            shutil.rmtree(item["workspace"], ignore_errors=True)
+            return None
+        save_checkpoint(
+            session,
+            item["uuid"],
+            "built",
+            finished=not dip_args["upload_type"],
+            dip_path=item["dip_path"],
+        )
+        return item
+
+    def upload(item):
+        upload_dip(item["uuid"], item["dip_path"], session=session, **dip_args)
+        save_checkpoint(session, item["uuid"], "uploaded", finished=True)
+        return item
+
+    stages = [
+        pipeline.Stage("download", download, stage_workers["download"]),
+        pipeline.Stage("extract", extract, stage_workers["extract"]),
+        pipeline.Stage("build", build, stage_workers["build"]),
+    ]
+    if dip_args["upload_type"]:
+        stages.append(pipeline.Stage("upload", upload, stage_workers["upload"]))
+    dip_pipeline = pipeline.Pipeline(stages)
+    return dip_pipeline.run(claimed())
+
+
+def init_worker(database_file, http_settings=None):
+    """Open the database session of a worker process and configure its HTTP
+    client with the settings of the job.
+    """
+    global WORKER_SESSION
+    WORKER_SESSION = models.init(database_file)
+    if http_settings:
+        utils.configure_client(**http_settings)
+
+
+def process_aip_in_worker(uuid, dip_args):
+    """Process an AIP in a worker process, see process_aip()."""
+    process_aip(WORKER_SESSION, uuid, **dip_args)
+
+
+def iter_package_pages(am_client, params, offset=0, page_size=100):
+    """
+    Yields the packages listed by the SS one page at a time.
+
+    :param dict params: filters of the SS packages API
+    :param int offset: number of packages to skip
+    :returns: tuples of the total number of packages, the offset of the next
+              page and the list of packages of the page
+    """
+    while True:
+        response = am_client.get_package(dict(params, limit=page_size, offset=offset))
+        if not isinstance(response, dict) and "order_by" in params:
+            LOGGER.warning("The SS can't sort the packages, listing them unsorted")
+            params = {key: value for key, value in params.items() if key != "order_by"}
             continue
-        if origin_pipeline_uuid:
-            pipeline = f"/api/v2/pipeline/{origin_pipeline_uuid}/"
-            if "origin_pipeline" not in aip:
-                LOGGER.debug("Skipping AIP (missing pipeline): %s", aip["uuid"])
-                continue
-            if aip["origin_pipeline"] != pipeline:
-                LOGGER.debug("Skipping AIP (different pipeline): %s", aip["uuid"])
-                continue
-        filtered_aips.append(aip["uuid"])
+        if not isinstance(response, dict):
+            raise Exception("Error connecting to the SS")
+        packages = response["objects"]
+        offset += len(packages)
+        yield response["meta"]["total_count"], offset, packages
+        if not response["meta"]["next"] or not packages:
+            break
 
-    return filtered_aips
+
+def sync_catalogue(
+    session, am_client, full_scan=False, page_size=100, full_scan_interval=None
+):
+    """
+    Adds the AIPs listed by the SS to the local catalogue.
+
+    There is an issue in the SS API that avoids filtering the results by
+    location, so all AIPs are listed, whatever their status, and stored in
+    the catalogue to filter them locally. The SS is asked to list them by id,
+    the order they were created, and the catalogue records how many it has
+    listed, so later calls only fetch the AIPs created since. See:
+    https://github.com/artefactual/archivematica-storage-service/issues/298
+
+    An offset misses the AIPs created when others were removed since the last
+    call, and the changes to the AIPs listed, so all AIPs are listed again
+    every full_scan_interval hours.
+
+    :param bool full_scan: list all AIPs again, to update the location and
+                           status of the known ones and forget the ones gone
+    :param int full_scan_interval: hours between full scans, or None to only
+                                   scan when requested
+    :returns: number of AIPs listed
+    """
+    started = datetime.datetime.utcnow()
+    session.execute(
+        insert(models.CatalogueState)
+        .values(ss_url=am_client.ss_url, offset=0)
+        .on_conflict_do_nothing(index_elements=["ss_url"])
+    )
+    state = (
+        session.query(models.CatalogueState).filter_by(ss_url=am_client.ss_url).one()
+    )
+    if not full_scan and full_scan_interval:
+        full_scan = (
+            state.full_scanned is None
+            or started - state.full_scanned
+            >= datetime.timedelta(hours=full_scan_interval)
+        )
+        if full_scan:
+            LOGGER.info("Last full scan over %s hours ago", full_scan_interval)
+    start = 0 if full_scan else state.offset
+    LOGGER.info("Listing AIPs in the SS from: %s", start)
+
+    listed = 0
+    pages = iter_package_pages(
+        am_client, {"package_type": "AIP", "order_by": "id"}, start, page_size
+    )
+    for total_count, offset, packages in pages:
+        if total_count < start:
+            # Packages were removed from the SS, the offset is not valid
+            LOGGER.warning("Fewer AIPs in the SS than listed, listing all again")
+            session.rollback()
+            return sync_catalogue(session, am_client, True, page_size)
+        now = datetime.datetime.utcnow()
+        rows = [
+            {
+                "uuid": package["uuid"],
+                "current_location": package.get("current_location"),
+                "origin_pipeline": package.get("origin_pipeline"),
+                "status": package.get("status"),
+                "last_seen": now,
+            }
+            for package in packages
+            if "uuid" in package
+        ]
+        if rows:
+            statement = insert(models.CatalogueAip).values(rows)
+            session.execute(
+                statement.on_conflict_do_update(
+                    index_elements=["uuid"],
+                    set_={
+                        column: statement.excluded[column]
+                        for column in rows[0]
+                        if column != "uuid"
+                    },
+                )
+            )
+        state.offset = offset
+        state.synced = now
+        session.commit()
+        listed += len(packages)
+
+    if full_scan:
+        state.full_scanned = started
+        forgotten = (
+            session.query(models.CatalogueAip)
+            .filter(models.CatalogueAip.last_seen < started)
+            .delete(synchronize_session=False)
+        )
+        session.commit()
+        if forgotten:
+            LOGGER.info("Removed %s AIPs gone from the SS", forgotten)
+    LOGGER.info("Listed %s AIPs in the SS", listed)
+    return listed
+
+
+def catalogue_aips(session, location_uuid, origin_pipeline_uuid):
+    """
+    Returns the UUIDs of the AIPs in the catalogue from a location and origin
+    pipeline, with an UPLOADED or VERIFIED status, that were not processed
+    yet.
+
+    :param str location_uuid: UUID from the SS location
+    :param str origin_pipeline_uuid: UUID from the origin pipeline, optional
+    :returns: list of UUIDs from the AIPs, in the order they were listed
+    """
+    query = (
+        session.query(models.CatalogueAip.uuid)
+        .outerjoin(models.Aip, models.Aip.uuid == models.CatalogueAip.uuid)
+        .filter(
+            models.CatalogueAip.current_location
+            == f"/api/v2/location/{location_uuid}/",
+            models.CatalogueAip.status.in_(AIP_STATUSES),
+            or_(models.Aip.finished.is_(None), models.Aip.finished.is_(False)),
+        )
+    )
+    if origin_pipeline_uuid:
+        query = query.filter(
+            models.CatalogueAip.origin_pipeline
+            == f"/api/v2/pipeline/{origin_pipeline_uuid}/"
+        )
+    return [uuid for uuid, in query.order_by(models.CatalogueAip.id)]
 
 
 if __name__ == "__main__":
@@ -251,6 +1014,122 @@ if __name__ == "__main__":
         help="Absolute path to the directory used to place the final DIP. Default: /tmp.",
         default="/tmp",
     )
+    parser.add_argument(
+        "--workers",
+        metavar="N",
+        type=int,
+        help="Number of AIPs to process at the same time. Default: 1.",
+        default=1,
+    )
+    parser.add_argument(
+        "--originals-only",
+        action="store_true",
+        help="Extract only the original files, submissionDocumentation and METS file from the AIPs.",
+    )
+    parser.add_argument(
+        "--zip-compression",
+        choices=list(create_dip.ZIP_COMPRESSION),
+        default="deflated",
+        help="Compression of the ZIP file in the DIPs, use stored for already compressed media. Default: deflated.",
+    )
+    parser.add_argument(
+        "--direct",
+        action="store_true",
+        help="Create the DIPs reading the files straight from the AIP archives, without extracting them.",
+    )
+    parser.add_argument(
+        "--staged",
+        action="store_true",
+        help="Download, extract, build and upload different AIPs at the same time.",
+    )
+    for stage in STAGES:
+        parser.add_argument(
+            f"--{stage}-workers",
+            metavar="N",
+            type=int,
+            help=f"Number of threads of the {stage} stage with --staged. Default: 1.",
+            default=1,
+        )
+    parser.add_argument(
+        "--min-free-space",
+        metavar="MB",
+        type=int,
+        help="Free space in the temporary directory needed to start a download with --staged. Default: 0.",
+        default=0,
+    )
+    parser.add_argument(
+        "--download-streams",
+        metavar="N",
+        type=int,
+        default=4,
+        help="Number of chunks of each AIP downloaded at the same time. Default: 4.",
+    )
+    parser.add_argument(
+        "--aip-cache",
+        metavar="PATH",
+        help="Absolute path to a directory to keep the downloaded AIPs in and take them from, instead of downloading them again.",
+    )
+    parser.add_argument(
+        "--aip-cache-size",
+        metavar="MB",
+        type=int,
+        default=0,
+        help="Space the AIPs in --aip-cache can take, the least recently used ones are removed to stay within it. Default: 0, no limit.",
+    )
+    parser.add_argument(
+        "--full-scan",
+        action="store_true",
+        help="List all the AIPs in the SS again, instead of only the ones created since the last run, to update the local catalogue.",
+    )
+    parser.add_argument(
+        "--full-scan-interval",
+        metavar="HOURS",
+        type=int,
+        default=24,
+        help="Hours after which all the AIPs in the SS are listed again, as with --full-scan. 0 to only do it with --full-scan. Default: 24.",
+    )
+    parser.add_argument(
+        "--page-size",
+        metavar="N",
+        type=int,
+        help="Number of AIPs requested to the SS at a time. Default: 100.",
+        default=100,
+    )
+    parser.add_argument(
+        "--http-timeout",
+        metavar="SECONDS",
+        type=float,
+        default=defaults.DEFAULT_HTTP_TIMEOUT,
+        help="Seconds to wait for a response of the SS. Default: 120.",
+    )
+    parser.add_argument(
+        "--http-retries",
+        metavar="N",
+        type=int,
+        default=defaults.DEFAULT_HTTP_RETRIES,
+        help="Retries of the SS requests on connection errors and 502, 503 or 504 responses. Default: 3.",
+    )
+    parser.add_argument(
+        "--http-backoff",
+        metavar="SECONDS",
+        type=float,
+        default=defaults.DEFAULT_HTTP_BACKOFF,
+        help="Backoff factor between the retries, doubled on every retry. Default: 0.5.",
+    )
+    parser.add_argument(
+        "--http-pool-size",
+        metavar="N",
+        type=int,
+        default=defaults.DEFAULT_HTTP_POOL_SIZE,
+        help="Connections to the SS kept open by each process. Default: 10.",
+    )
+    parser.add_argument(
+        "--resume-after",
+        metavar="SECONDS",
+        type=int,
+        help="Resume the AIPs left unfinished by jobs on other hosts after this many seconds without progress. By default, only the AIPs of interrupted jobs on this host are resumed.",
+        default=None,
+    )
 
     # Logging
     parser.add_argument(
@@ -347,7 +1226,46 @@ if __name__ == "__main__":
         "--rsync-target",
         metavar="HOST:PATH",
         required=True,
-        help="Destination value passed to Rsync.",
+        help="Destination value passed to Rsync, or to sftp. Path of a mounted "
+        "folder for the local upload backend.",
+    )
+    parser_atom.add_argument(
+        "--upload-backend",
+        choices=atom_upload.BACKENDS,
+        default="rsync",
+        help="How to send the DIP folders to the AtoM host. Default: rsync.",
+    )
+    parser_atom.add_argument(
+        "--upload-streams",
+        metavar="N",
+        type=int,
+        default=1,
+        help="Number of files sent at the same time by the sftp and local "
+        "upload backends. Default: 1.",
+    )
+    parser_atom.add_argument(
+        "--bwlimit",
+        metavar="KBPS",
+        type=int,
+        default=None,
+        help="Bandwidth limit of each DIP upload in KB/s.",
+    )
+    parser_atom.add_argument(
+        "--deposit-workers",
+        metavar="N",
+        type=int,
+        default=0,
+        help="Make the deposit requests to AtoM from a queue in the database, "
+        "with N requests at the same time, while the next DIPs are created. "
+        "Default: 0, each deposit is made right after its DIP is uploaded.",
+    )
+    parser_atom.add_argument(
+        "--deposit-attempts",
+        metavar="N",
+        type=int,
+        default=5,
+        help="Attempts to make a queued deposit request before giving up. "
+        "Default: 5.",
     )
 
     args = parser.parse_args()
@@ -388,5 +1306,35 @@ if __name__ == "__main__":
             atom_password=args_dict.get("atom_password"),
             atom_slug=args_dict.get("atom_slug"),
             rsync_target=args_dict.get("rsync_target"),
+            upload_backend=args_dict.get("upload_backend"),
+            upload_streams=args_dict.get("upload_streams"),
+            bwlimit=args_dict.get("bwlimit"),
+            deposit_workers=args_dict.get("deposit_workers") or 0,
+            deposit_attempts=args_dict.get("deposit_attempts") or 5,
+            download_streams=args_dict.get("download_streams"),
+            aip_cache=cache.AipCache(
+                args_dict["aip_cache"], args_dict.get("aip_cache_size") * 1024 * 1024
+            )
+            if args_dict.get("aip_cache")
+            else None,
+            workers=args_dict.get("workers"),
+            originals_only=args_dict.get("originals_only"),
+            zip_compression=args_dict.get("zip_compression"),
+            direct=args_dict.get("direct"),
+            staged=args_dict.get("staged"),
+            stage_workers={
+                stage: args_dict.get(f"{stage}_workers") for stage in STAGES
+            },
+            min_free_space=args_dict.get("min_free_space") * 1024 * 1024,
+            resume_after=args_dict.get("resume_after"),
+            full_scan=args_dict.get("full_scan"),
+            full_scan_interval=args_dict.get("full_scan_interval"),
+            page_size=args_dict.get("page_size"),
+            http_settings={
+                "timeout": args_dict.get("http_timeout"),
+                "retries": args_dict.get("http_retries"),
+                "backoff_factor": args_dict.get("http_backoff"),
+                "pool_size": args_dict.get("http_pool_size"),
+            },
         )
     )
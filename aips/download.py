@@ -0,0 +1,381 @@
+"""
+AIP download
+
+Downloads packages from the Storage Service in chunks, with HTTP Range
+requests made by several threads at the same time through the shared HTTP
+client, see transfers.utils.get_client(). The chunks are written to a partial
+file next to a state file recording the chunks completed, so a download that
+fails or is interrupted resumes from where it stopped. Servers that do not
+support ranges send the whole package in a single stream.
+"""
+import collections
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import requests
+
+from aips import archive
+from transfers import utils
+
+LOGGER = logging.getLogger("dip_workflow")
+
+# Size of the chunks requested with a Range header
+CHUNK_SIZE = 64 * 1024 * 1024
+
+# Size of the blocks read from the responses
+BLOCK_SIZE = 1024 * 1024
+
+# Suffixes of the partial file of a download and of its state file
+PART_SUFFIX = ".part"
+STATE_SUFFIX = ".part.json"
+
+# Seconds before retrying a chunk, doubled after each attempt
+RETRY_DELAY = 2
+
+CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+Package = collections.namedtuple("Package", "path checksum")
+Package.__doc__ = """Package downloaded.
+
+``checksum`` is the SHA-256 hex digest of the file at ``path``, computed while
+it was downloaded.
+"""
+
+
+class DownloadError(Exception):
+    """Error downloading a package."""
+
+
+def download_package(
+    ss_url,
+    ss_user,
+    ss_api_key,
+    uuid,
+    directory,
+    streams=4,
+    chunk_size=CHUNK_SIZE,
+    retries=3,
+):
+    """
+    Download a package from the Storage Service to directory.
+
+    :param int streams: number of chunks downloaded at the same time
+    :param int chunk_size: size of the chunks in bytes
+    :param int retries: attempts to download a chunk before giving up, the
+                        partial download is kept to resume it later
+    :returns: Package tuple of the absolute path to the package file and its
+              checksum, or None on error
+    """
+    url = f"{ss_url}/api/v2/file/{uuid}/download/"
+    params = {"username": ss_user, "api_key": ss_api_key}
+    try:
+        return fetch(url, params, directory, uuid, streams, chunk_size, retries)
+    except (requests.RequestException, OSError, DownloadError) as err:
+        LOGGER.warning("Unable to download package %s: %s", uuid, err)
+        return None
+
+
+def package_size(ss_url, ss_user, ss_api_key, uuid):
+    """Return the size in bytes of a package reported by the Storage Service,
+    or None if it can't be retrieved.
+    """
+    details = utils.AMClient(
+        ss_url=ss_url, ss_user_name=ss_user, ss_api_key=ss_api_key, package_uuid=uuid
+    ).get_package_details()
+    try:
+        return int(details["size"])
+    except (KeyError, TypeError, ValueError):
+        LOGGER.warning("Unable to get the size of package %s", uuid)
+        return None
+
+
+def fetch(url, params, directory, uuid, streams=4, chunk_size=CHUNK_SIZE, retries=3):
+    """Download the file of url to directory, see download_package().
+
+    :raises DownloadError: if the download can't be completed or verified
+    """
+    # The first chunk tells whether the server supports ranges
+    response = utils.get_client().get(
+        url,
+        params=params,
+        headers={"Range": f"bytes=0-{chunk_size - 1}"},
+        stream=True,
+    )
+    if response.status_code not in (200, 206):
+        raise DownloadError(f"Response status code {response.status_code}")
+    path = os.path.join(directory, package_filename(response, uuid))
+    content_range = CONTENT_RANGE.match(response.headers.get("Content-Range") or "")
+    if response.status_code == 200 or not content_range:
+        LOGGER.info("Downloading %s in a single stream", url)
+        size, checksum = write_stream(response, path)
+    else:
+        size = int(content_range.group(3))
+        validator = response.headers.get("ETag") or response.headers.get(
+            "Last-Modified"
+        )
+        checksum = fetch_ranges(
+            url,
+            params,
+            path,
+            size,
+            validator,
+            response,
+            streams,
+            chunk_size,
+            retries,
+        )
+    verify(path, size)
+    return Package(path, checksum)
+
+
+def package_filename(response, uuid):
+    """Return the name of the package file of a download response."""
+    try:
+        return re.findall('filename="(.+)"', response.headers["content-disposition"])[0]
+    except (KeyError, IndexError):
+        # Assuming that packages are stored as .7z, like amclient does
+        return f"package-{uuid}.7z"
+
+
+def write_stream(response, path):
+    """Write the body of a response to path and return the expected size,
+    or None if it is unknown, and the checksum of the body.
+    """
+    checksum = hashlib.sha256()
+    try:
+        with open(path, "wb") as f:
+            for block in response.iter_content(chunk_size=BLOCK_SIZE):
+                if block:
+                    checksum.update(block)
+                    f.write(block)
+    finally:
+        response.close()
+    size = response.headers.get("Content-Length")
+    return int(size) if size and size.isdigit() else None, checksum.hexdigest()
+
+
+def fetch_ranges(
+    url, params, path, size, validator, first, streams, chunk_size, retries
+):
+    """Download the chunks of a file not downloaded yet into its partial
+    file, then rename it to path.
+
+    :param first: response of the request of the first chunk
+    :returns: checksum of the file
+    """
+    part_path = path + PART_SUFFIX
+    chunks = [
+        (start, min(start + chunk_size, size) - 1)
+        for start in range(0, size, chunk_size)
+    ]
+    state = read_state(path, size, validator, chunk_size)
+    if state["done"]:
+        LOGGER.info(
+            "Resuming download of %s, %s of %s chunks done",
+            os.path.basename(path),
+            len(state["done"]),
+            len(chunks),
+        )
+    if not state["done"] or not os.path.isfile(part_path):
+        state["done"] = []
+        with open(part_path, "wb") as f:
+            f.truncate(size)
+        write_state(path, state)
+    done = set(state["done"])
+    lock = threading.Lock()
+    hasher = RangeHasher(part_path, chunks, done)
+
+    def download_chunk(index):
+        # The client retries failed connections and error responses, this
+        # retries the chunks whose body is cut or not the range requested
+        start, end = chunks[index]
+        for attempt in range(1, retries + 1):
+            response = first if index == 0 and attempt == 1 else None
+            try:
+                if response is None:
+                    headers = {"Range": f"bytes={start}-{end}"}
+                    if validator:
+                        # Sends the whole file instead if it changed
+                        headers["If-Range"] = validator
+                    response = utils.get_client().get(
+                        url, params=params, headers=headers, stream=True
+                    )
+                write_range(response, part_path, start, end)
+                break
+            except (requests.RequestException, OSError, DownloadError) as err:
+                if attempt == retries:
+                    raise
+                LOGGER.warning(
+                    "Download of bytes %s-%s failed, retrying: %s", start, end, err
+                )
+                time.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+        with lock:
+            state["done"].append(index)
+            write_state(path, state)
+        hasher.written(index)
+
+    if 0 in done:
+        first.close()
+    pending = [index for index in range(len(chunks)) if index not in done]
+    LOGGER.info(
+        "Downloading %s chunks of %s in %s streams",
+        len(pending),
+        os.path.basename(path),
+        streams,
+    )
+    with concurrent.futures.ThreadPoolExecutor(max_workers=streams) as executor:
+        futures = [executor.submit(download_chunk, index) for index in pending]
+        errors = [future.exception() for future in futures]
+    errors = [error for error in errors if error is not None]
+    if errors:
+        raise DownloadError(
+            f"{len(errors)} chunks failed, the download will resume from "
+            f"{part_path}: {errors[0]}"
+        )
+    checksum = hasher.hexdigest()
+    os.replace(part_path, path)
+    os.remove(path + STATE_SUFFIX)
+    return checksum
+
+
+class RangeHasher:
+    """Checksums a file written in chunks in any order.
+
+    Each chunk is hashed as soon as the ones before it are written, while it
+    is likely still in the page cache, instead of reading the whole file again
+    once downloaded.
+    """
+
+    def __init__(self, path, chunks, written=()):
+        """
+        :param list chunks: (start, end) byte ranges of the chunks, in order
+        :param written: indexes of the chunks already written
+        """
+        self.path = path
+        self.chunks = chunks
+        self._checksum = hashlib.sha256()
+        self._written = set(written)
+        self._hashed = 0
+        self._lock = threading.Lock()
+        self._hash_lock = threading.Lock()
+
+    def written(self, index):
+        """Record that a chunk was written and hash the chunks ready."""
+        with self._lock:
+            self._written.add(index)
+        # One thread hashes at a time, the others go on downloading and the
+        # chunks they leave are hashed by the next call or hexdigest()
+        if self._hash_lock.acquire(blocking=False):
+            try:
+                self._hash_ready()
+            finally:
+                self._hash_lock.release()
+
+    def hexdigest(self):
+        """Return the checksum of the file once all its chunks are written."""
+        with self._hash_lock:
+            self._hash_ready()
+        if self._hashed != len(self.chunks):
+            raise DownloadError(f"{self.path} is missing chunks")
+        return self._checksum.hexdigest()
+
+    def _hash_ready(self):
+        """Hash the written chunks following the ones hashed."""
+        with open(self.path, "rb") as f:
+            while True:
+                with self._lock:
+                    if self._hashed not in self._written:
+                        return
+                start, end = self.chunks[self._hashed]
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining:
+                    block = f.read(min(BLOCK_SIZE, remaining))
+                    if not block:
+                        raise DownloadError(f"{self.path} is truncated")
+                    self._checksum.update(block)
+                    remaining -= len(block)
+                self._hashed += 1
+
+
+def write_range(response, part_path, start, end):
+    """Write the body of a ranged response at its position in the partial
+    file, checking that it is the range requested.
+    """
+    try:
+        if response.status_code != 206:
+            raise DownloadError(
+                f"Response status code {response.status_code} for a range, "
+                "the file may have changed"
+            )
+        content_range = CONTENT_RANGE.match(response.headers.get("Content-Range") or "")
+        if not content_range or (
+            int(content_range.group(1)),
+            int(content_range.group(2)),
+        ) != (start, end):
+            raise DownloadError(f"Unexpected range for {start}-{end}")
+        written = 0
+        with open(part_path, "r+b") as f:
+            f.seek(start)
+            for block in response.iter_content(chunk_size=BLOCK_SIZE):
+                written += len(block)
+                if written > end - start + 1:
+                    raise DownloadError(f"Range {start}-{end} is too long")
+                f.write(block)
+            f.flush()
+            os.fsync(f.fileno())
+    finally:
+        response.close()
+    if written != end - start + 1:
+        raise DownloadError(f"Range {start}-{end} is truncated")
+
+
+def read_state(path, size, validator, chunk_size):
+    """Return the state of the partial download of path, or a new state if
+    there is none or it is for another version of the file.
+    """
+    state = {
+        "size": size,
+        "validator": validator,
+        "chunk_size": chunk_size,
+        "done": [],
+    }
+    try:
+        with open(path + STATE_SUFFIX) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return state
+    if all(saved.get(key) == state[key] for key in ("size", "validator", "chunk_size")):
+        state["done"] = [index for index in saved.get("done", []) if index >= 0]
+    return state
+
+
+def write_state(path, state):
+    """Save the state of a partial download, replacing the previous one
+    atomically.
+    """
+    tmp_path = path + STATE_SUFFIX + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path + STATE_SUFFIX)
+
+
+def verify(path, size=None):
+    """Check that a downloaded package has the expected size, if known, and
+    can be read as an archive.
+
+    :raises DownloadError: if it doesn't
+    """
+    actual = os.path.getsize(path)
+    if size is not None and actual != size:
+        raise DownloadError(f"{path} has {actual} bytes instead of {size}")
+    try:
+        archive.open_archive(path).members()
+    except (archive.ArchiveError, OSError) as err:
+        raise DownloadError(f"{path} is not a readable archive: {err}")
@@ -0,0 +1,201 @@
+"""
+AIP METS index
+
+Reads what the DIP creation needs to know about the files of an AIP from its
+METS file in a single pass over the document. The file is parsed as a stream
+of events and the elements are dropped once read, so memory use does not grow
+with the size of the METS file: the amdSecs, which come first, are reduced to
+a small summary by ID and joined to the files of the fileSec as they are read.
+"""
+import collections
+import copy
+
+import lxml.etree
+import metsrw
+
+NAMESPACES = metsrw.utils.NAMESPACES
+PREMIS_NAMESPACES = {
+    version["namespaces"]["premis"]
+    for version in metsrw.plugins.premisrw.utils.PREMIS_VERSIONS_MAP.values()
+}
+
+FileRecord = collections.namedtuple(
+    "FileRecord", "uuid path use amdsec techmd_type original_name lastmodified"
+)
+FileRecord.__doc__ = """File of the fileSec of an AIP METS file.
+
+``path`` is relative to the AIP data folder and ``use`` is the USE of its
+fileGrp. ``amdsec`` is the ID of its first amdSec and ``techmd_type`` the
+MDTYPE of the last techMD in it, or None if they are missing. The PREMIS
+``original_name`` and the FITS ``lastmodified`` date, in seconds, are None if
+they are not found.
+"""
+
+TechMD = collections.namedtuple("TechMD", "mdtype original_name lastmodified")
+
+METSHDR = f"{{{NAMESPACES['mets']}}}metsHdr"
+DMDSEC = f"{{{NAMESPACES['mets']}}}dmdSec"
+AMDSEC = f"{{{NAMESPACES['mets']}}}amdSec"
+FILESEC = f"{{{NAMESPACES['mets']}}}fileSec"
+STRUCTMAP = f"{{{NAMESPACES['mets']}}}structMap"
+FILEGRP = f"{{{NAMESPACES['mets']}}}fileGrp"
+FILE = f"{{{NAMESPACES['mets']}}}file"
+DIV = f"{{{NAMESPACES['mets']}}}div"
+
+
+def iter_mets(source):
+    """Yield the FileRecord tuples of the files in a METS file, in the
+    fileSec order, streaming the file.
+
+    :param source: path or binary file object of the METS file
+    """
+    techmds = {}
+    uses = []
+    for event, element in lxml.etree.iterparse(source, events=("start", "end")):
+        if element.tag == FILEGRP:
+            if event == "start":
+                uses.append(element.get("USE"))
+            else:
+                uses.pop()
+        if event == "start":
+            continue
+        if element.tag == AMDSEC:
+            techmds[element.get("ID")] = read_techmd(element)
+        elif element.tag == FILE:
+            yield read_file(element, uses[-1] if uses else None, techmds)
+        elif element.tag != DIV and not _is_top_level(element):
+            # Keep the content of the amdSec or file being read
+            continue
+        _clear(element)
+
+
+def index_mets(source):
+    """Return a dict of the FileRecord tuples of the files in a METS file,
+    by file UUID, in the fileSec order.
+
+    :param source: path or binary file object of the METS file
+    """
+    return {record.uuid: record for record in iter_mets(source)}
+
+
+def read_directory_divs(source, labels):
+    """Return a copy of the metsHdr element and the attributes of the divs
+    of the physical structMap along a path of directory labels from its root,
+    e.g. (AIP folder name, "objects"), streaming the METS file.
+
+    :param source: path or binary file object of the METS file
+    :returns: metsHdr element, or None if there is none, and list of dicts of
+              the div attributes, one per label found
+    """
+    header = None
+    divs = []
+    # Depth of the current div in the physical structMap, None outside of it
+    depth = None
+    for event, element in lxml.etree.iterparse(source, events=("start", "end")):
+        if event == "start":
+            if element.tag == STRUCTMAP and element.get("TYPE") == "physical":
+                depth = 0
+            elif element.tag == DIV and depth is not None:
+                depth += 1
+                if (
+                    depth == len(divs) + 1
+                    and depth <= len(labels)
+                    and element.get("LABEL") == labels[depth - 1]
+                ):
+                    divs.append(dict(element.attrib))
+            continue
+        if element.tag == METSHDR:
+            header = copy.deepcopy(element)
+        elif element.tag == DIV and depth is not None:
+            depth -= 1
+        elif element.tag == STRUCTMAP and depth is not None:
+            break
+        if element.tag == DIV or _is_top_level(element):
+            _clear(element)
+    return header, divs
+
+
+def iter_sections(source, ids):
+    """Yield copies of the dmdSec and amdSec elements of a METS file with
+    the given IDs, streaming the file until the fileSec.
+
+    :param source: path or binary file object of the METS file
+    :param ids: set of dmdSec and amdSec IDs
+    """
+    for event, element in lxml.etree.iterparse(source, events=("start", "end")):
+        if element.tag in (FILESEC, STRUCTMAP):
+            break
+        if event == "start":
+            continue
+        if element.tag in (DMDSEC, AMDSEC) and element.get("ID") in ids:
+            yield copy.deepcopy(element)
+        if _is_top_level(element):
+            _clear(element)
+
+
+def _is_top_level(element):
+    """Return whether an element is a child of the root element."""
+    parent = element.getparent()
+    return parent is not None and parent.getparent() is None
+
+
+def _clear(element):
+    """Drop the content of a parsed element and its preceding siblings."""
+    element.clear()
+    parent = element.getparent()
+    if parent is not None:
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+def read_techmd(amdsec):
+    """Return the TechMD tuple of the last techMD of an amdSec element, or
+    None if it has none.
+    """
+    techmds = amdsec.findall("mets:techMD", NAMESPACES)
+    if not techmds:
+        return None
+    mdwrap = techmds[-1].find("mets:mdWrap", NAMESPACES)
+    if mdwrap is None:
+        return TechMD(None, None, None)
+    mdtype = mdwrap.get("MDTYPE")
+    premis_object = None
+    for child in mdwrap.iterfind("mets:xmlData/*", NAMESPACES):
+        if lxml.etree.QName(child).namespace in PREMIS_NAMESPACES:
+            premis_object = child
+            break
+    if premis_object is None:
+        return TechMD(mdtype, None, None)
+    namespaces = dict(NAMESPACES, premis=lxml.etree.QName(premis_object).namespace)
+    original_name = premis_object.findtext("premis:originalName", namespaces=namespaces)
+    fslastmodified = premis_object.findtext(
+        "premis:objectCharacteristics/premis:objectCharacteristicsExtension/fits:fits/fits:fileinfo/fits:fslastmodified",
+        namespaces=namespaces,
+    )
+    lastmodified = None
+    if fslastmodified:
+        # Convert from miliseconds to seconds
+        lastmodified = int(fslastmodified) // 1000
+    return TechMD(mdtype, original_name or None, lastmodified)
+
+
+def read_file(file_element, use, techmds):
+    """Return the FileRecord of a fileSec file element."""
+    file_id = file_element.get("ID", "")
+    uuid = file_id[len("file-") :] if file_id.startswith("file-") else file_id
+    path = None
+    flocat = file_element.find("mets:FLocat", NAMESPACES)
+    if flocat is not None:
+        path = flocat.get(f"{{{NAMESPACES['xlink']}}}href")
+    amdsec = (file_element.get("ADMID") or "").split()
+    amdsec = amdsec[0] if amdsec else None
+    techmd = techmds.get(amdsec) or TechMD(None, None, None)
+    return FileRecord(
+        uuid,
+        path,
+        use,
+        amdsec,
+        techmd.mdtype,
+        techmd.original_name,
+        techmd.lastmodified,
+    )
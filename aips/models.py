@@ -1,30 +1,150 @@
 from os.path import isfile
 
+from sqlalchemy import Boolean
 from sqlalchemy import Column
 from sqlalchemy import create_engine
+from sqlalchemy import DateTime
+from sqlalchemy import Index
 from sqlalchemy import Integer
 from sqlalchemy import Sequence
 from sqlalchemy import String
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+from transfers import migrations
+
 Base = declarative_base()
 
+# Schema migrations, see transfers.migrations.
+MIGRATIONS = [
+    # 1: Checkpoints of the DIP creation
+    [
+        "ALTER TABLE aip ADD COLUMN stage VARCHAR(20)",
+        "ALTER TABLE aip ADD COLUMN finished BOOLEAN NOT NULL DEFAULT 0",
+        "ALTER TABLE aip ADD COLUMN owner VARCHAR(255)",
+        "ALTER TABLE aip ADD COLUMN updated DATETIME",
+        "ALTER TABLE aip ADD COLUMN aip_file VARCHAR",
+        "ALTER TABLE aip ADD COLUMN checksum VARCHAR(64)",
+        "ALTER TABLE aip ADD COLUMN aip_dir VARCHAR",
+        "ALTER TABLE aip ADD COLUMN dip_path VARCHAR",
+        # The AIPs recorded before were processed in a single step
+        "UPDATE aip SET finished = 1",
+    ],
+    # 2: Time of the last full scan of the catalogue
+    ["ALTER TABLE catalogue_state ADD COLUMN full_scanned DATETIME"],
+]
+
+# Stages of the DIP creation, in order
+STAGES = ("downloaded", "extracted", "built", "uploaded")
+
+# Statuses of the queued AtoM deposits
+DEPOSIT_STATUSES = ("pending", "retry", "deposited", "failed")
+
 
 class Aip(Base):
     __tablename__ = "aip"
     id = Column(Integer, Sequence("user_id_seq"), primary_key=True)
     uuid = Column(String(36), nullable=False, unique=True)
+    # Last stage completed, one of STAGES, and whether the processing of
+    # the AIP ended, successfully or not
+    stage = Column(String(20))
+    finished = Column(Boolean, nullable=False, default=False)
+    # Host and process ID of the job processing the AIP
+    owner = Column(String(255))
+    updated = Column(DateTime)
+    # Outputs of the stages, to resume an interrupted job
+    aip_file = Column(String)
+    checksum = Column(String(64))
+    aip_dir = Column(String)
+    dip_path = Column(String)
+
+    def __repr__(self):
+        return (
+            f"Aip(id={self.id!r}, uuid={self.uuid!r}, stage={self.stage!r}, "
+            f"finished={self.finished!r})"
+        )
+
+
+class CatalogueAip(Base):
+    """AIP listed by the Storage Service, see create_dips_job.sync_catalogue()."""
+
+    __tablename__ = "catalogue_aip"
+    id = Column(Integer, primary_key=True)
+    uuid = Column(String(36), nullable=False, unique=True)
+    current_location = Column(String)
+    origin_pipeline = Column(String)
+    status = Column(String(20))
+    # When the AIP was last listed
+    last_seen = Column(DateTime)
+
+    __table_args__ = (
+        Index("ix_catalogue_aip_location_status", "current_location", "status"),
+    )
+
+    def __repr__(self):
+        return f"CatalogueAip(uuid={self.uuid!r}, status={self.status!r})"
+
+
+class CatalogueState(Base):
+    """Progress of the listing of the AIPs of a Storage Service."""
+
+    __tablename__ = "catalogue_state"
+    id = Column(Integer, primary_key=True)
+    ss_url = Column(String, nullable=False, unique=True)
+    # Number of packages listed, where the next listing starts
+    offset = Column(Integer, nullable=False, default=0)
+    synced = Column(DateTime)
+    # When all the packages were last listed
+    full_scanned = Column(DateTime)
+
+    def __repr__(self):
+        return f"CatalogueState(ss_url={self.ss_url!r}, offset={self.offset!r})"
+
+
+class Deposit(Base):
+    """Deposit request of a DIP sent to AtoM, made in the background, see
+    create_dips_job.DepositQueue.
+    """
+
+    __tablename__ = "deposit"
+    id = Column(Integer, primary_key=True)
+    # UUID of the AIP of the DIP
+    uuid = Column(String(36), nullable=False, unique=True)
+    dip_path = Column(String, nullable=False)
+    atom_slug = Column(String, nullable=False)
+    delete_local_copy = Column(Boolean, nullable=False, default=False)
+    # One of DEPOSIT_STATUSES
+    status = Column(String(20), nullable=False, default="pending")
+    attempts = Column(Integer, nullable=False, default=0)
+    # When the deposit is due, later than its creation for the retries
+    next_attempt = Column(DateTime)
+    last_error = Column(String)
+    # Host and process ID of the job making the deposit
+    owner = Column(String(255))
+    updated = Column(DateTime)
+
+    __table_args__ = (
+        Index("ix_deposit_status_next_attempt", "status", "next_attempt"),
+    )
 
     def __repr__(self):
-        return f"Aip(id={self.id!r}, uuid={self.uuid!r})"
+        return (
+            f"Deposit(uuid={self.uuid!r}, status={self.status!r}, "
+            f"attempts={self.attempts!r})"
+        )
 
 
 def init(databasefile):
     if not isfile(databasefile):
         with open(databasefile, "a"):
             pass
-    engine = create_engine(f"sqlite:///{databasefile}", echo=False)
-    Base.metadata.create_all(engine)
+    # The session is shared by the threads of the staged pipeline, which
+    # serialize its use, see create_dips_job.DB_LOCK
+    engine = create_engine(
+        f"sqlite:///{databasefile}",
+        echo=False,
+        connect_args={"check_same_thread": False},
+    )
+    migrations.create_all(engine, Base.metadata, MIGRATIONS)
     session = sessionmaker(bind=engine)
     return session()
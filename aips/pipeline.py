@@ -0,0 +1,131 @@
+"""
+Staged pipeline
+
+Runs a sequence of stages over a stream of items, each stage in its own pool
+of threads and connected to the next one by a bounded queue, so the stages
+work on different items at the same time, e.g. downloading an AIP while the
+previous one is extracted. When a queue is full the stage feeding it waits,
+which limits the number of items in flight.
+"""
+import collections
+import logging
+import queue
+import shutil
+import threading
+import time
+
+LOGGER = logging.getLogger("dip_workflow")
+
+# Marks the end of the items in a queue
+_DONE = object()
+
+Stage = collections.namedtuple("Stage", "name func workers")
+Stage.__doc__ = """A step of the pipeline.
+
+``func`` is called with an item and returns the item for the next stage, or
+None to drop it, e.g. on error. ``workers`` is the number of threads running
+the stage.
+"""
+
+
+class Pipeline:
+    """Runs items through a sequence of stages."""
+
+    def __init__(self, stages, queue_size=1):
+        """
+        :param list stages: Stage tuples, in order
+        :param int queue_size: number of items waiting between two stages
+        """
+        self.stages = stages
+        self.queue_size = queue_size
+        self._in_flight = 0
+        self._downstream = 0
+        self._lock = threading.Lock()
+
+    @property
+    def in_flight(self):
+        """Number of items taken by the first stage and not done yet."""
+        with self._lock:
+            return self._in_flight
+
+    @property
+    def downstream(self):
+        """Number of items past the first stage and not done yet."""
+        with self._lock:
+            return self._downstream
+
+    def _count(self, delta, downstream=0):
+        with self._lock:
+            self._in_flight += delta
+            self._downstream += downstream
+
+    def run(self, items):
+        """Run the items through the stages and return the number of items
+        that made it through all of them.
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        # Workers of each stage still running
+        remaining = [stage.workers for stage in self.stages]
+        completed = []
+        threads = []
+        for index, stage in enumerate(self.stages):
+            for number in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._work,
+                    args=(index, queues, remaining, completed),
+                    name=f"{stage.name}-{number}",
+                    daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+        for item in items:
+            queues[0].put(item)
+        for _ in range(self.stages[0].workers):
+            queues[0].put(_DONE)
+        for thread in threads:
+            thread.join()
+        return len(completed)
+
+    def _work(self, index, queues, remaining, completed):
+        stage = self.stages[index]
+        last_stage = index + 1 == len(self.stages)
+        while True:
+            item = queues[index].get()
+            if item is _DONE:
+                break
+            if not index:
+                self._count(1)
+            try:
+                result = stage.func(item)
+            except Exception:
+                LOGGER.exception("Error in %s stage", stage.name)
+                result = None
+            if result is None or last_stage:
+                self._count(-1, -1 if index else 0)
+                if result is not None:
+                    completed.append(result)
+            else:
+                if not index:
+                    self._count(0, 1)
+                queues[index + 1].put(result)
+        # The last worker of the stage closes the next one
+        with self._lock:
+            remaining[index] -= 1
+            closing = not remaining[index]
+        if closing and not last_stage:
+            for _ in range(self.stages[index + 1].workers):
+                queues[index + 1].put(_DONE)
+
+
+def wait_for_space(path, min_free_space, pipeline, interval=10):
+    """Wait until the filesystem of path has min_free_space bytes free.
+
+    Gives up waiting when no item is past the first stage of the pipeline, as
+    only those would free space, the others waiting in the first stage too.
+    """
+    while shutil.disk_usage(path).free < min_free_space:
+        if not pipeline.downstream:
+            LOGGER.warning("Less than %s bytes free in %s", min_free_space, path)
+            return
+        LOGGER.info("Waiting for free space in %s", path)
+        time.sleep(interval)
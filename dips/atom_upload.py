@@ -2,16 +2,25 @@
 """
 Uploads a DIP to AtoM
 
-Sends the DIP to the AtoM host using rsync and executes a deposit request to the
-AtoM instance. A passwordless SSH connection is required to the AtoM host for the
-user running this script and it must be already added to the list of known hosts.
+Sends the DIP to the AtoM host and executes a deposit request to the AtoM
+instance. The DIP is sent with rsync by default, or with sftp or a copy to a
+mounted folder, which can send several files of the DIP at the same time.
+Sending a DIP with rsync or sftp requires a passwordless SSH connection to the
+AtoM host for the user running this script and it must be already added to the
+list of known hosts.
 """
 import argparse
+import collections
+import concurrent.futures
 import logging.config  # Has to be imported separately
 import os
+import posixpath
 import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
 import requests
 
@@ -19,6 +28,15 @@ import requests
 THIS_DIR = os.path.abspath(os.path.dirname(__file__))
 LOGGER = logging.getLogger("dip_workflow")
 
+# Ways of sending the DIP folder to the AtoM host
+BACKENDS = ("rsync", "sftp", "local")
+
+# Seconds between two progress messages of a transfer
+PROGRESS_INTERVAL = 10
+
+# Size of the chunks copied by the local backend
+CHUNK_SIZE = 1024 * 1024
+
 
 def setup_logger(log_file, log_level="INFO"):
     """Configures the logger to output to console and log file"""
@@ -60,18 +78,32 @@ def main(
     rsync_target,
     dip_path,
     delete_local_copy,
+    upload_backend="rsync",
+    upload_streams=1,
+    bwlimit=None,
+    deposit_dip=True,
 ):
-    """Sends the DIP to the AtoM host and a deposit request to the AtoM instance"""
+    """Sends the DIP to the AtoM host and a deposit request to the AtoM instance.
+
+    With deposit_dip False, only the DIP folder is sent, leaving the deposit
+    request and the removal of the local copy to the caller.
+    """
     LOGGER.info("Starting DIP upload to AtoM from: %s", dip_path)
 
     try:
-        rsync(rsync_target, dip_path)
+        send_dip(upload_backend, rsync_target, dip_path, upload_streams, bwlimit)
     except subprocess.CalledProcessError as e:
-        LOGGER.error("Rsync ended unexpectedly: %s", e.output)
+        LOGGER.error("%s ended unexpectedly: %s", upload_backend, e.output)
+        return 1
+    except OSError as e:
+        LOGGER.error("Could not send the DIP folder: %s", e)
         return 1
 
     LOGGER.info("DIP folder sent to: %s", rsync_target)
 
+    if not deposit_dip:
+        return None
+
     try:
         deposit(atom_url, atom_email, atom_password, atom_slug, dip_path)
     except Exception as e:
@@ -88,12 +120,35 @@ def main(
             LOGGER.warning("DIP removal failed: %s", e)
 
 
-def rsync(rsync_target, dip_path):
+def send_dip(backend, target, dip_path, streams=1, bwlimit=None):
+    """
+    Send the DIP folder to the AtoM host.
+
+    :param str backend: one of BACKENDS
+    :param str target: HOST:PATH of the parent folder of the DIP in the AtoM
+                       host, or PATH of a mounted folder for the local backend
+    :param str dip_path: absolute path to the DIP folder
+    :param int streams: number of files sent at the same time, ignored by rsync
+    :param int bwlimit: bandwidth limit in KB/s, shared by the streams
+    :raises subprocess.CalledProcessError: if rsync or sftp fail
+    :raises OSError: if the local copy fails
+    :returns: None
+    """
+    if backend == "sftp":
+        sftp(target, dip_path, streams, bwlimit)
+    elif backend == "local":
+        local_copy(target, dip_path, streams, bwlimit)
+    else:
+        rsync(target, dip_path, bwlimit)
+
+
+def rsync(rsync_target, dip_path, bwlimit=None):
     """
     Build and launch rsync command.
 
     :param str rsync_target: host and path target for rsync
     :param str dip_path: absolute path to the folder to rsync
+    :param int bwlimit: bandwidth limit in KB/s
     :returns: None
     """
     command = [
@@ -102,10 +157,267 @@ def rsync(rsync_target, dip_path):
         "-rltz",
         "-P",
         "--chmod=ugo=rwX",
-        dip_path,
-        rsync_target,
     ]
-    subprocess.check_output(command, stderr=subprocess.STDOUT)
+    if bwlimit:
+        command.append(f"--bwlimit={bwlimit:d}")
+    command.extend([dip_path, rsync_target])
+    run_command(command)
+
+
+def run_command(command, on_line=None):
+    """
+    Run a command logging its output as it is written.
+
+    By default, the progress lines (with a percentage) are logged every
+    PROGRESS_INTERVAL seconds and the other lines are logged as debug output.
+
+    :param list command: command and arguments
+    :param on_line: function called with each line of the output instead
+    :raises subprocess.CalledProcessError: if the command fails, with the last
+                                           lines of its output
+    :returns: None
+    """
+    output = collections.deque(maxlen=20)
+    last_progress = 0
+    # The universal newlines mode splits the progress lines rewritten with \r
+    with subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
+    ) as process:
+        for line in process.stdout:
+            line = line.strip()
+            if not line:
+                continue
+            output.append(line)
+            if on_line:
+                on_line(line)
+            elif "%" not in line:
+                LOGGER.debug("%s: %s", command[0], line)
+            elif time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                LOGGER.info("%s: %s", command[0], line)
+    if process.returncode:
+        raise subprocess.CalledProcessError(
+            process.returncode, command, output="\n".join(output)
+        )
+
+
+def sftp(target, dip_path, streams=1, bwlimit=None):
+    """
+    Send the DIP folder with sftp, splitting its files between concurrent
+    sftp sessions. Like the rsync backend, the times of the files are kept and
+    they are made readable and writable by everyone.
+
+    :param str target: [USER@]HOST:PATH of the parent folder of the DIP
+    :param str dip_path: absolute path to the DIP folder
+    :param int streams: number of sftp sessions
+    :param int bwlimit: bandwidth limit in KB/s, shared by the sessions
+    :returns: None
+    """
+    host, _, remote_dir = target.partition(":")
+    remote_dip = posixpath.join(remote_dir or ".", os.path.basename(dip_path))
+    directories, files = list_dip(dip_path)
+
+    # The folders are created first, ignoring the ones that exist already
+    commands = []
+    for directory in [""] + directories:
+        path = _sftp_quote(posixpath.join(remote_dip, directory).rstrip("/"))
+        commands.extend([f"-mkdir {path}", f"chmod 777 {path}"])
+    run_sftp(host, commands)
+
+    batches = split_files(files, streams)
+    progress = Progress(len(files), sum(size for _, size in files))
+    limit = None
+    if bwlimit:
+        # sftp limits each session in Kbit/s
+        limit = max(bwlimit * 8 // len(batches), 1)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(batches)) as executor:
+        futures = [
+            executor.submit(
+                _send_batch, host, dip_path, remote_dip, batch, limit, progress
+            )
+            for batch in batches
+        ]
+        for future in futures:
+            future.result()
+
+
+def _send_batch(host, dip_path, remote_dip, batch, limit, progress):
+    """Send a list of files of the DIP in a sftp session."""
+    commands = []
+    for path, _ in batch:
+        local = _sftp_quote(os.path.join(dip_path, *path.split("/")))
+        remote = _sftp_quote(posixpath.join(remote_dip, path))
+        commands.extend([f"put -p {local} {remote}", f"chmod 666 {remote}"])
+    sizes = [size for _, size in batch]
+    puts = []
+
+    # sftp echoes each command of the batch before running it, so a file has
+    # been sent when the next one is put
+    def on_line(line):
+        LOGGER.debug("sftp: %s", line)
+        if line.startswith("sftp> put"):
+            if puts:
+                progress.add(sizes[len(puts) - 1])
+            puts.append(line)
+
+    run_sftp(host, commands, limit, on_line)
+    if puts:
+        progress.add(sizes[len(puts) - 1])
+
+
+def run_sftp(host, commands, limit=None, on_line=None):
+    """Run a batch of sftp commands in a session with host. The batch stops
+    at the first command that fails, unless it starts with "-".
+    """
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".txt") as f:
+        f.write("\n".join(commands) + "\n")
+        f.flush()
+        command = ["sftp", "-b", f.name]
+        if limit:
+            command.extend(["-l", str(limit)])
+        command.append(host)
+        run_command(command, on_line)
+
+
+def _sftp_quote(path):
+    """Quote a path for a sftp batch file."""
+    return '"' + path.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def local_copy(target, dip_path, streams=1, bwlimit=None):
+    """
+    Copy the DIP folder to a mounted folder, copying several files at the
+    same time. Like the rsync backend, the times of the files are kept and
+    they are made readable and writable by everyone.
+
+    :param str target: path of the parent folder of the DIP
+    :param str dip_path: absolute path to the DIP folder
+    :param int streams: number of files copied at the same time
+    :param int bwlimit: bandwidth limit in KB/s, shared by the streams
+    :returns: None
+    """
+    destination = os.path.join(target, os.path.basename(dip_path))
+    directories, files = list_dip(dip_path)
+    for directory in [""] + directories:
+        path = os.path.join(destination, *directory.split("/"))
+        os.makedirs(path, exist_ok=True)
+        os.chmod(path, 0o777)
+    progress = Progress(len(files), sum(size for _, size in files))
+    throttle = Throttle(bwlimit * 1024) if bwlimit else None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=streams) as executor:
+        futures = [
+            executor.submit(
+                _copy_file,
+                os.path.join(dip_path, *path.split("/")),
+                os.path.join(destination, *path.split("/")),
+                throttle,
+            )
+            for path, _ in files
+        ]
+        for future, (_, size) in zip(futures, files):
+            future.result()
+            progress.add(size)
+
+
+def _copy_file(src, dst, throttle=None):
+    """Copy a file in chunks, waiting for the throttle before each one."""
+    with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+        for chunk in iter(lambda: src_file.read(CHUNK_SIZE), b""):
+            if throttle:
+                throttle.wait(len(chunk))
+            dst_file.write(chunk)
+    stat = os.stat(src)
+    os.utime(dst, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.chmod(dst, 0o666)
+
+
+def list_dip(dip_path):
+    """Return the relative paths of the folders of a DIP and the list of
+    (relative path, size) of its files, with forward slashes.
+    """
+    directories = []
+    files = []
+    for dirpath, dirnames, filenames in os.walk(dip_path):
+        relpath = os.path.relpath(dirpath, dip_path).replace(os.sep, "/")
+        relpath = "" if relpath == "." else relpath + "/"
+        dirnames.sort()
+        directories.extend(relpath + name for name in dirnames)
+        for name in sorted(filenames):
+            size = os.path.getsize(os.path.join(dirpath, name))
+            files.append((relpath + name, size))
+    return directories, files
+
+
+def split_files(files, count):
+    """Split a list of (path, size) of files in up to count lists with
+    similar total sizes, always returning at least one list.
+    """
+    batches = [[] for _ in range(max(min(count, len(files)), 1))]
+    totals = [0] * len(batches)
+    for path, size in sorted(files, key=lambda item: item[1], reverse=True):
+        index = totals.index(min(totals))
+        batches[index].append((path, size))
+        totals[index] += size
+    return batches
+
+
+class Progress:
+    """Counts the files of a transfer that have been sent, logging the
+    progress every PROGRESS_INTERVAL seconds and when it is complete.
+    """
+
+    def __init__(self, files, size):
+        self.files = files
+        self.size = size
+        self.sent_files = 0
+        self.sent_size = 0
+        self._last_log = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, size):
+        """Count a file of the given size as sent."""
+        with self._lock:
+            self.sent_files += 1
+            self.sent_size += size
+            now = time.monotonic()
+            if (
+                self.sent_files < self.files
+                and now - self._last_log < PROGRESS_INTERVAL
+            ):
+                return
+            self._last_log = now
+            LOGGER.info(
+                "Sent %s of %s files, %s of %s bytes",
+                self.sent_files,
+                self.files,
+                self.sent_size,
+                self.size,
+            )
+
+
+class Throttle:
+    """Limits the rate of the data sent by the streams of a transfer."""
+
+    def __init__(self, rate):
+        """
+        :param int rate: bytes per second
+        """
+        self.rate = rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self, size):
+        """Wait until size more bytes can be sent."""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + size / self.rate
+        if start > now:
+            time.sleep(start - now)
 
 
 def deposit(atom_url, atom_email, atom_password, atom_slug, dip_path):
@@ -182,7 +494,29 @@ if __name__ == "__main__":
         "--rsync-target",
         metavar="HOST:PATH",
         required=True,
-        help="Destination value passed to Rsync.",
+        help="Destination value passed to Rsync, or to sftp. Path of a mounted "
+        "folder for the local upload backend.",
+    )
+    parser.add_argument(
+        "--upload-backend",
+        choices=BACKENDS,
+        default="rsync",
+        help="How to send the DIP folder to the AtoM host. Default: rsync.",
+    )
+    parser.add_argument(
+        "--upload-streams",
+        metavar="N",
+        type=int,
+        default=1,
+        help="Number of files sent at the same time by the sftp and local "
+        "upload backends. Default: 1.",
+    )
+    parser.add_argument(
+        "--bwlimit",
+        metavar="KBPS",
+        type=int,
+        default=None,
+        help="Bandwidth limit of the DIP upload in KB/s.",
     )
     parser.add_argument(
         "--dip-path",
@@ -239,5 +573,8 @@ if __name__ == "__main__":
             rsync_target=args.rsync_target,
             dip_path=args.dip_path,
             delete_local_copy=args.delete_local_copy,
+            upload_backend=args.upload_backend,
+            upload_streams=args.upload_streams,
+            bwlimit=args.bwlimit,
         )
     )
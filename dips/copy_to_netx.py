@@ -14,6 +14,7 @@ import tempfile
 
 import lxml.etree
 
+from dips import staging
 
 THIS_DIR = os.path.abspath(os.path.dirname(__file__))
 LOGGER = logging.getLogger("copy_to_netx")
@@ -66,7 +67,54 @@ def change_premis_namespace_to_v2(namespaces):
     return namespaces_old_premis
 
 
-def parse_component_id_from_mets(mets_data, namespaces):
+def expand_path(path, namespaces):
+    """Convert an absolute path like "/mets:mets/mets:amdSec" to the list of
+    its element tags, with the namespace prefixes expanded.
+    """
+    tags = []
+    for step in path.strip("/").split("/"):
+        prefix, _, name = step.rpartition(":")
+        tags.append(f"{{{namespaces[prefix]}}}{name}" if prefix else name)
+    return tags
+
+
+def match_path(element, tags):
+    """Return whether the element and its ancestors match a list of tags."""
+    for tag in reversed(tags):
+        if element is None or element.tag != tag:
+            return False
+        element = element.getparent()
+    return element is None
+
+
+def find_text_in_mets(mets_file, path, namespaces_list):
+    """Return the text of the first element found at an absolute path in a
+    METS file, trying each namespaces mapping in order.
+
+    The file is parsed as a stream of events and every element is dropped
+    once read, so huge METS files are never fully loaded in memory.
+    """
+    paths = [expand_path(path, namespaces) for namespaces in namespaces_list]
+    last_tags = {tags[-1] for tags in paths}
+    found = {}
+    for _, element in lxml.etree.iterparse(mets_file, events=("end",)):
+        if element.tag in last_tags:
+            for index, tags in enumerate(paths):
+                if index not in found and match_path(element, tags):
+                    found[index] = element.text
+            if 0 in found:
+                break
+        element.clear()
+        parent = element.getparent()
+        if parent is not None:
+            while element.getprevious() is not None:
+                del parent[0]
+    for index in range(len(paths)):
+        if index in found:
+            return found[index]
+
+
+def parse_component_id_from_mets(mets_file, namespaces):
     """Parse component ID from METS file
 
     If a netx.json file is added to the metadata folder of a transfer, in the
@@ -77,21 +125,15 @@ def parse_component_id_from_mets(mets_data, namespaces):
     """
     path_to_component_id = "/mets:mets/mets:amdSec/mets:techMD/mets:mdWrap/mets:xmlData/premis:object/premis:objectCharacteristics/premis:objectCharacteristicsExtension/fits:fits/fits:toolOutput/fits:tool/exiftool/Componentidentifier"
 
-    identifier = mets_data.xpath(path_to_component_id, namespaces=namespaces)
-
-    if len(identifier):
-        return identifier[0].text
-
-    # Try again using V2 PREMIS namespace
-    identifier = mets_data.xpath(
-        path_to_component_id, namespaces=change_premis_namespace_to_v2(namespaces)
+    # Fall back to the V2 PREMIS namespace
+    return find_text_in_mets(
+        mets_file,
+        path_to_component_id,
+        [namespaces, change_premis_namespace_to_v2(namespaces)],
     )
 
-    if len(identifier):
-        return identifier[0].text
-
 
-def parse_object_id_from_mets(mets_data, namespaces):
+def parse_object_id_from_mets(mets_file, namespaces):
     """Parse object ID from METS file
 
     If an accession number is specified when starting a transfer then the
@@ -102,19 +144,13 @@ def parse_object_id_from_mets(mets_data, namespaces):
     """
     path_to_accession_number = "/mets:mets/mets:amdSec/mets:techMD/mets:mdWrap/mets:xmlData/premis:object/premis:objectCharacteristics/premis:objectCharacteristicsExtension/fits:fits/fits:toolOutput/fits:tool/exiftool/MetsMetsHdrAltRecordID"
 
-    accession_number = mets_data.xpath(path_to_accession_number, namespaces=namespaces)
-
-    if len(accession_number):
-        return accession_number[0].text
-
-    # Try again, using V2 PREMIS namespace, to find it as parsed from JSON
-    accession_number = mets_data.xpath(
-        path_to_accession_number, namespaces=change_premis_namespace_to_v2(namespaces)
+    # Fall back to the V2 PREMIS namespace, to find it as parsed from JSON
+    return find_text_in_mets(
+        mets_file,
+        path_to_accession_number,
+        [namespaces, change_premis_namespace_to_v2(namespaces)],
     )
 
-    if len(accession_number):
-        return accession_number[0].text
-
 
 def write_csv_and_copy_objects(
     netx_csv_directory, netx_objects_directory, dip_path, object_id, component_id
@@ -182,15 +218,18 @@ def main(
         LOGGER.error("A directory already exists for the DIP in: %s" % upload_dip_dir)
         return 1
 
+    # The local DIP is moved when it would be deleted afterwards anyway
     try:
-        shutil.copytree(dip_path, upload_dip_dir)
+        manifest = staging.stage_dip(dip_path, upload_dip_dir, move=delete_local_copy)
     except (OSError, shutil.Error) as e:
         LOGGER.warning("Could not move DIP to currently processing path: %s", e)
         return 2
+    methods = {entry.method for entry in manifest}
+    LOGGER.debug("DIP staged with: %s", ", ".join(sorted(methods)))
 
     # Attempt to read component and object IDs from metadata if not specified
-    mets_filename = mets_filename_for_dip(dip_path)
-    mets_data = lxml.etree.parse(os.path.join(dip_path, mets_filename))
+    mets_filename = mets_filename_for_dip(upload_dip_dir)
+    mets_file = os.path.join(upload_dip_dir, mets_filename)
 
     namespaces = {
         "mets": "http://www.loc.gov/METS/",
@@ -201,15 +240,19 @@ def main(
     }
 
     if component_id is None:
-        component_id = parse_component_id_from_mets(mets_data, namespaces)
+        component_id = parse_component_id_from_mets(mets_file, namespaces)
         LOGGER.info("Parsed component ID '%s' from METS" % component_id)
 
     if object_id is None:
-        object_id = parse_object_id_from_mets(mets_data, namespaces)
+        object_id = parse_object_id_from_mets(mets_file, namespaces)
         LOGGER.info("Parsed object ID '%s' from METS" % object_id)
 
     write_csv_and_copy_objects(
-        netx_csv_directory, netx_objects_directory, dip_path, object_id, component_id
+        netx_csv_directory,
+        netx_objects_directory,
+        upload_dip_dir,
+        object_id,
+        component_id,
     )
 
     # Finally remove the DIP from the currently processing location
@@ -219,8 +262,8 @@ def main(
     except (OSError, shutil.Error) as e:
         LOGGER.warning("Duplicates removal failed: %s", e)
 
-    # And remove the local copy if requested
-    if delete_local_copy:
+    # And remove the local copy if requested and it was not moved
+    if delete_local_copy and staging.RENAME not in methods:
         LOGGER.info("Deleting local DIP.")
         try:
             shutil.rmtree(dip_path)
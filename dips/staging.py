@@ -0,0 +1,129 @@
+"""
+DIP staging
+
+Places a DIP folder in a directory where it is picked up from, e.g. the
+pipeline's currently processing location, without copying its bytes when it
+can be avoided. The folder is renamed when the local DIP is not kept, and
+otherwise its files are hardlinked, or reflinked on filesystems that support
+it, falling back to a full copy when the target is on another filesystem,
+see transfers/fileutils.py.
+
+Staging returns a manifest of the staged files, built while they are placed,
+with their sizes and optionally their checksums, so the DIP does not have to
+be walked again to describe or verify it.
+"""
+import collections
+import logging
+import os
+import shutil
+
+from transfers import fileutils
+from transfers.fileutils import COPY
+from transfers.fileutils import HARDLINK
+from transfers.fileutils import REFLINK
+
+LOGGER = logging.getLogger("dip_workflow")
+
+RENAME = "rename"
+
+ManifestEntry = collections.namedtuple("ManifestEntry", "path size method checksum")
+ManifestEntry.__doc__ = """File of a staged DIP.
+
+``path`` is relative to the DIP folder, with forward slashes, ``size`` is in
+bytes and ``method`` is how the file was staged: RENAME, HARDLINK, REFLINK or
+COPY. ``checksum`` is the hex digest of the file, or None if no algorithm was
+requested.
+"""
+
+
+def stage_dip(src, dst, move=False, algorithm=None):
+    """Place the DIP folder src at dst, which must not exist.
+
+    :param bool move: rename src, which will not exist afterwards, when both
+                      paths are in the same filesystem
+    :param str algorithm: hashlib algorithm to checksum the files with, e.g.
+                          "sha256", or None to skip the checksums
+    :returns: list of ManifestEntry tuples of the staged files
+    :raises OSError: if the DIP could not be staged, in which case the partial
+                     staged folder is removed
+    """
+    manifest = []
+    if move:
+        try:
+            os.rename(src, dst)
+        except OSError as err:
+            if os.path.exists(dst) or err.errno not in fileutils.UNSUPPORTED_ERRNOS:
+                raise
+            LOGGER.debug("Could not rename %s to %s: %s", src, dst, err)
+        else:
+            _list_tree(dst, "", algorithm, manifest)
+            return manifest
+    methods = [COPY]
+    parent = os.path.dirname(os.path.abspath(dst))
+    if os.stat(src).st_dev == os.stat(parent).st_dev:
+        methods[:0] = [HARDLINK, REFLINK]
+    try:
+        _stage_tree(src, dst, "", methods, algorithm, manifest)
+    except BaseException:
+        shutil.rmtree(dst, ignore_errors=True)
+        raise
+    return manifest
+
+
+def _stage_tree(src, dst, relpath, methods, algorithm, manifest):
+    """Recreate the src tree in dst, adding its files to the manifest.
+    methods is the list of the file methods to try in order, from which the
+    unsupported ones are removed.
+    """
+    os.mkdir(dst)
+    with os.scandir(src) as entries:
+        for entry in entries:
+            target = os.path.join(dst, entry.name)
+            path = relpath + entry.name
+            if entry.is_dir():
+                _stage_tree(
+                    entry.path, target, path + "/", methods, algorithm, manifest
+                )
+                continue
+            size = entry.stat().st_size
+            method, checksum = fileutils.stage_file(
+                entry.path, target, methods, algorithm
+            )
+            manifest.append(ManifestEntry(path, size, method, checksum))
+    shutil.copystat(src, dst)
+
+
+def _list_tree(directory, relpath, algorithm, manifest):
+    """Add the files of a renamed DIP folder to the manifest."""
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            path = relpath + entry.name
+            if entry.is_dir():
+                _list_tree(entry.path, path + "/", algorithm, manifest)
+                continue
+            checksum = (
+                fileutils.file_checksum(entry.path, algorithm) if algorithm else None
+            )
+            manifest.append(ManifestEntry(path, entry.stat().st_size, RENAME, checksum))
+
+
+def verify_manifest(directory, manifest, algorithm=None):
+    """Check the files of a staged DIP against its manifest.
+
+    :param str algorithm: algorithm of the checksums of the manifest, which
+                          are only checked if given
+    :returns: list of the paths of the manifest missing from directory or not
+              matching their size or checksum
+    """
+    failed = []
+    for entry in manifest:
+        path = os.path.join(directory, *entry.path.split("/"))
+        try:
+            matches = os.path.getsize(path) == entry.size
+            if matches and algorithm and entry.checksum:
+                matches = fileutils.file_checksum(path, algorithm) == entry.checksum
+        except OSError:
+            matches = False
+        if not matches:
+            failed.append(entry.path)
+    return failed
@@ -9,6 +9,7 @@ Storage Service to process that DIP and create a relationship with the
 AIP from where it was created.
 """
 import argparse
+import datetime
 import logging.config  # Has to be imported separately
 import os
 import shutil
@@ -16,6 +17,10 @@ import sys
 import uuid
 
 import requests
+from metsrw.plugins import premisrw
+
+from dips import staging
+from transfers import utils
 
 
 THIS_DIR = os.path.abspath(os.path.dirname(__file__))
@@ -54,6 +59,38 @@ def setup_logger(log_file, log_level="INFO"):
     logging.config.dictConfig(CONFIG)
 
 
+def message_digest_events(manifest, algorithm):
+    """Return the PREMIS message digest calculation events of the files of a
+    staging manifest with a checksum, as premisrw data.
+    """
+    event_date_time = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    return [
+        (
+            "event",
+            premisrw.PREMIS_META,
+            (
+                "event_identifier",
+                ("event_identifier_type", "UUID"),
+                ("event_identifier_value", str(uuid.uuid4())),
+            ),
+            ("event_type", "message digest calculation"),
+            ("event_date_time", event_date_time),
+            ("event_detail", f'program="python"; module="hashlib.{algorithm}()"'),
+            (
+                "event_outcome_information",
+                ("event_outcome_detail", ("event_outcome_detail_note", entry.checksum)),
+            ),
+            (
+                "linking_object_identifier",
+                ("linking_object_identifier_type", "path"),
+                ("linking_object_identifier_value", entry.path),
+            ),
+        )
+        for entry in manifest
+        if entry.checksum
+    ]
+
+
 def main(
     ss_url,
     ss_user,
@@ -65,6 +102,7 @@ def main(
     dip_path,
     aip_uuid,
     delete_local_copy,
+    checksum_algorithm=None,
 ):
     # Move DIP to the currently processing location path, do not use any of the
     # existing watched directories as that may trigger other workflows.
@@ -81,18 +119,37 @@ def main(
         LOGGER.error("A directory already exists for the DIP in: %s" % upload_dip_dir)
         return 1
 
+    # The local DIP is moved when it would be deleted afterwards anyway
     try:
-        shutil.copytree(dip_path, upload_dip_dir)
+        manifest = staging.stage_dip(
+            dip_path,
+            upload_dip_dir,
+            move=delete_local_copy,
+            algorithm=checksum_algorithm,
+        )
     except (OSError, shutil.Error) as e:
         LOGGER.warning("Could not move DIP to currently processing path: %s", e)
         return 2
+    methods = {entry.method for entry in manifest}
+    LOGGER.debug("DIP staged with: %s", ", ".join(sorted(methods)))
+
+    # Verify the files that were copied, the others share their data with the
+    # local DIP
+    if checksum_algorithm:
+        copied = [entry for entry in manifest if entry.method == staging.COPY]
+        failed = staging.verify_manifest(upload_dip_dir, copied, checksum_algorithm)
+        if failed:
+            LOGGER.error(
+                "Files of the staged DIP do not match the local DIP: %s",
+                ", ".join(failed),
+            )
+            try:
+                shutil.rmtree(upload_dip_dir)
+            except (OSError, shutil.Error) as e:
+                LOGGER.warning("Duplicates removal failed: %s", e)
+            return 2
 
     # Build DIP data for SS request
-    size = 0
-    for dirpath, _, filenames in os.walk(upload_dip_dir):
-        for filename in filenames:
-            file_path = os.path.join(dirpath, filename)
-            size += os.path.getsize(file_path)
     dip_data = {
         "uuid": str(uuid.uuid4()),  # new UUID
         "origin_pipeline": "/api/v2/pipeline/%s/" % pipeline_uuid,
@@ -102,16 +159,18 @@ def main(
         "current_path": upload_dir_name,
         "package_type": "DIP",
         "aip_subtype": "Archival Information Package",  # same as in AM
-        "size": size,
+        "size": sum(entry.size for entry in manifest),
         "related_package_uuid": aip_uuid,
-        "events": [],
+        "events": message_digest_events(manifest, checksum_algorithm),
         "agents": [],
     }
     # TODO: Move this to amclient.
     LOGGER.info("Storing DIP in Storage Service.")
     url = "%s/api/v2/file/" % ss_url
     headers = {"Authorization": f"ApiKey {ss_user}:{ss_api_key}"}
-    response = requests.post(url, headers=headers, json=dip_data, timeout=86400)
+    response = utils.get_client().post(
+        url, headers=headers, json=dip_data, timeout=86400
+    )
     result = 0
     if response.status_code != requests.codes.created:
         LOGGER.error("Could not store DIP in Storage Service: %s", response.text)
@@ -131,8 +190,8 @@ def main(
     except (OSError, shutil.Error) as e:
         LOGGER.warning("Duplicates removal failed: %s", e)
 
-    # And remove the local copy if requested
-    if delete_local_copy:
+    # And remove the local copy if requested and it was not moved
+    if delete_local_copy and staging.RENAME not in methods:
         LOGGER.info("Deleting local DIP.")
         try:
             shutil.rmtree(dip_path)
@@ -202,6 +261,13 @@ if __name__ == "__main__":
         action="store_true",
         help="Deletes the local DIP after upload.",
     )
+    parser.add_argument(
+        "--checksum-algorithm",
+        choices=["md5", "sha1", "sha256", "sha512"],
+        default=None,
+        help="Checksum the DIP files while staging them, verify the copied "
+        "ones and send the checksums to the Storage Service.",
+    )
 
     # Logging
     parser.add_argument(
@@ -249,5 +315,6 @@ if __name__ == "__main__":
             dip_path=args.dip_path,
             aip_uuid=args.aip_uuid,
             delete_local_copy=args.delete_local_copy,
+            checksum_algorithm=args.checksum_algorithm,
         )
     )
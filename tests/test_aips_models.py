@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 import os
+import sqlite3
 
 import pytest
 
@@ -28,3 +29,22 @@ def test_init_fail():
     """Test that the database can't be created in a wrong path."""
     with pytest.raises(IOError):
         models.init("/this/should/be/a/wrong/path/to.db")
+
+
+def test_init_migrates_aip_table(tmp_path):
+    """Test that the AIPs recorded by older versions are marked as finished."""
+    database_file = (tmp_path / "aips.db").as_posix()
+    with sqlite3.connect(database_file) as connection:
+        connection.execute(
+            "CREATE TABLE aip (id INTEGER NOT NULL, uuid VARCHAR(36) NOT NULL, "
+            "PRIMARY KEY (id), UNIQUE (uuid))"
+        )
+        connection.execute("INSERT INTO aip (uuid) VALUES ('uuid')")
+    connection.close()
+
+    session = models.init(database_file)
+
+    db_aip = session.query(models.Aip).one()
+    assert db_aip.uuid == "uuid"
+    assert db_aip.finished
+    assert db_aip.stage is None
@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import os
 import subprocess
 from unittest import mock
 
@@ -17,16 +18,120 @@ DIP_PATH = "/tmp/fake_DIP"
 
 def test_rsync_fail():
     effect = subprocess.CalledProcessError(1, [])
-    with mock.patch("subprocess.check_output", side_effect=effect):
+    with mock.patch("dips.atom_upload.run_command", side_effect=effect):
         with pytest.raises(subprocess.CalledProcessError):
             atom_upload.rsync(RSYNC_TARGET, DIP_PATH)
 
 
 def test_rsync_success():
-    with mock.patch("subprocess.check_output", return_value=None):
-        ret = atom_upload.rsync(RSYNC_TARGET, DIP_PATH)
+    with mock.patch("dips.atom_upload.run_command", return_value=None) as run:
+        ret = atom_upload.rsync(RSYNC_TARGET, DIP_PATH, bwlimit=500)
 
     assert ret is None
+    command = run.call_args[0][0]
+    assert "--bwlimit=500" in command
+    assert command[-2:] == [DIP_PATH, RSYNC_TARGET]
+
+
+def test_run_command(caplog):
+    """Test that the output of a command is logged as it is written and
+    returned on error.
+    """
+    caplog.set_level("DEBUG", logger="dip_workflow")
+    atom_upload.run_command(["sh", "-c", "printf 'file\\n 50%%\\r100%%\\n'"])
+    assert [record.getMessage() for record in caplog.records] == [
+        "sh: file",
+        "sh: 50%",
+    ]
+
+    with pytest.raises(subprocess.CalledProcessError) as exc_info:
+        atom_upload.run_command(["sh", "-c", "echo failed; exit 3"])
+    assert exc_info.value.returncode == 3
+    assert exc_info.value.output == "failed"
+
+
+@pytest.fixture
+def dip(tmp_path):
+    dip_path = tmp_path / "dip"
+    (dip_path / "objects" / "sub").mkdir(parents=True)
+    (dip_path / "METS.xml").write_text("mets")
+    (dip_path / "objects" / "file.txt").write_text("file")
+    (dip_path / "objects" / "sub" / "large.txt").write_text("large file")
+    return dip_path
+
+
+def test_split_files():
+    files = [("a", 1), ("b", 10), ("c", 5), ("d", 4)]
+    assert atom_upload.split_files(files, 2) == [
+        [("b", 10)],
+        [("c", 5), ("d", 4), ("a", 1)],
+    ]
+    assert atom_upload.split_files(files[:1], 4) == [[("a", 1)]]
+    assert atom_upload.split_files([], 4) == [[]]
+
+
+def test_local_copy(dip, tmp_path):
+    """Test that the DIP folder is copied with its times in several streams."""
+    target = tmp_path / "atom"
+    target.mkdir()
+    os.utime(dip / "METS.xml", (0, 1000))
+    atom_upload.local_copy(str(target), str(dip), streams=2, bwlimit=1024)
+
+    copied = target / "dip"
+    assert sorted(
+        (path.relative_to(copied).as_posix(), path.read_text())
+        for path in copied.rglob("*")
+        if path.is_file()
+    ) == [
+        ("METS.xml", "mets"),
+        ("objects/file.txt", "file"),
+        ("objects/sub/large.txt", "large file"),
+    ]
+    assert (copied / "METS.xml").stat().st_mtime == 1000
+
+
+def test_sftp(dip):
+    """Test that the folders are created first and the files are split in
+    sftp batches by size.
+    """
+    batches = []
+
+    def run_command(command, on_line=None):
+        with open(command[command.index("-b") + 1]) as f:
+            batches.append((command, f.read().splitlines()))
+        if on_line:
+            for line in batches[-1][1]:
+                on_line(f"sftp> {line}")
+
+    with mock.patch("dips.atom_upload.run_command", side_effect=run_command):
+        atom_upload.sftp("user@host:/tmp/atom", str(dip), streams=2, bwlimit=100)
+
+    command, mkdirs = batches[0]
+    assert command[-1] == "user@host"
+    assert "-l" not in command
+    assert mkdirs == [
+        '-mkdir "/tmp/atom/dip"',
+        'chmod 777 "/tmp/atom/dip"',
+        '-mkdir "/tmp/atom/dip/objects"',
+        'chmod 777 "/tmp/atom/dip/objects"',
+        '-mkdir "/tmp/atom/dip/objects/sub"',
+        'chmod 777 "/tmp/atom/dip/objects/sub"',
+    ]
+    puts = sorted(batch for _, batch in batches[1:])
+    assert puts == [
+        [
+            f'put -p "{dip}/METS.xml" "/tmp/atom/dip/METS.xml"',
+            'chmod 666 "/tmp/atom/dip/METS.xml"',
+            f'put -p "{dip}/objects/file.txt" "/tmp/atom/dip/objects/file.txt"',
+            'chmod 666 "/tmp/atom/dip/objects/file.txt"',
+        ],
+        [
+            f'put -p "{dip}/objects/sub/large.txt" "/tmp/atom/dip/objects/sub/large.txt"',
+            'chmod 666 "/tmp/atom/dip/objects/sub/large.txt"',
+        ],
+    ]
+    # The bandwidth limit in Kbit/s is shared by the sessions
+    assert all(command[command.index("-l") + 1] == "400" for command, _ in batches[1:])
 
 
 @mock.patch(
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+import hashlib
+import os
+from unittest import mock
+
+from aips import cache
+from aips import create_dip
+from aips import download
+
+AIP_UUID = "3ea465ac-ea0a-4a9c-a057-507e794de332"
+OTHER_UUID = "b5dbd0cc-9f4a-4b9c-8d2a-7c3e0d0a9d2c"
+
+
+def _archive(directory, content, name="aip.7z"):
+    # A new file each time, the cached ones are hardlinks of the archives
+    directory = directory / hashlib.sha256(content).hexdigest()
+    directory.mkdir(exist_ok=True)
+    path = directory / name
+    path.write_bytes(content)
+    return str(path)
+
+
+def test_add_and_fetch(tmp_path):
+    """Test that a cached archive is placed in a workspace and that removing
+    it there keeps it in the cache.
+    """
+    aip_cache = cache.AipCache(str(tmp_path / "cache"))
+    entry = aip_cache.add(AIP_UUID, _archive(tmp_path, b"aip"))
+    assert entry.checksum == hashlib.sha256(b"aip").hexdigest()
+    assert entry.path == str(tmp_path / "cache" / AIP_UUID / entry.checksum / "aip.7z")
+
+    workspace = tmp_path / "workspace"
+    workspace.mkdir()
+    fetched = aip_cache.fetch(AIP_UUID, str(workspace))
+    assert fetched.path == str(workspace / "aip.7z")
+    assert fetched.checksum == entry.checksum
+    os.remove(fetched.path)
+    assert aip_cache.lookup(AIP_UUID).path == entry.path
+    assert aip_cache.fetch(OTHER_UUID, str(workspace)) is None
+    # An archive of another size is of a different version of the AIP
+    assert aip_cache.fetch(AIP_UUID, str(workspace), size=3).checksum == entry.checksum
+    assert aip_cache.fetch(AIP_UUID, str(workspace), size=4) is None
+
+
+def test_add_replaces_older_versions(tmp_path):
+    """Test that adding a new archive of an AIP removes the previous one."""
+    aip_cache = cache.AipCache(str(tmp_path / "cache"))
+    old = aip_cache.add(AIP_UUID, _archive(tmp_path, b"old"))
+    new = aip_cache.add(AIP_UUID, _archive(tmp_path, b"new"), checksum="a" * 64)
+    assert new.checksum == "a" * 64
+    assert aip_cache.entries() == [new]
+    assert not os.path.exists(os.path.dirname(old.path))
+
+
+def test_evict_least_recently_used(tmp_path):
+    """Test that the least recently used archives are evicted to stay within
+    the size of the cache and that archives larger than it are not added.
+    """
+    aip_cache = cache.AipCache(str(tmp_path / "cache"), max_size=10)
+    first = aip_cache.add(AIP_UUID, _archive(tmp_path, b"12345"))
+    second = aip_cache.add(OTHER_UUID, _archive(tmp_path, b"67890"))
+    # Make the second one the least recently used
+    os.utime(os.path.dirname(second.path), (0, 0))
+    third = aip_cache.add("third", _archive(tmp_path, b"abc"))
+    assert [entry.uuid for entry in aip_cache.entries()] == ["third", AIP_UUID]
+    assert third.size == 3 and first.size == 5
+    assert aip_cache.add("large", _archive(tmp_path, b"x" * 11)) is None
+    assert aip_cache.lookup("large") is None
+
+
+def test_invalidate(tmp_path):
+    """Test that the archives of an AIP are removed."""
+    aip_cache = cache.AipCache(str(tmp_path / "cache"))
+    aip_cache.add(AIP_UUID, _archive(tmp_path, b"aip"))
+    aip_cache.invalidate(AIP_UUID)
+    assert aip_cache.lookup(AIP_UUID) is None
+    aip_cache.invalidate(AIP_UUID)
+
+
+@mock.patch("aips.create_dip.download.package_size", return_value=3)
+@mock.patch("aips.create_dip.download.download_package")
+def test_download_aip_cached(download_package, package_size, tmp_path):
+    """Test that an AIP is downloaded only once with a cache, and again when
+    its size in the Storage Service changes.
+    """
+    aip_cache = cache.AipCache(str(tmp_path / "cache"))
+    tmp_dir = tmp_path / "tmp"
+    tmp_dir.mkdir()
+
+    content = b"aip"
+
+    def fake_download(ss_url, ss_user, ss_api_key, uuid, directory, **kwargs):
+        path = os.path.join(directory, "aip.7z")
+        with open(path, "wb") as f:
+            f.write(content)
+        return download.Package(path, hashlib.sha256(content).hexdigest())
+
+    download_package.side_effect = fake_download
+    args = ("ss_url", "user", "key", AIP_UUID, str(tmp_dir), str(tmp_path))
+    workspace, aip_file, checksum = create_dip.download_aip(*args, aip_cache=aip_cache)
+    assert download_package.call_count == 1
+    assert checksum == hashlib.sha256(b"aip").hexdigest()
+    assert aip_cache.lookup(AIP_UUID).checksum == hashlib.sha256(b"aip").hexdigest()
+
+    os.remove(aip_file)
+    workspace, aip_file, checksum = create_dip.download_aip(*args, aip_cache=aip_cache)
+    assert download_package.call_count == 1
+    assert checksum == hashlib.sha256(b"aip").hexdigest()
+    assert aip_file == os.path.join(workspace, "aip.7z")
+    with open(aip_file, "rb") as f:
+        assert f.read() == b"aip"
+
+    # Reingested in the meantime
+    os.remove(aip_file)
+    content = b"reingested"
+    package_size.return_value = len(content)
+    workspace, aip_file, checksum = create_dip.download_aip(*args, aip_cache=aip_cache)
+    assert download_package.call_count == 2
+    assert checksum == hashlib.sha256(content).hexdigest()
+    assert aip_cache.lookup(AIP_UUID).checksum == checksum
@@ -1,13 +1,17 @@
 #!/usr/bin/env python
 import os
+import shutil
 import time
 import zipfile
 from pathlib import Path
 from unittest import mock
 
 import amclient
+import metsrw
+import pytest
 import requests
 
+from aips import archive
 from aips import create_dip
 
 
@@ -188,3 +192,198 @@ def test_get_original_relpath_warn_invalid_prefix():
     path = "%transferDirectory%datas/folder1/file5.txt"
 
     assert create_dip.get_original_relpath(path) is None
+
+
+@pytest.mark.parametrize(
+    "fixture, aip_uuid, original, preservation",
+    [
+        (
+            "aip.7z",
+            AIP_UUID,
+            "transfer-216dd8a6-c366-41f8-b11e-0c70814b3992/data/objects/file.txt",
+            "transfer-216dd8a6-c366-41f8-b11e-0c70814b3992/data/thumbnails",
+        ),
+        (
+            "aip.tar",
+            "3ea465ac-ea0a-4a9c-a057-507e794de332",
+            "test_B-3ea465ac-ea0a-4a9c-a057-507e794de332/data/objects/"
+            "digital_object_component_4/lion.svg",
+            "test_B-3ea465ac-ea0a-4a9c-a057-507e794de332/data/objects/"
+            "digital_object_component_4/lion-17bb652c-fefa-460c-976d-4ae27e149e4b.svg",
+        ),
+    ],
+)
+def test_extract_aip_originals_only(
+    tmp_path, fixture, aip_uuid, original, preservation
+):
+    """Test that only the METS, original files and submissionDocumentation
+    are extracted from 7z and tar AIPs.
+    """
+    aip_path = tmp_path / fixture
+    shutil.copy(AIP_FIXTURE_PATH.parent / fixture, aip_path)
+    aip_dir = create_dip.extract_aip(
+        aip_path.as_posix(), aip_uuid, tmp_path.as_posix(), originals_only=True
+    )
+    assert aip_dir == (tmp_path / original.split("/")[0]).as_posix()
+    assert (tmp_path / original).is_file()
+    assert (Path(aip_dir) / "data" / f"METS.{aip_uuid}.xml").is_file()
+    assert (Path(aip_dir) / "data" / "objects" / "submissionDocumentation").is_dir()
+    assert not (tmp_path / preservation).exists()
+    assert not (Path(aip_dir) / "data" / "logs").exists()
+    assert not aip_path.exists()
+
+
+@mock.patch.dict(os.environ, {"TZ": "UTC"})
+def test_create_dip_stored_zip(tmp_path):
+    """Test that the ZIP file can be written without compression and keeps
+    the last modified dates from the METS file.
+    """
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+    aip_path = tmp_path / "aip.7z"
+    shutil.copy(AIP_FIXTURE_PATH, aip_path)
+    aip_dir = create_dip.extract_aip(aip_path.as_posix(), AIP_UUID, tmp_path.as_posix())
+    dip_dir = create_dip.create_dip(
+        aip_dir,
+        AIP_UUID,
+        output_dir.as_posix(),
+        "storage-service",
+        "zipped-objects",
+        zip_compression="stored",
+    )
+    assert os.listdir(f"{dip_dir}/objects") == [f"{TRANSFER_NAME}.zip"]
+    with zipfile.ZipFile(f"{dip_dir}/objects/{TRANSFER_NAME}.zip") as zip_file:
+        infos = {info.filename: info for info in zip_file.infolist()}
+    assert {info.compress_type for info in infos.values()} == {zipfile.ZIP_STORED}
+    assert f"{TRANSFER_NAME}/METS.{AIP_UUID}.xml" in infos
+    # ZIP files store the seconds with a resolution of 2
+    assert infos[f"{TRANSFER_NAME}/folder1/file5.txt"].date_time == (
+        time.gmtime(1510849550)[:6]
+    )
+    assert os.path.isfile(f"{dip_dir}/METS.{AIP_UUID}.xml")
+
+
+@pytest.mark.parametrize(
+    "fixture, aip_uuid",
+    [("aip.7z", AIP_UUID), ("aip.tar", "3ea465ac-ea0a-4a9c-a057-507e794de332")],
+)
+@pytest.mark.parametrize("mets_type", ["atom", "storage-service"])
+def test_create_dip_from_archive(tmp_path, fixture, aip_uuid, mets_type):
+    """Test that a DIP created straight from the AIP archive has the same ZIP
+    file contents as one created from the extracted AIP.
+    """
+    aip_path = tmp_path / fixture
+    shutil.copy(AIP_FIXTURE_PATH.parent / fixture, aip_path)
+    archive_output = tmp_path / "archive"
+    archive_output.mkdir()
+    archive_dip = create_dip.create_dip_from_archive(
+        aip_path.as_posix(), aip_uuid, archive_output.as_posix(), mets_type
+    )
+
+    extracted_output = tmp_path / "extracted"
+    extracted_output.mkdir()
+    aip_dir = create_dip.extract_aip(aip_path.as_posix(), aip_uuid, tmp_path.as_posix())
+    extracted_dip = create_dip.create_dip(
+        aip_dir, aip_uuid, extracted_output.as_posix(), mets_type, "zipped-objects"
+    )
+
+    assert os.path.basename(archive_dip) == os.path.basename(extracted_dip)
+    assert os.path.isfile(f"{archive_dip}/METS.{aip_uuid}.xml")
+    zip_name = os.listdir(f"{extracted_dip}/objects")[0]
+    contents = []
+    for dip in (archive_dip, extracted_dip):
+        with zipfile.ZipFile(f"{dip}/objects/{zip_name}") as zip_file:
+            contents.append(
+                {
+                    info.filename: (zip_file.read(info), info.date_time)
+                    for info in zip_file.infolist()
+                    if "/submissionDocumentation/" not in info.filename
+                }
+            )
+            assert any(
+                "/submissionDocumentation/" in name for name in zip_file.namelist()
+            )
+    assert contents[0] == contents[1]
+
+
+def test_create_dip_from_archive_fail(tmp_path):
+    """Test that no DIP is created from an archive without METS file."""
+    aip_path = tmp_path / "aip.tar"
+    shutil.copy(AIP_FIXTURE_PATH.parent / "aip.tar", aip_path)
+    dip_dir = create_dip.create_dip_from_archive(
+        aip_path.as_posix(), AIP_UUID, tmp_path.as_posix(), "atom"
+    )
+    assert dip_dir is None
+
+
+def test_create_dip_mets(tmp_path):
+    """Test that the AtoM DIP METS file has the AIP and objects directories,
+    with their dmdSecs, and a single entry for the ZIP file.
+    """
+    aip_uuid = "3ea465ac-ea0a-4a9c-a057-507e794de332"
+    aip_path = tmp_path / "aip.tar"
+    shutil.copy(AIP_FIXTURE_PATH.parent / "aip.tar", aip_path)
+    aip_dir = create_dip.extract_aip(aip_path.as_posix(), aip_uuid, tmp_path.as_posix())
+    dip_mets_file = (tmp_path / "METS.xml").as_posix()
+    create_dip.create_dip_mets(
+        f"{aip_dir}/data/METS.{aip_uuid}.xml",
+        os.path.basename(aip_dir),
+        "test_B",
+        dip_mets_file,
+    )
+
+    mets = metsrw.METSDocument.fromfile(dip_mets_file)
+    assert mets.createdate == "2017-12-12T20:28:28"
+    entries = {fsentry.label: fsentry for fsentry in mets.all_files()}
+    assert set(entries) == {os.path.basename(aip_dir), "objects", "test_B.zip"}
+    [objects_entry] = entries[os.path.basename(aip_dir)].children
+    assert objects_entry.label == "objects"
+    assert [dmdsec.contents.mdtype for dmdsec in objects_entry.dmdsecs] == ["DC"]
+    [zip_entry] = objects_entry.children
+    assert zip_entry.path == "objects/test_B.zip"
+    assert zip_entry.use == "original"
+    assert [fsentry.path for fsentry in mets.all_files() if fsentry.file_uuid] == [
+        "objects/test_B.zip"
+    ]
+
+
+def test_move_original_files(tmp_path):
+    """Test that the original files are moved by several threads and that
+    the files that can't be moved are counted.
+    """
+    data_dir = tmp_path / "data"
+    dip_dir = tmp_path / "dip"
+    original_files = []
+    for number in range(20):
+        path = f"objects/file{number}-uuid.txt"
+        (data_dir / "objects").mkdir(parents=True, exist_ok=True)
+        (data_dir / path).write_text(str(number))
+        original_files.append(
+            create_dip.OriginalFile(path, f"folder{number % 3}/file{number}.txt", None)
+        )
+    original_files.append(
+        create_dip.OriginalFile("objects/missing.txt", "missing.txt", None)
+    )
+
+    failed = create_dip.move_original_files(
+        original_files, data_dir.as_posix(), dip_dir.as_posix(), workers=4
+    )
+
+    assert failed == 1
+    for number in range(20):
+        path = dip_dir / f"folder{number % 3}" / f"file{number}.txt"
+        assert path.read_text() == str(number)
+    assert not list((data_dir / "objects").iterdir())
+
+
+def test_seven_zip_archive_no_names(tmp_path):
+    """Test that nothing is read or extracted from a 7z archive when no
+    member names are given.
+    """
+    aip_archive = archive.SevenZipArchive(
+        (AIP_FIXTURE_PATH.parent / "aip.7z").as_posix()
+    )
+    assert list(aip_archive.iter_files([])) == []
+    assert list(aip_archive.iter_files(["missing"])) == []
+    aip_archive.extract([], tmp_path.as_posix())
+    assert os.listdir(tmp_path) == []
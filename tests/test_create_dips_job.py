@@ -1,5 +1,9 @@
 #!/usr/bin/env python
+import datetime
 import os
+import shutil
+import socket
+import subprocess
 from pathlib import Path
 from unittest import mock
 
@@ -7,7 +11,9 @@ import pytest
 import requests
 from sqlalchemy import exc
 
+from aips import create_dip
 from aips import create_dips_job
+from aips import models
 
 
 SS_URL = "http://192.168.168.192:8000"
@@ -74,10 +80,10 @@ def args(tmp_path):
     }
 
 
-def test_filter_aips():
+def test_catalogue_aips(args):
     """
-    Test that AIPs without 'uuid' or 'current_location'
-    or in a different location are filtered.
+    Test that AIPs without 'uuid' or 'current_location', in a different
+    location or pipeline, or already processed are filtered.
     """
     aips = [
         # Okay
@@ -114,12 +120,102 @@ def test_filter_aips():
             "uuid": "e6409b38-20e9-4739-bb4a-892f2fb300d3",
         },
     ]
-    filtered_aips = create_dips_job.filter_aips(
-        aips, LOCATION_UUID, ORIGIN_PIPELINE_UUID
+    for aip in aips:
+        aip["status"] = "UPLOADED"
+    aips.append(
+        # Processed
+        {
+            "current_location": "/api/v2/location/e9a08ce2-4e8e-4e01-bdea-09d8d8deff8b/",
+            "origin_pipeline": "/api/v2/pipeline/ad174753-6776-47e2-9a12-ac37837e5128/",
+            "status": "UPLOADED",
+            "uuid": "2ec3d6c7-1d39-4c4b-9c3a-08d4f1e0f5a6",
+        },
+    )
+    session = models.init(args["database_file"])
+    session.add(models.Aip(uuid="2ec3d6c7-1d39-4c4b-9c3a-08d4f1e0f5a6", finished=True))
+    session.commit()
+    am_client = mock.Mock(ss_url=SS_URL)
+    am_client.get_package.return_value = {
+        "meta": {"next": None, "total_count": len(aips)},
+        "objects": aips,
+    }
+    assert create_dips_job.sync_catalogue(session, am_client) == len(aips)
+    filtered_aips = create_dips_job.catalogue_aips(
+        session, LOCATION_UUID, ORIGIN_PIPELINE_UUID
     )
     assert filtered_aips == ["0fef53b0-0573-4398-aa4f-ebf04fe711cf"]
 
 
+def test_sync_catalogue_pages(args):
+    """Test that the AIPs are listed a page at a time and that later syncs
+    only list the AIPs created since, unless a full scan is requested.
+    """
+    aips = [
+        {
+            "current_location": f"/api/v2/location/{LOCATION_UUID}/",
+            "status": "UPLOADED" if number % 2 else "DELETED",
+            "uuid": f"00000000-0000-0000-0000-{number:012d}",
+        }
+        for number in range(5)
+    ]
+
+    def get_package(params):
+        offset, limit = params["offset"], params["limit"]
+        return {
+            "meta": {
+                "next": "next" if offset + limit < len(aips) else None,
+                "total_count": len(aips),
+            },
+            "objects": aips[offset : offset + limit],
+        }
+
+    session = models.init(args["database_file"])
+    am_client = mock.Mock(ss_url=SS_URL, get_package=mock.Mock(wraps=get_package))
+    assert create_dips_job.sync_catalogue(session, am_client, page_size=2) == 5
+    assert am_client.get_package.call_count == 3
+    assert create_dips_job.catalogue_aips(session, LOCATION_UUID, None) == [
+        "00000000-0000-0000-0000-000000000001",
+        "00000000-0000-0000-0000-000000000003",
+    ]
+
+    # Only the new AIP is listed
+    aips.append(dict(aips[0], uuid="00000000-0000-0000-0000-000000000005"))
+    aips[0]["status"] = "UPLOADED"
+    am_client.get_package.reset_mock()
+    assert create_dips_job.sync_catalogue(session, am_client, page_size=2) == 1
+    assert am_client.get_package.call_args.args[0]["offset"] == 5
+    assert len(create_dips_job.catalogue_aips(session, LOCATION_UUID, None)) == 2
+
+    # A full scan updates the status of the known AIPs
+    assert create_dips_job.sync_catalogue(session, am_client, full_scan=True) == 6
+    assert len(create_dips_job.catalogue_aips(session, LOCATION_UUID, None)) == 3
+    assert am_client.get_package.call_args.args[0]["order_by"] == "id"
+
+    # Full scans happen when the last one is too old
+    assert create_dips_job.sync_catalogue(session, am_client, full_scan_interval=1) == 0
+    state = session.query(models.CatalogueState).one()
+    state.full_scanned -= datetime.timedelta(hours=2)
+    session.commit()
+    assert create_dips_job.sync_catalogue(session, am_client, full_scan_interval=1) == 6
+
+
+def test_sync_catalogue_unsorted(args):
+    """Test that the AIPs are listed unsorted if the SS can't sort them."""
+
+    def get_package(params):
+        if "order_by" in params:
+            return 400
+        return {
+            "meta": {"next": None, "total_count": 1},
+            "objects": [{"uuid": "00000000-0000-0000-0000-000000000001"}],
+        }
+
+    session = models.init(args["database_file"])
+    am_client = mock.Mock(ss_url=SS_URL, get_package=mock.Mock(wraps=get_package))
+    assert create_dips_job.sync_catalogue(session, am_client) == 1
+    assert am_client.get_package.call_count == 2
+
+
 def test_main_fail_db(args):
     """Test a fail when a database can't be created."""
     args["database_file"] = "/this/should/be/a/wrong/path/to.db"
@@ -128,7 +224,7 @@ def test_main_fail_db(args):
 
 
 @mock.patch(
-    "requests.request",
+    "requests.Session.request",
     side_effect=[mock.Mock(status_code=401, headers={}, spec=requests.Response)],
 )
 def test_main_fail_request(_request, args):
@@ -139,7 +235,7 @@ def test_main_fail_request(_request, args):
 
 
 @mock.patch(
-    "requests.request",
+    "requests.Session.request",
     side_effect=[
         mock.Mock(
             **{
@@ -149,12 +245,12 @@ def test_main_fail_request(_request, args):
                 ),
                 "json.return_value": AIPS_JSON,
             },
-            spec=requests.Response
+            spec=requests.Response,
         )
     ],
 )
 @mock.patch(
-    "requests.get",
+    "requests.Session.get",
     side_effect=[
         mock.Mock(
             **{
@@ -162,7 +258,7 @@ def test_main_fail_request(_request, args):
                 "headers": {},
                 "iter_content.return_value": iter([AIP_CONTENT]),
             },
-            spec=requests.Response
+            spec=requests.Response,
         ),
     ],
 )
@@ -177,7 +273,7 @@ def test_main_success(_get, _request, args):
 
 
 @mock.patch(
-    "requests.request",
+    "requests.Session.request",
     side_effect=[
         mock.Mock(
             **{
@@ -187,12 +283,12 @@ def test_main_success(_get, _request, args):
                 ),
                 "json.return_value": AIPS_JSON,
             },
-            spec=requests.Response
+            spec=requests.Response,
         )
     ],
 )
 @mock.patch(
-    "requests.get",
+    "requests.Session.get",
     side_effect=[
         mock.Mock(
             **{
@@ -200,7 +296,7 @@ def test_main_success(_get, _request, args):
                 "headers": {},
                 "iter_content.return_value": iter([AIP_CONTENT]),
             },
-            spec=requests.Response
+            spec=requests.Response,
         ),
     ],
 )
@@ -220,7 +316,7 @@ def test_main_success_no_dip_creation(_get, _request, args):
 @mock.patch("aips.create_dips_job.atom_upload.main")
 @mock.patch("aips.create_dips_job.create_dip.main", return_value=1)
 @mock.patch(
-    "requests.request",
+    "requests.Session.request",
     side_effect=[
         mock.Mock(
             **{
@@ -230,12 +326,12 @@ def test_main_success_no_dip_creation(_get, _request, args):
                 ),
                 "json.return_value": AIPS_JSON,
             },
-            spec=requests.Response
+            spec=requests.Response,
         )
     ],
 )
 @mock.patch(
-    "requests.get",
+    "requests.Session.get",
     side_effect=[
         mock.Mock(
             **{
@@ -243,7 +339,7 @@ def test_main_success_no_dip_creation(_get, _request, args):
                 "headers": {},
                 "iter_content.return_value": iter([AIP_CONTENT]),
             },
-            spec=requests.Response
+            spec=requests.Response,
         ),
     ],
 )
@@ -257,7 +353,7 @@ def test_main_dip_creation_failed(_get, _request, create_dip, atom_upload, args)
 @mock.patch("aips.create_dips_job.atom_upload.main", return_value=None)
 @mock.patch("aips.create_dips_job.create_dip.main", return_value="fake/path")
 @mock.patch(
-    "requests.request",
+    "requests.Session.request",
     side_effect=[
         mock.Mock(
             **{
@@ -267,12 +363,12 @@ def test_main_dip_creation_failed(_get, _request, create_dip, atom_upload, args)
                 ),
                 "json.return_value": AIPS_JSON,
             },
-            spec=requests.Response
+            spec=requests.Response,
         )
     ],
 )
 @mock.patch(
-    "requests.get",
+    "requests.Session.get",
     side_effect=[
         mock.Mock(
             **{
@@ -280,7 +376,7 @@ def test_main_dip_creation_failed(_get, _request, create_dip, atom_upload, args)
                 "headers": {},
                 "iter_content.return_value": iter([AIP_CONTENT]),
             },
-            spec=requests.Response
+            spec=requests.Response,
         ),
     ],
 )
@@ -304,7 +400,7 @@ def test_main_success_atom_upload_call(_get, _request, create_dip, atom_upload,
 @mock.patch("aips.create_dips_job.storage_service_upload.main", return_value=None)
 @mock.patch("aips.create_dips_job.create_dip.main", return_value="fake/path")
 @mock.patch(
-    "requests.request",
+    "requests.Session.request",
     side_effect=[
         mock.Mock(
             **{
@@ -314,12 +410,12 @@ def test_main_success_atom_upload_call(_get, _request, create_dip, atom_upload,
                 ),
                 "json.return_value": AIPS_JSON,
             },
-            spec=requests.Response
+            spec=requests.Response,
         )
     ],
 )
 @mock.patch(
-    "requests.get",
+    "requests.Session.get",
     side_effect=[
         mock.Mock(
             **{
@@ -327,7 +423,7 @@ def test_main_success_atom_upload_call(_get, _request, create_dip, atom_upload,
                 "headers": {},
                 "iter_content.return_value": iter([AIP_CONTENT]),
             },
-            spec=requests.Response
+            spec=requests.Response,
         ),
     ],
 )
@@ -345,3 +441,290 @@ def test_main_success_ss_upload_call(_get, _request, create_dip, ss_upload, args
     )
     create_dips_job.main(**args)
     assert ss_upload.called
+
+
+@mock.patch("aips.create_dips_job.create_dip.main", return_value=1)
+@mock.patch(
+    "requests.Session.request",
+    side_effect=[
+        mock.Mock(
+            **{
+                "status_code": 200,
+                "headers": requests.structures.CaseInsensitiveDict(
+                    {"Content-Type": "application/json"}
+                ),
+                "json.return_value": {
+                    "meta": AIPS_JSON["meta"],
+                    "objects": [
+                        dict(AIPS_JSON["objects"][0], uuid=uuid)
+                        for uuid in (
+                            "3ea465ac-ea0a-4a9c-a057-507e794de332",
+                            "5ef80ea6-4bb1-4d30-a4fa-2ea5bea1e0c6",
+                            "9b2ab0cf-4d63-4f59-b24b-f1f4d0bcd6d2",
+                        )
+                    ],
+                },
+            },
+            spec=requests.Response,
+        )
+    ],
+)
+def test_main_workers(_request, create_dip, args):
+    """Test that the worker processes claim the AIPs not processed yet."""
+    session = models.init(args["database_file"])
+    session.add(models.Aip(uuid="3ea465ac-ea0a-4a9c-a057-507e794de332"))
+    session.commit()
+    args["workers"] = 2
+    ret = create_dips_job.main(**args)
+    assert ret is None
+    assert {aip.uuid for aip in session.query(models.Aip)} == {
+        "3ea465ac-ea0a-4a9c-a057-507e794de332",
+        "5ef80ea6-4bb1-4d30-a4fa-2ea5bea1e0c6",
+        "9b2ab0cf-4d63-4f59-b24b-f1f4d0bcd6d2",
+    }
+
+
+@mock.patch("aips.create_dips_job.atom_upload.main", return_value=None)
+@mock.patch(
+    "requests.Session.request",
+    side_effect=[
+        mock.Mock(
+            **{
+                "status_code": 200,
+                "headers": requests.structures.CaseInsensitiveDict(
+                    {"Content-Type": "application/json"}
+                ),
+                "json.return_value": AIPS_JSON,
+            },
+            spec=requests.Response,
+        )
+    ],
+)
+@mock.patch(
+    "requests.Session.get",
+    side_effect=[
+        mock.Mock(
+            **{
+                "status_code": 200,
+                "headers": {},
+                "iter_content.return_value": iter([AIP_CONTENT]),
+            },
+            spec=requests.Response,
+        ),
+    ],
+)
+def test_main_staged(_get, _request, atom_upload, args):
+    """Test that a DIP is created and uploaded by the staged pipeline."""
+    args.update({"upload_type": "atom-upload", "staged": True})
+    ret = create_dips_job.main(**args)
+    assert ret is None
+    dip_path = os.path.join(
+        args["output_dir"], "test_B-3ea465ac-ea0a-4a9c-a057-507e794de332"
+    )
+    assert os.path.isdir(dip_path)
+    assert atom_upload.call_args.kwargs["dip_path"] == dip_path
+    assert "3ea465ac-ea0a-4a9c-a057-507e794de332" not in os.listdir(args["tmp_dir"])
+
+
+def _dead_owner():
+    process = subprocess.Popen(["true"])
+    process.wait()
+    return f"{socket.gethostname()}:{process.pid}"
+
+
+def _interrupted_aip(args, checksum=None):
+    """Record an AIP downloaded by a job that was interrupted."""
+    uuid = AIPS_JSON["objects"][0]["uuid"]
+    workspace = Path(args["tmp_dir"]) / uuid
+    workspace.mkdir()
+    aip_file = workspace / "aip.tar"
+    shutil.copy(AIP_FIXTURE_PATH, aip_file)
+    session = models.init(args["database_file"])
+    session.add(
+        models.Aip(
+            uuid=uuid,
+            stage="downloaded",
+            owner=_dead_owner(),
+            updated=datetime.datetime.utcnow(),
+            aip_file=aip_file.as_posix(),
+            checksum=checksum or create_dip.file_checksum(aip_file.as_posix()),
+        )
+    )
+    session.commit()
+    return session
+
+
+@mock.patch(
+    "requests.Session.request",
+    side_effect=[
+        mock.Mock(
+            **{
+                "status_code": 200,
+                "headers": requests.structures.CaseInsensitiveDict(
+                    {"Content-Type": "application/json"}
+                ),
+                "json.return_value": AIPS_JSON,
+            },
+            spec=requests.Response,
+        )
+    ],
+)
+@mock.patch("requests.Session.get")
+def test_main_resume(_get, _request, args):
+    """Test that an AIP left unfinished by an interrupted job is resumed
+    reusing the downloaded archive.
+    """
+    session = _interrupted_aip(args)
+    ret = create_dips_job.main(**args)
+    assert ret is None
+    assert not _get.called
+    dip_path = os.path.join(
+        args["output_dir"], "test_B-3ea465ac-ea0a-4a9c-a057-507e794de332"
+    )
+    assert os.path.isdir(dip_path)
+    db_aip = session.query(models.Aip).one()
+    assert db_aip.stage == "built"
+    assert db_aip.finished
+    assert db_aip.dip_path == dip_path
+
+
+@mock.patch(
+    "requests.Session.request",
+    side_effect=[
+        mock.Mock(
+            **{
+                "status_code": 200,
+                "headers": requests.structures.CaseInsensitiveDict(
+                    {"Content-Type": "application/json"}
+                ),
+                "json.return_value": AIPS_JSON,
+            },
+            spec=requests.Response,
+        )
+    ],
+)
+@mock.patch(
+    "requests.Session.get",
+    side_effect=[
+        mock.Mock(
+            **{
+                "status_code": 200,
+                "headers": {},
+                "iter_content.return_value": iter([AIP_CONTENT]),
+            },
+            spec=requests.Response,
+        ),
+    ],
+)
+def test_main_resume_checksum_mismatch(_get, _request, args):
+    """Test that the AIP is downloaded again if the archive changed."""
+    session = _interrupted_aip(args, checksum="0" * 64)
+    args["staged"] = True
+    create_dips_job.main(**args)
+    assert _get.called
+    db_aip = session.query(models.Aip).one()
+    assert db_aip.stage == "built"
+    assert db_aip.finished
+
+
+def test_claim_aip_running_owner(args):
+    """Test that the unfinished AIPs of running jobs are not taken over,
+    unless they made no progress for resume_after seconds.
+    """
+    session = models.init(args["database_file"])
+    updated = datetime.datetime.utcnow() - datetime.timedelta(seconds=60)
+    session.add(
+        models.Aip(uuid="uuid", owner="otherhost:1", stage=None, updated=updated)
+    )
+    session.commit()
+    assert create_dips_job.claim_aip(session, "uuid") is None
+    assert create_dips_job.claim_aip(session, "uuid", resume_after=3600) is None
+    assert create_dips_job.claim_aip(session, "uuid", resume_after=30) == {
+        "uuid": "uuid",
+        "stage": None,
+        "aip_file": None,
+        "checksum": None,
+        "aip_dir": None,
+        "dip_path": None,
+    }
+    assert session.query(models.Aip).one().owner == create_dips_job.get_owner()
+
+
+def test_deposit_queue(args, tmp_path):
+    """Test that the queued deposits are made in the background, retried
+    when they fail and kept in the database.
+    """
+    session = models.init(args["database_file"])
+    dip_path = tmp_path / "dip"
+    dip_path.mkdir()
+    create_dips_job.enqueue_deposit(session, "uuid-1", str(dip_path), "slug", True)
+    create_dips_job.enqueue_deposit(session, "uuid-2", "/tmp/other", "failing")
+    # A deposit left by a job that is gone
+    create_dips_job.enqueue_deposit(session, "uuid-3", "/tmp/left", "slug")
+    session.query(models.Deposit).filter_by(uuid="uuid-3").update(
+        {"owner": _dead_owner()}
+    )
+    session.commit()
+
+    def deposit(atom_url, atom_email, atom_password, atom_slug, dip_path):
+        if atom_slug == "failing":
+            raise Exception("Response status code not expected")
+
+    queue = create_dips_job.DepositQueue(session, "url", "email", "password", 2)
+    with mock.patch("aips.create_dips_job.atom_upload.deposit", side_effect=deposit):
+        queue.start()
+        queue.close()
+
+    deposits = {deposit.uuid: deposit for deposit in session.query(models.Deposit)}
+    assert deposits["uuid-1"].status == "deposited"
+    assert not dip_path.exists()
+    assert deposits["uuid-3"].status == "deposited"
+    assert deposits["uuid-2"].status == "retry"
+    assert deposits["uuid-2"].attempts == 1
+    assert deposits["uuid-2"].owner is None
+    assert deposits["uuid-2"].last_error == "Response status code not expected"
+    assert deposits["uuid-2"].next_attempt > datetime.datetime.utcnow()
+
+    # The deposit is not due yet, and it fails after the last attempt
+    assert create_dips_job.claim_deposit(session) is None
+    session.query(models.Deposit).filter_by(uuid="uuid-2").update(
+        {"next_attempt": datetime.datetime.utcnow(), "attempts": 4}
+    )
+    session.commit()
+    deposit = create_dips_job.claim_deposit(session)
+    assert deposit["uuid"] == "uuid-2"
+    assert create_dips_job.claim_deposit(session) is None
+    assert create_dips_job.finish_deposit(session, deposit, "error", 5) == "failed"
+
+
+@mock.patch("aips.create_dips_job.atom_upload.deposit")
+@mock.patch("aips.create_dips_job.atom_upload.main", return_value=None)
+@mock.patch("aips.create_dips_job.create_dip.main", return_value="fake/path")
+@mock.patch(
+    "requests.Session.request",
+    side_effect=[
+        mock.Mock(
+            **{
+                "status_code": 200,
+                "headers": requests.structures.CaseInsensitiveDict(
+                    {"Content-Type": "application/json"}
+                ),
+                "json.return_value": AIPS_JSON,
+            },
+            spec=requests.Response,
+        )
+    ],
+)
+def test_main_deposit_queue(_request, create_dip, atom_upload, deposit, args):
+    """Test that the AtoM deposits are queued and made by the job."""
+    args.update(
+        {"upload_type": "atom-upload", "atom_slug": "slug", "deposit_workers": 1}
+    )
+    ret = create_dips_job.main(**args)
+    assert ret is None
+    assert atom_upload.call_args.kwargs["deposit_dip"] is False
+    deposit.assert_called_once_with("", "", "", "slug", "fake/path")
+    session = models.init(args["database_file"])
+    assert [
+        (deposit.uuid, deposit.status) for deposit in session.query(models.Deposit)
+    ] == [("3ea465ac-ea0a-4a9c-a057-507e794de332", "deposited")]
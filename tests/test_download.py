@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+import hashlib
+import http.server
+import re
+import threading
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+from aips import download
+
+AIP_FIXTURE_PATH = Path(__file__).parent.parent / "fixtures" / "aip.tar"
+AIP_UUID = "3ea465ac-ea0a-4a9c-a057-507e794de332"
+CHUNK_SIZE = 4096
+
+
+class PackageHandler(http.server.BaseHTTPRequestHandler):
+    """Stand-in of the Storage Service download endpoint."""
+
+    content = AIP_FIXTURE_PATH.read_bytes()
+    ranges = True
+    # Start of the ranges sent truncated
+    broken = set()
+    requests = []
+
+    def do_GET(self):
+        requested = self.headers.get("Range")
+        self.requests.append(requested)
+        match = re.match(r"bytes=(\d+)-(\d+)", requested or "")
+        self.send_response(206 if match and self.ranges else 200)
+        self.send_header("Content-Disposition", 'attachment; filename="aip.tar"')
+        self.send_header("ETag", '"v1"')
+        if match and self.ranges:
+            start, end = int(match.group(1)), int(match.group(2))
+            end = min(end, len(self.content) - 1)
+            body = self.content[start : end + 1]
+            self.send_header(
+                "Content-Range", f"bytes {start}-{end}/{len(self.content)}"
+            )
+            if start in self.broken:
+                body = body[: len(body) // 2]
+                self.send_header("Content-Length", str(end - start + 1))
+                self.end_headers()
+                self.wfile.write(body)
+                self.close_connection = True
+                return
+        else:
+            body = self.content
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    PackageHandler.ranges = True
+    PackageHandler.broken = set()
+    PackageHandler.requests = []
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), PackageHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _download(server, directory, **kwargs):
+    return download.download_package(
+        server, "user", "key", AIP_UUID, str(directory), chunk_size=CHUNK_SIZE, **kwargs
+    )
+
+
+def test_download_package_ranges(server, tmp_path):
+    """Test that the package is downloaded in chunks."""
+    package = _download(server, tmp_path, streams=3)
+    assert package.path == str(tmp_path / "aip.tar")
+    assert Path(package.path).read_bytes() == PackageHandler.content
+    assert package.checksum == hashlib.sha256(PackageHandler.content).hexdigest()
+    chunks = -(-len(PackageHandler.content) // CHUNK_SIZE)
+    assert len(PackageHandler.requests) == chunks
+    assert all(PackageHandler.requests)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["aip.tar"]
+
+
+@mock.patch("aips.download.RETRY_DELAY", 0)
+def test_download_package_resume(server, tmp_path):
+    """Test that a failed download keeps the chunks downloaded and resumes
+    with the missing ones.
+    """
+    PackageHandler.broken = {CHUNK_SIZE * 2}
+    assert _download(server, tmp_path, streams=2, retries=2) is None
+    assert (tmp_path / "aip.tar.part").exists()
+    assert (tmp_path / "aip.tar.part.json").exists()
+    assert not (tmp_path / "aip.tar").exists()
+
+    PackageHandler.broken = set()
+    PackageHandler.requests = []
+    package = _download(server, tmp_path, streams=2)
+    assert Path(package.path).read_bytes() == PackageHandler.content
+    assert package.checksum == hashlib.sha256(PackageHandler.content).hexdigest()
+    # The first chunk is requested to check the server, then only the
+    # missing one
+    assert PackageHandler.requests == [
+        f"bytes=0-{CHUNK_SIZE - 1}",
+        f"bytes={CHUNK_SIZE * 2}-{CHUNK_SIZE * 3 - 1}",
+    ]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["aip.tar"]
+
+
+def test_download_package_single_stream(server, tmp_path):
+    """Test that the package is downloaded in a single stream from servers
+    that don't support ranges.
+    """
+    PackageHandler.ranges = False
+    package = _download(server, tmp_path, streams=3)
+    assert Path(package.path).read_bytes() == PackageHandler.content
+    assert package.checksum == hashlib.sha256(PackageHandler.content).hexdigest()
+    assert len(PackageHandler.requests) == 1
+
+
+def test_download_package_not_an_archive(server, tmp_path):
+    """Test that a download that can't be read as an archive fails."""
+    with mock.patch.object(PackageHandler, "content", b"not an archive" * 1000):
+        assert _download(server, tmp_path) is None
+
+
+def test_range_hasher(tmp_path):
+    """Test that chunks written in any order are hashed in file order."""
+    path = tmp_path / "file"
+    path.write_bytes(b"abcdefgh")
+    chunks = [(0, 2), (3, 5), (6, 7)]
+    hasher = download.RangeHasher(str(path), chunks, written={1})
+    hasher.written(2)
+    hasher.written(0)
+    assert hasher.hexdigest() == hashlib.sha256(b"abcdefgh").hexdigest()
+
+    hasher = download.RangeHasher(str(path), chunks)
+    hasher.written(1)
+    with pytest.raises(download.DownloadError):
+        hasher.hexdigest()
+
+
+@mock.patch("transfers.utils.AMClient.get_package_details")
+def test_package_size(get_package_details):
+    """Test that the size of a package is read from its details in the SS."""
+    get_package_details.return_value = {"uuid": AIP_UUID, "size": 1024}
+    assert download.package_size("ss_url", "user", "key", AIP_UUID) == 1024
+    get_package_details.return_value = 1
+    assert download.package_size("ss_url", "user", "key", AIP_UUID) is None
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+import io
+import tarfile
+from pathlib import Path
+
+import lxml.etree
+import pytest
+
+from aips import mets_index
+
+AIP_UUID = "3ea465ac-ea0a-4a9c-a057-507e794de332"
+AIP_FIXTURE_PATH = Path(__file__).parent.parent / "fixtures" / "aip.tar"
+METS_NAME = f"test_B-{AIP_UUID}/data/METS.{AIP_UUID}.xml"
+
+
+def test_index_mets():
+    """Test that the files of the fileSec are indexed with the original
+    name and last modified date from their techMD.
+    """
+    with tarfile.open(AIP_FIXTURE_PATH) as tar:
+        records = mets_index.index_mets(tar.extractfile(METS_NAME))
+    assert list(records) == [
+        "cded9deb-de40-465d-89b5-39dd711689e2",
+        "1f74c49a-3c7e-4fa4-ba27-561b88bf16ea",
+        "17bb652c-fefa-460c-976d-4ae27e149e4b",
+        "1832beb4-7719-44cd-825f-f16866c29fa6",
+    ]
+    assert records["cded9deb-de40-465d-89b5-39dd711689e2"] == mets_index.FileRecord(
+        uuid="cded9deb-de40-465d-89b5-39dd711689e2",
+        path="objects/digital_object_component_4/lion.svg",
+        use="original",
+        amdsec="amdSec_2",
+        techmd_type="PREMIS:OBJECT",
+        original_name="%transferDirectory%objects/lion.svg",
+        lastmodified=1513105427,
+    )
+    preservation = records["17bb652c-fefa-460c-976d-4ae27e149e4b"]
+    assert preservation.use == "preservation"
+    assert preservation.lastmodified is None
+
+
+def test_iter_mets_streams_records():
+    """Test that the records are yielded as the METS file is read, before
+    the end of the document.
+    """
+    with tarfile.open(AIP_FIXTURE_PATH) as tar:
+        content = tar.extractfile(METS_NAME).read()
+    # Cut the document after the first file of the fileSec
+    end = content.index(b"</mets:file>") + len(b"</mets:file>")
+    records = mets_index.iter_mets(io.BytesIO(content[:end]))
+    assert next(records).uuid == "cded9deb-de40-465d-89b5-39dd711689e2"
+    with pytest.raises(lxml.etree.XMLSyntaxError):
+        next(records)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+import sqlite3
+
+import pytest
+from sqlalchemy import create_engine
+
+from transfers import migrations
+from transfers import models
+from transfers import reingestmodel
+
+
+def _indexes(database_file):
+    with sqlite3.connect(database_file) as connection:
+        return {
+            row[0]
+            for row in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"
+            )
+        }
+
+
+def test_migrate(tmp_path):
+    """Test that only the migrations newer than the database are applied."""
+    database_file = (tmp_path / "test.db").as_posix()
+    engine = create_engine(f"sqlite:///{database_file}")
+    steps = [
+        ["CREATE TABLE test (id INTEGER)"],
+        ["INSERT INTO test VALUES (1)", "INSERT INTO test VALUES (2)"],
+    ]
+    assert migrations.migrate(engine, steps[:1]) == 1
+    assert migrations.migrate(engine, steps) == 2
+    assert migrations.migrate(engine, steps) == 2
+    with engine.connect() as connection:
+        assert migrations.get_version(connection) == 2
+        rows = connection.exec_driver_sql("SELECT id FROM test").fetchall()
+    assert rows == [(1,), (2,)]
+
+
+def test_migrate_atomic(tmp_path):
+    """Test that a failed migration is rolled back with its version bump and
+    that columns already added are not added again.
+    """
+    database_file = (tmp_path / "test.db").as_posix()
+    engine = create_engine(f"sqlite:///{database_file}")
+    migrations.migrate(engine, [["CREATE TABLE test (id INTEGER)"]])
+    failing = [
+        "ALTER TABLE test ADD COLUMN name VARCHAR",
+        "ALTER TABLE missing ADD COLUMN name VARCHAR",
+    ]
+    with pytest.raises(sqlite3.OperationalError):
+        migrations.migrate(engine, [[], failing])
+    with engine.connect() as connection:
+        assert migrations.get_version(connection) == 1
+        columns = connection.exec_driver_sql("PRAGMA table_info(test)").fetchall()
+    assert [column[1] for column in columns] == ["id"]
+
+    steps = [[], ["ALTER TABLE test ADD COLUMN name VARCHAR"]]
+    with engine.begin() as connection:
+        connection.exec_driver_sql("ALTER TABLE test ADD COLUMN name VARCHAR")
+    assert migrations.migrate(engine, steps) == 2
+
+
+def test_upgrade_transfers_database(tmp_path):
+    """Test that a transfers database created by an older version gets the
+    new indexes and keeps its units.
+    """
+    database_file = (tmp_path / "transfers.db").as_posix()
+    with sqlite3.connect(database_file) as connection:
+        connection.execute(
+            "CREATE TABLE unit (id INTEGER NOT NULL, uuid VARCHAR(36), "
+            "path BLOB, unit_type VARCHAR(10), status VARCHAR(20), "
+            "microservice VARCHAR(50), current BOOLEAN, PRIMARY KEY (id))"
+        )
+        connection.execute(
+            "INSERT INTO unit (uuid, path, unit_type, status, current) "
+            "VALUES ('uuid', X'2f666f6f', 'ingest', 'COMPLETE', 0)"
+        )
+    connection.close()
+    assert not {"ix_unit_path", "ix_unit_current"} & _indexes(database_file)
+
+    models.init_session(database_file)
+
+    assert {
+        "ix_unit_path",
+        "ix_unit_current",
+        "ix_unit_unit_type_uuid",
+    } <= _indexes(database_file)
+    unit = models.retrieve_unit_by_type_and_uuid("uuid", "ingest")
+    assert unit.path == b"/foo"
+    with sqlite3.connect(database_file) as connection:
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+    connection.close()
+    assert version == len(models.MIGRATIONS)
+    models.cleanup_session()
+    models.Session = models.transfer_session = None
+
+
+def test_upgrade_reingest_database(tmp_path):
+    """Test that a reingest database created by an older version gets the
+    columns of the status check schedule.
+    """
+    database_file = (tmp_path / "reingest.db").as_posix()
+    with sqlite3.connect(database_file) as connection:
+        connection.execute(
+            "CREATE TABLE reingests (aip_uuid VARCHAR(36) NOT NULL, "
+            "transfer_uuid VARCHAR(36), status VARCHAR(18), message VARCHAR(200), "
+            "start_time DATETIME, end_time DATETIME, PRIMARY KEY (aip_uuid))"
+        )
+        connection.execute(
+            "INSERT INTO reingests (aip_uuid, status) VALUES ('uuid', 'STATUS_NEW')"
+        )
+        connection.execute("PRAGMA user_version = 1")
+    connection.close()
+
+    reingestmodel.init(database_file)
+
+    session = reingestmodel.Session()
+    item = reingestmodel.get_item_by_aip_uuid(session, "uuid")
+    assert item.checks == 0
+    assert item.next_check is None
+    session.close()
+    with sqlite3.connect(database_file) as connection:
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+    connection.close()
+    assert version == len(reingestmodel.MIGRATIONS)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+import collections
+import threading
+from unittest import mock
+
+from aips import pipeline
+
+
+def test_pipeline_run():
+    """Test that the items go through every stage and that the dropped and
+    failed ones stop.
+    """
+    seen = collections.defaultdict(list)
+
+    def stage(name, func):
+        def run(item):
+            seen[name].append(item)
+            return func(item)
+
+        return run
+
+    def fail(item):
+        if item == 3:
+            raise ValueError()
+        return item
+
+    stages = [
+        pipeline.Stage("double", stage("double", lambda item: item * 2), 2),
+        pipeline.Stage("drop", stage("drop", lambda item: item if item else None), 1),
+        pipeline.Stage("halve", stage("halve", lambda item: item // 2), 3),
+        pipeline.Stage("fail", stage("fail", fail), 1),
+    ]
+    dip_pipeline = pipeline.Pipeline(stages)
+    assert dip_pipeline.run(iter(range(5))) == 3
+    assert sorted(seen["drop"]) == [0, 2, 4, 6, 8]
+    assert sorted(seen["fail"]) == [1, 2, 3, 4]
+    assert dip_pipeline.in_flight == 0
+    assert dip_pipeline.downstream == 0
+
+
+def test_pipeline_overlap():
+    """Test that the stages work on different items at the same time."""
+    second_started = threading.Event()
+
+    def first(item):
+        # The second stage waits on the first item until the first stage
+        # gets to the second one, which times out if the stages don't overlap.
+        if item == 1:
+            second_started.set()
+        return item
+
+    def second(item):
+        if item == 0:
+            assert second_started.wait(5)
+        return item
+
+    stages = [pipeline.Stage("first", first, 1), pipeline.Stage("second", second, 1)]
+    assert pipeline.Pipeline(stages).run(iter(range(3))) == 3
+
+
+@mock.patch("aips.pipeline.time.sleep")
+@mock.patch("aips.pipeline.shutil.disk_usage")
+def test_wait_for_space(disk_usage, sleep):
+    """Test that downloads wait for space while others items are in flight."""
+    disk_usage.side_effect = [mock.Mock(free=10), mock.Mock(free=100)]
+    dip_pipeline = mock.Mock(downstream=1)
+    pipeline.wait_for_space("/tmp", 50, dip_pipeline)
+    assert sleep.call_count == 1
+
+    # Do not wait for space that no other item would free
+    disk_usage.side_effect = None
+    disk_usage.return_value = mock.Mock(free=10)
+    dip_pipeline.downstream = 0
+    pipeline.wait_for_space("/tmp", 50, dip_pipeline)
+    assert sleep.call_count == 1
+
+
+@mock.patch("aips.pipeline.shutil.disk_usage")
+def test_wait_for_space_pipeline(disk_usage):
+    """Test that the items waiting for space to download don't wait on each
+    other when the space is never freed.
+    """
+    disk_usage.return_value = mock.Mock(free=10)
+    waiting = threading.Barrier(2, timeout=5)
+
+    def download(item):
+        if item < 2:
+            # Both download workers wait for space at the same time
+            waiting.wait()
+        pipeline.wait_for_space("/tmp", 50, dip_pipeline, interval=0.01)
+        return item
+
+    stages = [pipeline.Stage("download", download, 2), pipeline.Stage("build", str, 1)]
+    dip_pipeline = pipeline.Pipeline(stages)
+    result = []
+    thread = threading.Thread(
+        target=lambda: result.append(dip_pipeline.run(iter(range(3)))), daemon=True
+    )
+    thread.start()
+    thread.join(5)
+    assert result == [3]
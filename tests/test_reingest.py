@@ -1,11 +1,31 @@
 #!/usr/bin/env python
+import datetime
 import os
+from unittest import mock
 
 import pytest
 
 from transfers import reingest
 from transfers import reingestmodel as reingestunit
 
+AIP_UUIDS = [
+    "54369f6a-aa82-4b29-80c9-834d3625397d",
+    "b18801dd-30ec-46ba-ac6b-4cb561585ac9",
+]
+
+
+def _amclient(completed):
+    """Return a mock AM client where the reingests of the AIPs in completed
+    are done and the others in ingest.
+    """
+    amclient = mock.Mock()
+    amclient.get_transfer_status.return_value = {"status": "COMPLETE"}
+    amclient.get_ingest_status.side_effect = lambda: {
+        "status": "COMPLETE" if amclient.sip_uuid in completed else "PROCESSING"
+    }
+    amclient.get_package_details.return_value = {"status": "UPLOADED"}
+    return amclient
+
 
 class TestReingestClass:
     dbpath = "fixtures/reingest_test.db"
@@ -51,3 +71,56 @@ class TestReingestClass:
     )
     def test_load_db_iterable(self, aip_uuids, expected):
         assert reingest.load_db(self.session, aip_uuids) == expected
+
+    def test_backoff(self):
+        """Test that the delay doubles up to the maximum, with jitter."""
+        for checks, expected in [(0, 30), (1, 60), (3, 240), (10, 600), (100, 600)]:
+            delay = reingest.backoff(checks, interval=30, max_interval=600)
+            assert expected * (1 - reingest.JITTER) <= delay
+            assert delay <= expected * (1 + reingest.JITTER)
+
+    def test_poll_reingest(self):
+        """Test that only the reingests due are checked and that the next
+        check of the ones not complete is scheduled.
+        """
+        reingest.load_db(self.session, AIP_UUIDS)
+        for aip_uuid in AIP_UUIDS:
+            reingestunit.set_status_in_progress(self.session, aip_uuid, "transfer")
+        amclient = _amclient({AIP_UUIDS[0]})
+
+        before = datetime.datetime.utcnow()
+        assert reingest.poll_reingest(self.session, amclient) == 1
+        assert [
+            item.aip_uuid for item in reingestunit.get_items_complete(self.session)
+        ] == AIP_UUIDS[:1]
+        item = reingestunit.get_item_by_aip_uuid(self.session, AIP_UUIDS[1])
+        assert item.checks == 1
+        assert item.next_check > before
+        assert reingestunit.get_next_check(self.session) == item.next_check
+
+        amclient.reset_mock()
+        assert reingest.poll_reingest(self.session, amclient) == 0
+        amclient.get_ingest_status.assert_not_called()
+
+    @mock.patch("transfers.reingest.reingest_full_and_approve")
+    def test_run_scheduler(self, reingest_full_and_approve):
+        """Test that the scheduler starts a reingest as soon as one
+        completes, until all are complete.
+        """
+        reingest_full_and_approve.return_value = (True, "transfer")
+        reingest.load_db(self.session, AIP_UUIDS)
+        amclient = _amclient(set(AIP_UUIDS))
+
+        assert reingest.run_scheduler(
+            self.session, amclient, "pipeline", "default", throttle=1, interval=0
+        )
+        assert reingest_full_and_approve.call_count == 2
+        assert len(reingestunit.get_items_complete(self.session)) == 2
+
+    def test_run_scheduler_stop(self):
+        """Test that the scheduler returns when it is stopped."""
+        stop = mock.Mock()
+        stop.is_set.return_value = True
+        assert not reingest.run_scheduler(
+            self.session, mock.Mock(), "pipeline", "default", throttle=1, stop=stop
+        )
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+import errno
+from unittest import mock
+
+import pytest
+
+from dips import staging
+
+
+@pytest.fixture
+def dip(tmp_path):
+    dip_path = tmp_path / "dip"
+    (dip_path / "objects" / "sub").mkdir(parents=True)
+    (dip_path / "METS.xml").write_text("mets")
+    (dip_path / "objects" / "file.txt").write_text("file")
+    (dip_path / "objects" / "sub" / "other.txt").write_text("other")
+    return dip_path
+
+
+def _files(path):
+    return sorted(
+        (file_path.relative_to(path).as_posix(), file_path.read_text())
+        for file_path in path.rglob("*")
+        if file_path.is_file()
+    )
+
+
+def _methods(manifest):
+    return {entry.method for entry in manifest}
+
+
+def test_stage_dip_move(dip, tmp_path):
+    """Test that the DIP folder is renamed when it can be moved."""
+    expected = _files(dip)
+    target = tmp_path / "staged"
+    manifest = staging.stage_dip(dip, target, move=True)
+    assert _methods(manifest) == {staging.RENAME}
+    assert not dip.exists()
+    assert _files(target) == expected
+
+
+def test_stage_dip_hardlink(dip, tmp_path):
+    """Test that the files are hardlinked and the local DIP is kept."""
+    target = tmp_path / "staged"
+    assert _methods(staging.stage_dip(dip, target)) == {staging.HARDLINK}
+    assert _files(target) == _files(dip)
+    source_file = dip / "objects" / "file.txt"
+    assert source_file.stat().st_ino == (target / "objects" / "file.txt").stat().st_ino
+
+
+@mock.patch(
+    "transfers.fileutils.fcntl.ioctl",
+    side_effect=OSError(errno.EOPNOTSUPP, "Not supported"),
+)
+@mock.patch(
+    "transfers.fileutils.os.link", side_effect=OSError(errno.EXDEV, "Cross-device")
+)
+def test_stage_dip_copy_fallback(mock_link, mock_ioctl, dip, tmp_path):
+    """Test that the files are copied when they can't be linked, trying each
+    method only once.
+    """
+    target = tmp_path / "staged"
+    assert _methods(staging.stage_dip(dip, target)) == {staging.COPY}
+    assert _files(target) == _files(dip)
+    assert mock_link.call_count == 1
+    assert mock_ioctl.call_count == 1
+    assert not (dip / "objects" / "file.txt").samefile(target / "objects" / "file.txt")
+
+
+@mock.patch(
+    "transfers.fileutils.os.link", side_effect=OSError(errno.ENOSPC, "No space")
+)
+def test_stage_dip_error(_link, dip, tmp_path):
+    """Test that errors other than unsupported methods are raised and the
+    partial staged folder is removed.
+    """
+    target = tmp_path / "staged"
+    with pytest.raises(OSError):
+        staging.stage_dip(dip, target)
+    assert not target.exists()
+    assert dip.exists()
+
+
+@pytest.mark.parametrize("move", [False, True])
+@pytest.mark.parametrize("copy", [False, True])
+def test_stage_dip_manifest(dip, tmp_path, move, copy):
+    """Test that the manifest lists the sizes and checksums of the files,
+    however they are staged.
+    """
+    target = tmp_path / "staged"
+    link = mock.patch(
+        "transfers.fileutils.os.link", side_effect=OSError(errno.EXDEV, "Cross-device")
+    )
+    ioctl = mock.patch(
+        "transfers.fileutils.fcntl.ioctl",
+        side_effect=OSError(errno.EOPNOTSUPP, "Not supported"),
+    )
+    if copy:
+        link.start()
+        ioctl.start()
+    try:
+        manifest = staging.stage_dip(dip, target, move=move, algorithm="md5")
+    finally:
+        mock.patch.stopall()
+    assert sorted((entry.path, entry.size, entry.checksum) for entry in manifest) == [
+        ("METS.xml", 4, "8b1175a1bc5dc1bb6f34b571de89cd3f"),
+        ("objects/file.txt", 4, "8c7dd922ad47494fc02c388e12c00eac"),
+        ("objects/sub/other.txt", 5, "795f3202b17cb6bc3d4b771d8c6c9eaf"),
+    ]
+    assert staging.verify_manifest(target, manifest, "md5") == []
+
+    (target / "objects" / "file.txt").write_text("changed")
+    (target / "objects" / "sub" / "other.txt").write_text("OTHER")
+    (target / "METS.xml").unlink()
+    assert staging.verify_manifest(target, manifest, "md5") == [
+        entry.path for entry in manifest
+    ]
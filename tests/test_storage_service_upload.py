@@ -1,11 +1,11 @@
 #!/usr/bin/env python
 import os
-import shutil
 import unittest
 from unittest import mock
 
 import requests
 
+from dips import staging
 from dips import storage_service_upload
 
 SS_URL = "http://localhost:62081"
@@ -17,6 +17,10 @@ DS_LOCATION_UUID = "7537c1a8-a3d3-4de7-a3ba-f6e6d4aa25c6"
 SHARED_DIRECTORY = "/home/radda/.am/am-pipeline-data/"
 DIP_PATH = "/tmp/fake_DIP"
 AIP_UUID = "2942ac09-d55e-426b-84d3-0def52739791"
+MANIFEST = [
+    staging.ManifestEntry("METS.xml", 10, staging.HARDLINK, None),
+    staging.ManifestEntry("objects/file.txt", 5, staging.HARDLINK, None),
+]
 
 
 class TestSsUpload(unittest.TestCase):
@@ -37,10 +41,10 @@ class TestSsUpload(unittest.TestCase):
         assert ret == 1
 
     @mock.patch(
-        "dips.storage_service_upload.shutil.copytree", side_effect=shutil.Error("")
+        "dips.storage_service_upload.staging.stage_dip", side_effect=OSError("")
     )
     @mock.patch("dips.storage_service_upload.os.makedirs")
-    def test_dip_folder_copy_fail(self, mock_makedirs, mock_copytree):
+    def test_dip_folder_copy_fail(self, mock_makedirs, mock_stage_dip):
         ret = storage_service_upload.main(
             ss_url=SS_URL,
             ss_user=SS_USER_NAME,
@@ -55,13 +59,13 @@ class TestSsUpload(unittest.TestCase):
         )
         assert ret == 2
 
-    @mock.patch("dips.storage_service_upload.shutil.copytree")
+    @mock.patch("dips.storage_service_upload.staging.stage_dip", return_value=MANIFEST)
     @mock.patch("dips.storage_service_upload.os.makedirs")
     @mock.patch(
-        "requests.post",
+        "requests.Session.post",
         side_effect=[mock.Mock(status_code=401, headers={}, spec=requests.Response)],
     )
-    def test_request_fail(self, _get, _makedirs, _copytree):
+    def test_request_fail(self, _get, _makedirs, _stage_dip):
         ret = storage_service_upload.main(
             ss_url=SS_URL,
             ss_user=SS_USER_NAME,
@@ -77,10 +81,10 @@ class TestSsUpload(unittest.TestCase):
         assert ret == 3
 
     @mock.patch("dips.atom_upload.shutil.rmtree")
-    @mock.patch("dips.storage_service_upload.shutil.copytree")
+    @mock.patch("dips.storage_service_upload.staging.stage_dip", return_value=MANIFEST)
     @mock.patch("dips.storage_service_upload.os.makedirs")
     @mock.patch(
-        "requests.post",
+        "requests.Session.post",
         side_effect=[
             mock.Mock(
                 **{
@@ -92,7 +96,7 @@ class TestSsUpload(unittest.TestCase):
             )
         ],
     )
-    def test_success(self, _get, _makedirs, _copytree, mock_rmtree):
+    def test_success(self, mock_post, _makedirs, mock_stage_dip, mock_rmtree):
         ret = storage_service_upload.main(
             ss_url=SS_URL,
             ss_user=SS_USER_NAME,
@@ -112,4 +116,95 @@ class TestSsUpload(unittest.TestCase):
             "automationToolsDIPs",
             os.path.basename(DIP_PATH),
         )
+        mock_stage_dip.assert_called_once_with(
+            DIP_PATH, upload_dip_path, move=True, algorithm=None
+        )
+        assert mock_post.call_args[1]["json"]["size"] == 15
         mock_rmtree.assert_has_calls([mock.call(upload_dip_path), mock.call(DIP_PATH)])
+
+    @mock.patch("dips.atom_upload.shutil.rmtree")
+    @mock.patch(
+        "dips.storage_service_upload.staging.stage_dip",
+        return_value=[staging.ManifestEntry("METS.xml", 10, staging.RENAME, None)],
+    )
+    @mock.patch("dips.storage_service_upload.os.makedirs")
+    @mock.patch(
+        "requests.Session.post",
+        side_effect=[
+            mock.Mock(
+                **{
+                    "status_code": 201,
+                    "json.return_value": {},
+                    "headers": {},
+                },
+                spec=requests.Response
+            )
+        ],
+    )
+    def test_success_moved(self, _get, _makedirs, _stage_dip, mock_rmtree):
+        """Test that a DIP moved to the shared directory is only removed from
+        there.
+        """
+        ret = storage_service_upload.main(
+            ss_url=SS_URL,
+            ss_user=SS_USER_NAME,
+            ss_api_key=SS_API_KEY,
+            pipeline_uuid=PIPELINE_UUID,
+            cp_location_uuid=CP_LOCATION_UUID,
+            ds_location_uuid=DS_LOCATION_UUID,
+            shared_directory=SHARED_DIRECTORY,
+            dip_path=DIP_PATH,
+            aip_uuid=AIP_UUID,
+            delete_local_copy=True,
+        )
+        assert ret == 0
+        upload_dip_path = os.path.join(
+            SHARED_DIRECTORY,
+            "watchedDirectories",
+            "automationToolsDIPs",
+            os.path.basename(DIP_PATH),
+        )
+        mock_rmtree.assert_called_once_with(upload_dip_path)
+
+    @mock.patch("dips.storage_service_upload.shutil.rmtree")
+    @mock.patch(
+        "dips.storage_service_upload.staging.verify_manifest",
+        return_value=["objects/file.txt"],
+    )
+    @mock.patch(
+        "dips.storage_service_upload.staging.stage_dip",
+        return_value=[
+            staging.ManifestEntry("objects/file.txt", 5, staging.COPY, "abc"),
+        ],
+    )
+    @mock.patch("dips.storage_service_upload.os.makedirs")
+    @mock.patch("requests.Session.post")
+    def test_checksum_mismatch(
+        self, mock_post, _makedirs, _stage_dip, mock_verify, mock_rmtree
+    ):
+        """Test that a DIP copied with errors is not stored."""
+        ret = storage_service_upload.main(
+            ss_url=SS_URL,
+            ss_user=SS_USER_NAME,
+            ss_api_key=SS_API_KEY,
+            pipeline_uuid=PIPELINE_UUID,
+            cp_location_uuid=CP_LOCATION_UUID,
+            ds_location_uuid=DS_LOCATION_UUID,
+            shared_directory=SHARED_DIRECTORY,
+            dip_path=DIP_PATH,
+            aip_uuid=AIP_UUID,
+            delete_local_copy=True,
+            checksum_algorithm="sha256",
+        )
+        assert ret == 2
+        upload_dip_path = os.path.join(
+            SHARED_DIRECTORY,
+            "watchedDirectories",
+            "automationToolsDIPs",
+            os.path.basename(DIP_PATH),
+        )
+        mock_verify.assert_called_once_with(
+            upload_dip_path, _stage_dip.return_value, "sha256"
+        )
+        mock_post.assert_not_called()
+        mock_rmtree.assert_called_once_with(upload_dip_path)
@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+from unittest import mock
 from uuid import uuid4
 
 import pytest
@@ -44,8 +45,7 @@ def test_get_functions(setup_session):
         status="PROCESSING",
         current=True,
     )
-    unit = models.get_current_unit()
-    assert unit.uuid == transfer_one_uuid
+    assert [unit.uuid for unit in models.get_current_units()] == [transfer_one_uuid]
     transfer_two_uuid = str(uuid4())
     models._update_unit(
         uuid=transfer_two_uuid,
@@ -62,8 +62,7 @@ def test_get_functions(setup_session):
     )
     assert unit_one.uuid == transfer_one_uuid
     assert unit_two.uuid == transfer_two_uuid
-    all_processed_paths = models.get_processed_transfer_paths()
-    assert len(all_processed_paths) == 2
+    assert list(models.get_unprocessed_paths([b"/foo", b"/bar", b"/baz"])) == [b"/baz"]
 
 
 def test_start_Transfer_unit_state(setup_session):
@@ -117,3 +116,59 @@ def test_update_unit_attributes(setup_session):
     assert unit.microservice == "Generate METS.xml document"
     assert unit.current is False
     assert unit.status == "COMPLETE"
+
+
+def test_get_unprocessed_paths(setup_session, monkeypatch):
+    """Test the bulk lookup of the paths that are not in the database, across
+    several queries.
+    """
+    monkeypatch.setattr(models, "PATH_CHUNK_SIZE", 2)
+    for path in (b"/b", b"/d"):
+        models.add_new_transfer(uuid=str(uuid4()), path=path)
+    candidates = [b"/a", b"/b", b"/c", b"/d", b"/e"]
+    assert list(models.get_unprocessed_paths(candidates)) == [b"/a", b"/c", b"/e"]
+    assert list(models.get_unprocessed_paths([b"/b"])) == []
+    assert "ix_unit_path" in {index.name for index in models.Unit.__table__.indexes}
+
+
+def test_transaction(setup_session):
+    """Test that the changes in a transaction are committed once, or rolled
+    back on errors.
+    """
+    unit = models.add_new_transfer(uuid=str(uuid4()), path=b"/foo")
+    with mock.patch.object(
+        models.transfer_session, "commit", wraps=models.transfer_session.commit
+    ) as mock_commit:
+        with models.transaction():
+            models.update_unit_status(unit, "PROCESSING")
+            with models.transaction():
+                models.update_unit_microservice(unit, "Approve transfer")
+            models.update_unit_current(unit, False)
+            assert mock_commit.call_count == 0
+            assert models.transfer_session.info[models.TRANSACTION_DEPTH] == 1
+        assert mock_commit.call_count == 1
+        assert models.transfer_session.info[models.TRANSACTION_DEPTH] == 0
+    with pytest.raises(RuntimeError):
+        with models.transaction():
+            models.update_unit_status(unit, "FAILED")
+            raise RuntimeError()
+    unit = models.transfer_session.query(models.Unit).one()
+    assert unit.status == "PROCESSING"
+    assert unit.microservice == "Approve transfer"
+    assert unit.current is False
+
+
+def test_init_session_pragmas(tmp_path):
+    """Test that the journal mode and synchronous setting are applied to the
+    connections, and that invalid ones are rejected.
+    """
+    models.init_session(
+        (tmp_path / "transfers.db").as_posix(), journal_mode="wal", synchronous="normal"
+    )
+    connection = models.transfer_session.connection()
+    assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+    # NORMAL is 1
+    assert connection.exec_driver_sql("PRAGMA synchronous").scalar() == 1
+    models.cleanup_session()
+    with pytest.raises(ValueError):
+        models.init_session(":memory:", journal_mode="fast")
@@ -9,6 +9,7 @@ import requests
 from transfers import errors
 from transfers import models
 from transfers import transfer
+from transfers import utils
 
 
 AM_URL = "http://127.0.0.1"
@@ -69,7 +70,7 @@ class TestAutomateTransfers(unittest.TestCase):
         ]
 
     @mock.patch(
-        "requests.request",
+        "requests.Session.request",
         side_effect=[
             mock.Mock(
                 **{
@@ -111,7 +112,7 @@ class TestAutomateTransfers(unittest.TestCase):
         )
 
     @mock.patch(
-        "requests.request",
+        "requests.Session.request",
         side_effect=[
             mock.Mock(
                 **{
@@ -186,7 +187,7 @@ class TestAutomateTransfers(unittest.TestCase):
         )
 
     @mock.patch(
-        "requests.request",
+        "requests.Session.request",
         side_effect=[
             mock.Mock(
                 **{
@@ -229,7 +230,7 @@ class TestAutomateTransfers(unittest.TestCase):
         )
 
     @mock.patch(
-        "requests.request",
+        "requests.Session.request",
         side_effect=[
             mock.Mock(
                 **{
@@ -252,7 +253,7 @@ class TestAutomateTransfers(unittest.TestCase):
         self.assertEqual(info, errors.error_lookup(errors.ERR_INVALID_RESPONSE))
 
     @mock.patch(
-        "requests.request",
+        "requests.Session.request",
         side_effect=[
             mock.Mock(
                 **{
@@ -279,7 +280,7 @@ class TestAutomateTransfers(unittest.TestCase):
         self.assertEqual(accession_id, None)
 
     @mock.patch(
-        "requests.request",
+        "requests.Session.request",
         side_effect=[
             mock.Mock(
                 **{
@@ -310,7 +311,7 @@ class TestAutomateTransfers(unittest.TestCase):
         self.assertEqual(path, b"SampleTransfers/BagTransfer")
 
     @mock.patch(
-        "requests.request",
+        "requests.Session.request",
         side_effect=[
             mock.Mock(
                 **{
@@ -342,7 +343,7 @@ class TestAutomateTransfers(unittest.TestCase):
         self.assertEqual(path, b"SampleTransfers/CSVmetadata")
 
     @mock.patch(
-        "requests.request",
+        "requests.Session.request",
         side_effect=[
             mock.Mock(
                 **{
@@ -384,7 +385,7 @@ class TestAutomateTransfers(unittest.TestCase):
         self.assertEqual(path, b"SampleTransfers/BagTransfer/data")
 
     @mock.patch(
-        "requests.request",
+        "requests.Session.request",
         side_effect=[
             mock.Mock(
                 **{
@@ -416,7 +417,7 @@ class TestAutomateTransfers(unittest.TestCase):
         self.assertEqual(path, b"OPF format-corpus")
 
     @mock.patch(
-        "requests.request",
+        "requests.Session.request",
         side_effect=[
             mock.Mock(
                 **{
@@ -460,7 +461,7 @@ class TestAutomateTransfers(unittest.TestCase):
         self.assertEqual(path, None)
 
     @mock.patch(
-        "requests.request",
+        "requests.Session.request",
         side_effect=[
             mock.Mock(
                 **{
@@ -493,7 +494,7 @@ class TestAutomateTransfers(unittest.TestCase):
         self.assertEqual(path, None)
 
     @mock.patch(
-        "requests.request",
+        "requests.Session.request",
         side_effect=[
             mock.Mock(
                 **{
@@ -526,7 +527,7 @@ class TestAutomateTransfers(unittest.TestCase):
         self.assertEqual(path, b"SampleTransfers/BagTransfer.zip")
 
     @mock.patch(
-        "requests.request",
+        "requests.Session.request",
         side_effect=[
             mock.Mock(
                 **{
@@ -561,7 +562,7 @@ class TestAutomateTransfers(unittest.TestCase):
 
     @mock.patch("time.sleep")
     @mock.patch(
-        "requests.request",
+        "requests.Session.request",
         side_effect=[
             mock.Mock(
                 **{
@@ -721,7 +722,7 @@ class TestAutomateTransfers(unittest.TestCase):
             assert res == test.expected
 
     @mock.patch(
-        "requests.post",
+        "requests.Session.post",
         side_effect=[
             mock.Mock(
                 **{
@@ -804,7 +805,7 @@ class TestAutomateTransfers(unittest.TestCase):
         return_value="4bd2006a-1178-4695-9463-5c72eec6257a",
     )
     @mock.patch(
-        "requests.post",
+        "requests.Session.post",
         side_effect=[
             mock.Mock(
                 **{
@@ -916,3 +917,194 @@ class TestAutomateTransfers(unittest.TestCase):
                     assert unit.uuid == returned_uuid
                     assert unit.current is True
                     assert unit.unit_type == "transfer"
+
+    def test_next_poll_interval(self):
+        """Polling should back off while nothing changes and restart at the
+        minimum interval as soon as a unit changes state.
+        """
+        assert transfer.next_poll_interval(10, False, 10, 300) == 20
+        assert transfer.next_poll_interval(200, False, 10, 300) == 300
+        assert transfer.next_poll_interval(300, False, 10, 300) == 300
+        assert transfer.next_poll_interval(300, True, 10, 300) == 10
+
+    @mock.patch("signal.signal")
+    def test_run_daemon(self, _signal):
+        """The daemon should keep polling with the same session until it is
+        asked to stop, and survive unexpected errors in a poll.
+        """
+        calls = []
+
+        def run_once(**kwargs):
+            calls.append(kwargs)
+            if len(calls) == 1:
+                models.add_new_transfer(uuid="uuid-1", path=b"/foo")
+            elif len(calls) == 2:
+                raise ValueError("transient error")
+            else:
+                transfer.SHUTDOWN.set()
+            return 0
+
+        waits = []
+        with mock.patch("transfers.transfer.run_once", side_effect=run_once):
+            with mock.patch.object(transfer.SHUTDOWN, "wait", waits.append):
+                try:
+                    ret = transfer.run_daemon(10, 300, config_file="config.cfg")
+                finally:
+                    transfer.SHUTDOWN.clear()
+        assert ret == 0
+        assert len(calls) == 3
+        assert calls[0] == {"config_file": "config.cfg"}
+        # A new transfer resets the interval, idle polls back off.
+        assert waits == [10, 20, 40]
+
+    def test_run_once_fills_free_slots(self):
+        """Units still processing keep their slot, finished ones free it and
+        new transfers are started until max_in_flight units are in flight.
+        """
+        processing = models.add_new_transfer(uuid="uuid-1", path=b"/foo")
+        complete = models.add_new_transfer(uuid="uuid-2", path=b"/bar")
+        statuses = {
+            "uuid-1": {"status": "PROCESSING"},
+            "uuid-2": {"status": "COMPLETE"},
+        }
+
+        def get_status(*args):
+            # The units are polled outside of the transaction of the run
+            assert not models.transfer_session.info.get(models.TRANSACTION_DEPTH)
+            return statuses[args[6]]
+
+        def start_transfer(*args):
+            return models.add_new_transfer(uuid=None, path=b"/new")
+
+        run_args = {
+            "am_user": USER,
+            "am_api_key": API_KEY,
+            "ss_user": SS_USER,
+            "ss_api_key": SS_KEY,
+            "ts_uuid": TS_LOCATION_UUID,
+            "ts_path": PATH_PREFIX,
+            "depth": DEPTH,
+            "am_url": AM_URL,
+            "ss_url": SS_URL,
+            "transfer_type": "standard",
+            "see_files": FILES,
+        }
+        get_status_patch = mock.patch(
+            "transfers.transfer.get_status", side_effect=get_status
+        )
+        start_transfer_patch = mock.patch(
+            "transfers.transfer.start_transfer", side_effect=start_transfer
+        )
+        with get_status_patch, start_transfer_patch as mock_start_transfer:
+            ret = transfer.run_once(max_in_flight=1, **run_args)
+            assert ret == 0
+            assert not mock_start_transfer.called
+            assert processing.current is True
+            assert complete.current is False
+
+            ret = transfer.run_once(max_in_flight=3, **run_args)
+            assert ret == 0
+            assert mock_start_transfer.call_count == 2
+        assert processing.status == "PROCESSING"
+        assert complete.status == "COMPLETE"
+        assert len(models.get_current_units()) == 3
+
+    def test_get_next_transfer_browse_cache(self):
+        """Listings should be read from the database while not expired."""
+        response = mock.Mock(
+            **{
+                "status_code": 200,
+                "headers": requests.structures.CaseInsensitiveDict(
+                    {"Content-Type": "application/json"}
+                ),
+                "json.return_value": {
+                    "directories": ["QmFnVHJhbnNmZXI=", "Q1NWbWV0YWRhdGE="]
+                },
+            },
+            spec=requests.Response,
+        )
+        args = (SS_URL, SS_USER, SS_KEY, TS_LOCATION_UUID, PATH_PREFIX, DEPTH)
+        with mock.patch("requests.Session.request", return_value=response) as req:
+            path = transfer.get_next_transfer(*args, COMPLETED, FILES, browse_ttl=60)
+            assert path == b"SampleTransfers/BagTransfer"
+            path = transfer.get_next_transfer(
+                *args, {b"SampleTransfers/BagTransfer"}, FILES, browse_ttl=60
+            )
+            assert path == b"SampleTransfers/CSVmetadata"
+            assert req.call_count == 1
+            # An expired listing is browsed again
+            transfer.get_next_transfer(*args, COMPLETED, FILES, browse_ttl=60)
+            with mock.patch(
+                "transfers.models.datetime.datetime", wraps=models.datetime.datetime
+            ) as mock_datetime:
+                mock_datetime.utcnow.return_value = (
+                    models.datetime.datetime.utcnow()
+                    + models.datetime.timedelta(seconds=61)
+                )
+                transfer.get_next_transfer(*args, COMPLETED, FILES, browse_ttl=60)
+            assert req.call_count == 2
+
+    def test_http_client(self):
+        """The shared HTTP client should pool connections per host, retry
+        with a backoff and apply a default timeout that callers can override.
+        """
+        client = utils.configure_client(
+            timeout=5, retries=2, backoff_factor=0.1, pool_size=3
+        )
+        assert utils.get_client() is client
+        adapter = client.get_adapter(AM_URL)
+        assert adapter._pool_maxsize == 3
+        assert adapter._pool_block is True
+        assert adapter.max_retries.total == 2
+        assert adapter.max_retries.backoff_factor == 0.1
+        with mock.patch("requests.Session.request") as mock_request:
+            client.get(AM_URL)
+            client.post(SS_URL, timeout=60)
+        assert mock_request.call_args_list[0].kwargs["timeout"] == 5
+        assert mock_request.call_args_list[1].kwargs["timeout"] == 60
+        utils.configure_client()
+
+    def test_am_client(self):
+        """The Archivematica and Storage Service calls made with amclient's
+        client should go through the shared HTTP client, with its timeout.
+        """
+        utils.configure_client(timeout=5)
+        am = utils.AMClient(
+            am_url=AM_URL,
+            am_user_name=USER,
+            am_api_key=API_KEY,
+            ss_url=SS_URL,
+            ss_user_name=SS_USER,
+            ss_api_key=SS_KEY,
+            transfer_uuid="transfer-uuid",
+            sip_uuid="sip-uuid",
+            package_uuid="package-uuid",
+        )
+        response = mock.Mock(
+            **{
+                "status_code": 200,
+                "headers": requests.structures.CaseInsensitiveDict(
+                    {"Content-Type": "application/json"}
+                ),
+                "json.return_value": {"status": "COMPLETE"},
+            },
+            spec=requests.Response,
+        )
+        with mock.patch("requests.Session.request", return_value=response) as req:
+            assert am.get_transfer_status() == {"status": "COMPLETE"}
+            assert am.get_ingest_status() == {"status": "COMPLETE"}
+            assert am.get_package_details() == {"status": "COMPLETE"}
+            assert am.get_package({"package_type": "AIP"}) == {"status": "COMPLETE"}
+        assert [call.args for call in req.call_args_list] == [
+            ("GET", f"{AM_URL}/api/transfer/status/transfer-uuid/"),
+            ("GET", f"{AM_URL}/api/ingest/status/sip-uuid/"),
+            ("GET", f"{SS_URL}/api/v2/file/package-uuid"),
+            ("GET", f"{SS_URL}/api/v2/file/"),
+        ]
+        assert req.call_args_list[3].kwargs["params"] == {
+            "username": SS_USER,
+            "api_key": SS_KEY,
+            "package_type": "AIP",
+        }
+        assert all(call.kwargs["timeout"] == 5 for call in req.call_args_list)
+        utils.configure_client()
@@ -52,7 +52,7 @@ Result = collections.namedtuple(
     ],
 )
 @mock.patch(
-    "requests.post",
+    "requests.Session.post",
     side_effect=[
         mock.Mock(
             **{
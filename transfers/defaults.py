@@ -31,3 +31,15 @@ DEFAULT_REINGEST_TYPE = "full"
 
 # Default transfer type
 DEFAULT_TRANSFER_TYPE = "standard"
+
+# Minimum and maximum number of seconds between two polls in daemon mode
+DEFAULT_POLL_INTERVAL = 10
+DEFAULT_MAX_POLL_INTERVAL = 300
+
+# Settings of the HTTP client shared by the Archivematica and Storage Service
+# calls: timeout in seconds, number of retries, backoff factor in seconds and
+# maximum number of connections kept per host.
+DEFAULT_HTTP_TIMEOUT = 120
+DEFAULT_HTTP_RETRIES = 3
+DEFAULT_HTTP_BACKOFF = 0.5
+DEFAULT_HTTP_POOL_SIZE = 10
@@ -0,0 +1,109 @@
+"""
+File placement helpers shared by the AIP and DIP scripts.
+
+Places a file at another path without copying its bytes when it can be
+avoided: it is hardlinked, or reflinked on filesystems that support it,
+falling back to a full copy when the target is on another filesystem.
+"""
+import errno
+import hashlib
+import logging
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+LOGGER = logging.getLogger("dip_workflow")
+
+HARDLINK = "hardlink"
+REFLINK = "reflink"
+COPY = "copy"
+
+# Size of the chunks read to copy or checksum the files
+CHUNK_SIZE = 1024 * 1024
+
+# ioctl request cloning a file into another one, from linux/fs.h
+FICLONE = 0x40049409
+
+# Errors meaning that a method is not supported between the two paths, as
+# opposed to errors reading or writing the files
+UNSUPPORTED_ERRNOS = {
+    errno.EXDEV,
+    errno.EPERM,
+    errno.EMLINK,
+    errno.EINVAL,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    getattr(errno, "ENOTSUP", errno.EOPNOTSUPP),
+}
+
+
+def stage_file(src, dst, methods, algorithm=None):
+    """Place the file src at dst with the first method of the list that
+    works. Unsupported methods are removed from the list, so the next files
+    go straight to the ones that work.
+
+    :returns: the method used and the checksum of the file, or None
+    """
+    while True:
+        method = methods[0]
+        if method == COPY:
+            return COPY, copy_file(src, dst, algorithm)
+        try:
+            if method == HARDLINK:
+                os.link(src, dst)
+            else:
+                reflink_file(src, dst)
+            return method, file_checksum(dst, algorithm) if algorithm else None
+        except OSError as err:
+            if err.errno not in UNSUPPORTED_ERRNOS:
+                raise
+            LOGGER.debug("Could not %s %s: %s", method, src, err)
+            if methods[0] == method:
+                methods.pop(0)
+
+
+def reflink_file(src, dst):
+    """Clone src to dst, sharing the data blocks of both files until either
+    is modified. Only works within a filesystem supporting it, e.g. Btrfs or
+    XFS.
+    """
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported")
+    try:
+        with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        raise
+    shutil.copystat(src, dst)
+
+
+def copy_file(src, dst, algorithm=None):
+    """Copy src to dst with its metadata.
+
+    :returns: checksum of the data copied, or None if no algorithm is given
+    """
+    if algorithm is None:
+        shutil.copy2(src, dst)
+        return None
+    checksum = hashlib.new(algorithm)
+    with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+        for chunk in iter(lambda: src_file.read(CHUNK_SIZE), b""):
+            checksum.update(chunk)
+            dst_file.write(chunk)
+    shutil.copystat(src, dst)
+    return checksum.hexdigest()
+
+
+def file_checksum(path, algorithm):
+    """Return the hex digest of a file with a hashlib algorithm."""
+    checksum = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
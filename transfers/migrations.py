@@ -0,0 +1,102 @@
+"""Schema migrations of the automation-tools SQLite databases.
+
+The version of the schema of a database is recorded in its ``user_version``
+pragma. Every models module keeps a list of migrations, each one a list of SQL
+statements, and ``migrate`` applies the ones that are newer than the version
+of the database when it is initialized. New tables and the indexes declared on
+them are created by ``create_all``, so the statements only need to upgrade the
+tables of existing databases, and they should be safe to run on databases that
+already have the change, e.g. ``CREATE INDEX IF NOT EXISTS``. SQLite has no
+``ADD COLUMN IF NOT EXISTS``, so ``ALTER TABLE ... ADD COLUMN`` statements are
+skipped when the table already has the column, e.g. when ``create_all`` just
+created it. Databases created from scratch by ``create_all`` already have the
+latest schema and are only stamped with its version.
+
+Each migration is applied in a transaction with the bump of the version, so
+a migration that fails or is interrupted is rolled back and applied again from
+the start the next time.
+
+Migrations are only ever appended to the lists, never modified or removed.
+"""
+import logging
+import re
+
+from sqlalchemy import inspect
+
+LOGGER = logging.getLogger("transfers")
+
+ADD_COLUMN = re.compile(
+    r"\s*ALTER\s+TABLE\s+(\w+)\s+ADD\s+(?:COLUMN\s+)?(\w+)", re.IGNORECASE
+)
+
+
+def get_version(connection):
+    """Return the schema version of the database."""
+    return connection.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def migrate(engine, migrations):
+    """Apply to the database the migrations newer than its schema version.
+
+    :param engine: SQLAlchemy engine of the database.
+    :param list migrations: Lists of SQL statements, oldest first.
+    :returns: The schema version of the database.
+    """
+    connection = engine.raw_connection()
+    # pysqlite only opens transactions before DML statements, so they are
+    # opened explicitly to include the DDL statements and the version.
+    dbapi_connection = connection.connection
+    isolation_level = dbapi_connection.isolation_level
+    dbapi_connection.isolation_level = None
+    try:
+        cursor = dbapi_connection.cursor()
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        for number, statements in enumerate(migrations[version:], start=version + 1):
+            LOGGER.info("Migrating %s to schema version %s", engine.url, number)
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                for statement in statements:
+                    if not _has_column(cursor, statement):
+                        cursor.execute(statement)
+                # PRAGMA does not take bound parameters.
+                cursor.execute(f"PRAGMA user_version = {number:d}")
+                cursor.execute("COMMIT")
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            version = number
+    finally:
+        dbapi_connection.isolation_level = isolation_level
+        connection.close()
+    return version
+
+
+def _has_column(cursor, statement):
+    """Return whether statement adds a column that its table already has."""
+    match = ADD_COLUMN.match(statement)
+    if not match:
+        return False
+    table, column = match.groups()
+    columns = cursor.execute(f"PRAGMA table_info({table})").fetchall()
+    return any(row[1].lower() == column.lower() for row in columns)
+
+
+def create_all(engine, metadata, migrations):
+    """Create the missing tables of the database and migrate it.
+
+    A database without any of the tables gets them with the latest schema and
+    is stamped with the latest version instead of being migrated.
+
+    :param engine: SQLAlchemy engine of the database.
+    :param metadata: SQLAlchemy metadata of the tables.
+    :param list migrations: Lists of SQL statements, oldest first.
+    :returns: The schema version of the database.
+    """
+    inspector = inspect(engine)
+    created = not any(inspector.has_table(table) for table in metadata.tables)
+    metadata.create_all(engine)
+    if not created:
+        return migrate(engine, migrations)
+    with engine.begin() as connection:
+        connection.exec_driver_sql(f"PRAGMA user_version = {len(migrations):d}")
+    return len(migrations)
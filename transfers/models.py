@@ -1,23 +1,61 @@
+import contextlib
+import datetime
+import json
+
 from sqlalchemy import Boolean
 from sqlalchemy import Column
 from sqlalchemy import create_engine
+from sqlalchemy import DateTime
+from sqlalchemy import event
+from sqlalchemy import Index
 from sqlalchemy import Integer
 from sqlalchemy import LargeBinary
 from sqlalchemy import Sequence
 from sqlalchemy import String
+from sqlalchemy import Text
+from sqlalchemy import UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
 
+from transfers import migrations
+
 Base = declarative_base()
 Session = None
 transfer_session = None
 
+# Key of the session info with the depth of the nested transaction() blocks
+# the session is in.
+TRANSACTION_DEPTH = "transaction_depth"
+
+# Values accepted by the journal_mode and synchronous pragmas.
+JOURNAL_MODES = ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")
+SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+# Number of paths bound to a single IN query, below the SQLite default limit
+# of 999 host parameters.
+PATH_CHUNK_SIZE = 500
+
+# Schema migrations, see transfers.migrations.
+MIGRATIONS = [
+    # 1: Index the columns units are looked up by.
+    [
+        "CREATE INDEX IF NOT EXISTS ix_unit_path ON unit (path)",
+        "CREATE INDEX IF NOT EXISTS ix_unit_current ON unit (current)",
+        "CREATE INDEX IF NOT EXISTS ix_unit_unit_type_uuid ON unit (unit_type, uuid)",
+    ],
+]
+
 
 class Unit(Base):
     """Object that represents transfer units in the automation tools database."""
 
     __tablename__ = "unit"
+    __table_args__ = (
+        Index("ix_unit_path", "path"),
+        Index("ix_unit_current", "current"),
+        Index("ix_unit_unit_type_uuid", "unit_type", "uuid"),
+    )
 
     id = Column(Integer, Sequence("user_id_seq"), primary_key=True)
     uuid = Column(String(36))
@@ -34,17 +72,60 @@ class Unit(Base):
         )
 
 
-def init_session(databasefile):
+class BrowseListing(Base):
+    """Object that represents the cached Storage Service listing of a
+    directory in a transfer source location.
+    """
+
+    __tablename__ = "browse_listing"
+    __table_args__ = (UniqueConstraint("location_uuid", "path"),)
+
+    id = Column(Integer, Sequence("browse_listing_id_seq"), primary_key=True)
+    location_uuid = Column(String(36))
+    path = Column(LargeBinary())
+    listing = Column(Text())  # JSON with the base64 encoded names
+    browsed = Column(DateTime())
+
+    def __repr__(self):
+        return (
+            "<BrowseListing(id={s.id}, location_uuid={s.location_uuid}, "
+            "path={s.path}, browsed={s.browsed})>".format(s=self)
+        )
+
+
+def init_session(databasefile, journal_mode=None, synchronous=None):
     """Initialize the database given a database filename and initiate the
     database session to use throughout our transactions.
+
+    :param journal_mode: SQLite journal mode of the database, one of
+                         JOURNAL_MODES. The SQLite default if None.
+    :param synchronous: SQLite synchronous setting of the connections, one of
+                        SYNCHRONOUS_MODES. The SQLite default if None.
     """
+    pragmas = []
+    if journal_mode is not None:
+        if journal_mode.upper() not in JOURNAL_MODES:
+            raise ValueError(f"Invalid SQLite journal mode: {journal_mode}")
+        pragmas.append(f"PRAGMA journal_mode = {journal_mode.upper()}")
+    if synchronous is not None:
+        if synchronous.upper() not in SYNCHRONOUS_MODES:
+            raise ValueError(f"Invalid SQLite synchronous setting: {synchronous}")
+        pragmas.append(f"PRAGMA synchronous = {synchronous.upper()}")
     engine = create_engine(f"sqlite:///{databasefile}", echo=False)
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
     global Session
     Session = scoped_session(sessionmaker())
     Session.configure(bind=engine)
     global transfer_session
     transfer_session = Session()
-    Base.metadata.create_all(engine)
+    migrations.create_all(engine, Base.metadata, MIGRATIONS)
 
 
 def cleanup_session():
@@ -52,18 +133,55 @@ def cleanup_session():
     Session.remove()
 
 
-def get_current_unit():
-    """Query the database for current units. Return the first."""
-    return transfer_session.query(Unit).filter_by(current=True).one()
+@contextlib.contextmanager
+def transaction():
+    """Group the changes made by the helpers of this module in the block into
+    a single commit, e.g. all the status updates of a polling cycle. The
+    changes are rolled back if the block raises. Nested blocks are committed
+    by the outermost one. The depth of the blocks is kept in the info of the
+    session, so it only applies to the changes made with it.
+    """
+    session = transfer_session
+    session.info[TRANSACTION_DEPTH] = session.info.get(TRANSACTION_DEPTH, 0) + 1
+    try:
+        yield session
+    except BaseException:
+        session.info[TRANSACTION_DEPTH] -= 1
+        if not session.info[TRANSACTION_DEPTH]:
+            session.rollback()
+        raise
+    session.info[TRANSACTION_DEPTH] -= 1
+    if not session.info[TRANSACTION_DEPTH]:
+        session.commit()
+
+
+def _commit():
+    """Commit the session, unless in a transaction() block."""
+    if not transfer_session.info.get(TRANSACTION_DEPTH):
+        transfer_session.commit()
+
+
+def get_current_units():
+    """Query the database for all the units currently in flight, oldest
+    first.
+    """
+    return transfer_session.query(Unit).filter_by(current=True).order_by(Unit.id).all()
 
 
-def get_processed_transfer_paths():
-    """Return a set that represents the processed transfer paths in the
-    database. Set is a set of all paths in the database. The caller needs to
-    create a delta by comparing the result to other data points, e.g. a list of
-    paths of its own.
+def get_unprocessed_paths(paths):
+    """Yield the paths, in the given order, that are not the path of any unit
+    in the database. The paths are looked up in bulk through the path index,
+    so the cost does not grow with the number of units in the database.
     """
-    return {x[0] for x in transfer_session.query(Unit.path).all()}
+    paths = list(paths)
+    for start in range(0, len(paths), PATH_CHUNK_SIZE):
+        chunk = paths[start : start + PATH_CHUNK_SIZE]
+        processed = {
+            x[0] for x in transfer_session.query(Unit.path).filter(Unit.path.in_(chunk))
+        }
+        for path in chunk:
+            if path not in processed:
+                yield path
 
 
 def retrieve_unit_by_type_and_uuid(uuid, unit_type):
@@ -86,7 +204,7 @@ def _update_unit(uuid, path, unit_type, status, current, microservice=""):
         microservice=microservice,
     )
     transfer_session.add(unit)
-    transfer_session.commit()
+    _commit()
     return unit
 
 
@@ -119,13 +237,13 @@ def update_unit_type_and_uuid(unit, unit_type, uuid):
     """
     unit.unit_type = unit_type
     unit.uuid = uuid
-    transfer_session.commit()
+    _commit()
 
 
 def update_unit_microservice(unit, microservice):
     """Update the microservice column of the given unit."""
     unit.microservice = microservice
-    transfer_session.commit()
+    _commit()
 
 
 def update_unit_current(unit, current):
@@ -133,10 +251,49 @@ def update_unit_current(unit, current):
     is still current and needs to be processed by the automation tools.
     """
     unit.current = current
-    transfer_session.commit()
+    _commit()
 
 
 def update_unit_status(unit, status):
     """Update the status of the given unit, e.g. COMPLETED, PROCESSING, etc."""
     unit.status = status
-    transfer_session.commit()
+    _commit()
+
+
+def get_browse_listing(location_uuid, path, max_age):
+    """Return the cached listing of a directory in a transfer source location
+    as returned by the Storage Service browse endpoint, or None if it has not
+    been browsed in the last ``max_age`` seconds.
+    """
+    oldest = datetime.datetime.utcnow() - datetime.timedelta(seconds=max_age)
+    cached = (
+        transfer_session.query(BrowseListing)
+        .filter_by(location_uuid=location_uuid, path=path)
+        .filter(BrowseListing.browsed >= oldest)
+        .one_or_none()
+    )
+    if cached is None:
+        return None
+    return json.loads(cached.listing)
+
+
+def save_browse_listing(location_uuid, path, browse_info):
+    """Cache the listing of a directory in a transfer source location."""
+    listing = json.dumps(
+        {
+            key: browse_info[key]
+            for key in ("entries", "directories")
+            if key in browse_info
+        }
+    )
+    cached = (
+        transfer_session.query(BrowseListing)
+        .filter_by(location_uuid=location_uuid, path=path)
+        .one_or_none()
+    )
+    if cached is None:
+        cached = BrowseListing(location_uuid=location_uuid, path=path)
+        transfer_session.add(cached)
+    cached.listing = listing
+    cached.browsed = datetime.datetime.utcnow()
+    _commit()
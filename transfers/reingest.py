@@ -10,19 +10,21 @@ processes like this over time.
 """
 import argparse
 import atexit
+import datetime
 import json
 import logging
 import os
+import random
+import signal
 import sys
+import threading
 import time
 
-from amclient import AMClient
-
 # Allow execution as an executable and the script to be run at package level
 # by ensuring that it can see itself.
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from transfers import errors, loggingconfig
+from transfers import defaults, errors, loggingconfig, utils
 from transfers import reingestmodel as reingestunit
 
 LOGGER = logging.getLogger("transfers")
@@ -35,6 +37,13 @@ ERR_PROCESSING = 1
 # reingest to happen.
 LATENCY = 0.8
 
+# Seconds between the status checks of a reingest in progress with --daemon,
+# doubled after each check up to the maximum, and the random fraction they
+# are shifted by.
+POLL_INTERVAL = 30
+MAX_POLL_INTERVAL = 600
+JITTER = 0.2
+
 # If the process is running already we don't want to atexit to execute with
 # its default registered behavior. Override here.
 OVERRIDE_ATEXIT = False
@@ -76,7 +85,7 @@ def get_am_client(config):
     of the script.
     """
     connection = config["connection"]
-    amclient = AMClient(
+    amclient = utils.AMClient(
         ss_url=connection["ss_url"],
         ss_user_name=connection["ss_user_name"],
         ss_api_key=connection["ss_api_key"],
@@ -88,6 +97,19 @@ def get_am_client(config):
     return setup_amclient(amclient)
 
 
+def setup_http_client(config):
+    """Configure the HTTP client shared by the calls to Archivematica and the
+    Storage Service from the connection section of the configuration.
+    """
+    connection = config["connection"]
+    utils.configure_client(
+        timeout=connection.get("http_timeout", defaults.DEFAULT_HTTP_TIMEOUT),
+        retries=connection.get("http_retries", defaults.DEFAULT_HTTP_RETRIES),
+        backoff_factor=connection.get("http_backoff", defaults.DEFAULT_HTTP_BACKOFF),
+        pool_size=connection.get("http_pool_size", defaults.DEFAULT_HTTP_POOL_SIZE),
+    )
+
+
 def pipeline_exists(amclient, pipeline_uuid):
     """Test whether a pipeline is known to the storage service."""
     try:
@@ -264,29 +286,77 @@ def get_status(status):
         return None
 
 
-def update_reingest(session, amclient):
+def check_reingest(session, amclient, aip):
     """Set the status of the AIP to COMPLETE if the transfer and ingest process
     has completed.
+
+    :returns: True if the reingest is complete
+    """
+    transfer_uuid = aip.transfer_uuid
+    aip_uuid = aip.aip_uuid
+
+    # A delta can be produced if we look at transfer status, ingest status,
+    # and the package details. If transfer is complete, and ingest is
+    # complete (and the SIP uuid can be found) and then the package is
+    # described as being uploaded, then we have reingested the AIP and we
+    # can set our process state to STATUS_COMPLETE.
+    amclient.transfer_uuid = transfer_uuid
+    amclient.sip_uuid = aip_uuid
+    amclient.package_uuid = aip_uuid
+    transfer_status = get_status(amclient.get_transfer_status())
+    ingest_status = get_status(amclient.get_ingest_status())
+    aip_status = get_status(amclient.get_package_details())
+    if transfer_status == "COMPLETE" and ingest_status == "PROCESSING":
+        LOGGER.info("AIP %s processing is now in ingest", aip_uuid)
+    elif ingest_status == "COMPLETE" and aip_status == "UPLOADED":
+        reingestunit.set_status_complete(session, aip_uuid)
+        return True
+    return False
+
+
+def update_reingest(session, amclient):
+    """Check the status of all the AIP reingests in progress, see
+    check_reingest().
     """
     for aip in reingestunit.get_items_in_progress(session):
-        transfer_uuid = aip.transfer_uuid
-        aip_uuid = aip.aip_uuid
-
-        # A delta can be produced if we look at transfer status, ingest status,
-        # and the package details. If transfer is complete, and ingest is
-        # complete (and the SIP uuid can be found) and then the package is
-        # described as being uploaded, then we have reingested the AIP and we
-        # can set our process state to STATUS_COMPLETE.
-        amclient.transfer_uuid = transfer_uuid
-        amclient.sip_uuid = aip_uuid
-        amclient.package_uuid = aip_uuid
-        transfer_status = get_status(amclient.get_transfer_status())
-        ingest_status = get_status(amclient.get_ingest_status())
-        aip_status = get_status(amclient.get_package_details())
-        if transfer_status == "COMPLETE" and ingest_status == "PROCESSING":
-            LOGGER.info("AIP %s processing is now in ingest", aip_uuid)
-        elif ingest_status == "COMPLETE" and aip_status == "UPLOADED":
-            reingestunit.set_status_complete(session, aip.aip_uuid)
+        check_reingest(session, amclient, aip)
+
+
+def poll_reingest(
+    session,
+    amclient,
+    interval=POLL_INTERVAL,
+    max_interval=MAX_POLL_INTERVAL,
+):
+    """Check the status of the AIP reingests in progress that are due and
+    schedule the next check of the ones not complete yet, see backoff().
+
+    :returns: number of reingests completed
+    """
+    completed = 0
+    for aip in reingestunit.get_items_due(session):
+        if check_reingest(session, amclient, aip):
+            completed += 1
+            continue
+        delay = backoff(aip.checks, interval, max_interval)
+        reingestunit.set_next_check(
+            session,
+            aip.aip_uuid,
+            datetime.datetime.utcnow() + datetime.timedelta(seconds=delay),
+        )
+    return completed
+
+
+def backoff(checks, interval=POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL):
+    """Return the seconds to wait before checking again the status of a
+    reingest already checked a number of times.
+
+    The interval is doubled after each check, up to max_interval, so the long
+    reingests are polled less often, and it is randomly shifted by up to
+    JITTER so the checks of the reingests started together spread out.
+    """
+    delay = min(interval * 2 ** min(checks, 32), max_interval)
+    return delay * random.uniform(1 - JITTER, 1 + JITTER)
 
 
 def start_reingest(
@@ -313,7 +383,7 @@ def start_reingest(
         return True
     pool = throttle - len(in_progress)
     if pool < 1:
-        LOGGER.info("Pool is less than one, exiting, until next run")
+        LOGGER.info("Pool is less than one, waiting for a reingest to complete")
         return False
     for index in range(min(pool, len(new_aips))):
         aip = new_aips[index].aip_uuid
@@ -333,6 +403,52 @@ def start_reingest(
     return False
 
 
+def run_scheduler(
+    session,
+    amclient,
+    pipeline_uuid,
+    processing_config,
+    throttle,
+    approval_retries=2,
+    interval=POLL_INTERVAL,
+    max_interval=MAX_POLL_INTERVAL,
+    stop=None,
+):
+    """Reingest AIPs until there are none left or stop is set.
+
+    Unlike the update -> start approach of a cronjob, the scheduler keeps
+    running and starts the next reingest as soon as one completes, so the
+    pool stays full. It sleeps until the next status check is due, see
+    poll_reingest(), and the schedule is recorded in the database, so a
+    scheduler restarted carries on with it.
+
+    :param stop: threading.Event set to stop the scheduler between polls
+    :returns: True if the reingest of all the AIPs is complete
+    """
+    if stop is None:
+        stop = threading.Event()
+    LOGGER.info("Starting reingest scheduler, polling every %s seconds", interval)
+    while not stop.is_set():
+        poll_reingest(session, amclient, interval, max_interval)
+        complete = start_reingest(
+            session=session,
+            amclient=amclient,
+            pipeline_uuid=pipeline_uuid,
+            processing_config=processing_config,
+            throttle=throttle,
+            approval_retries=approval_retries,
+        )
+        if complete:
+            return True
+        next_check = reingestunit.get_next_check(session)
+        delay = interval
+        if next_check is not None:
+            delay = (next_check - datetime.datetime.utcnow()).total_seconds()
+        stop.wait(max(delay, 0))
+    LOGGER.info("Reingest scheduler stopped")
+    return False
+
+
 def get_completion_stats(session, all_items=False):
     """Output the database state.
 
@@ -370,7 +486,8 @@ def main():
              our AIP list
         * 6. From there, check the progress of the reingest, update if
              necessary, and then in-turn start and approve each subsequent
-             AIPs reingest.
+             AIPs reingest. With --daemon, keep doing so until all the AIPs
+             are reingested, see run_scheduler().
         * 7. On completion, output a log of results.
     """
 
@@ -400,6 +517,11 @@ def main():
     parser.add_argument(
         "--dbstatus", action="store_true", help="output log from the database"
     )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="keep running and start reingests as others complete, until all are",
+    )
     parser.add_argument(
         "--logging",
         type=str,
@@ -429,6 +551,7 @@ def main():
         loggingconfig.setup(args.logging, logging_path)
 
     # Create an AM Client instance to work with.
+    setup_http_client(config)
     amclient = get_am_client(config)
 
     # Perform some early checks to make sure this process will work. Check now,
@@ -508,22 +631,39 @@ def main():
         if not load_db(session, list(aips.keys())):
             sys.exit(ERR_PROCESSING)
 
-    # Check for existing transfers in the pipeline matching our AIPs and update
-    # their status. This will free up our ability to start new reingests. Even
-    # if there are zero in the pipeline we can call it fairly inexpensively
-    # here first so that start_reingest doesn't have to be called within
-    # itself.
-    update_reingest(session=session, amclient=amclient)
-
-    # Start as many ingests from the pool as we can per throttle.
-    complete = start_reingest(
-        session=session,
-        amclient=amclient,
-        pipeline_uuid=pipeline_uuid,
-        processing_config=processing_config,
-        throttle=throttle,
-        approval_retries=approval_retries,
-    )
+    if args.daemon:
+        # Stop between polls on SIGTERM or Ctrl-C, so the PID is removed.
+        stop = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda signum, frame: stop.set())
+        complete = run_scheduler(
+            session=session,
+            amclient=amclient,
+            pipeline_uuid=pipeline_uuid,
+            processing_config=processing_config,
+            throttle=throttle,
+            approval_retries=approval_retries,
+            interval=config["reingest"].get("poll_interval", POLL_INTERVAL),
+            max_interval=config["reingest"].get("max_poll_interval", MAX_POLL_INTERVAL),
+            stop=stop,
+        )
+    else:
+        # Check for existing transfers in the pipeline matching our AIPs and
+        # update their status. This will free up our ability to start new
+        # reingests. Even if there are zero in the pipeline we can call it
+        # fairly inexpensively here first so that start_reingest doesn't have
+        # to be called within itself.
+        update_reingest(session=session, amclient=amclient)
+
+        # Start as many ingests from the pool as we can per throttle.
+        complete = start_reingest(
+            session=session,
+            amclient=amclient,
+            pipeline_uuid=pipeline_uuid,
+            processing_config=processing_config,
+            throttle=throttle,
+            approval_retries=approval_retries,
+        )
 
     # If there are no new AIPs and none in progress, then complete this work
     # by outputting some information about the process.
@@ -12,14 +12,29 @@ from sqlalchemy import Column
 from sqlalchemy import create_engine
 from sqlalchemy import DateTime
 from sqlalchemy import Enum
+from sqlalchemy import Index
+from sqlalchemy import Integer
 from sqlalchemy import String
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+from transfers import migrations
+
 LOGGER = logging.getLogger("transfers")
 
 BASE = declarative_base()
 
+# Schema migrations, see transfers.migrations.
+MIGRATIONS = [
+    # 1: Index the column reingests are looked up by.
+    ["CREATE INDEX IF NOT EXISTS ix_reingests_status ON reingests (status)"],
+    # 2: Schedule the status checks of the reingests in progress.
+    [
+        "ALTER TABLE reingests ADD COLUMN next_check DATETIME",
+        "ALTER TABLE reingests ADD COLUMN checks INTEGER NOT NULL DEFAULT 0",
+    ],
+]
+
 
 class AIPUUIDException(Exception):
     """Exception class for errors retrieving information about our AIPs from
@@ -42,12 +57,17 @@ class ReingestUnit(BASE):
     """Row definition for the reingest database."""
 
     __tablename__ = "reingests"
+    __table_args__ = (Index("ix_reingests_status", "status"),)
     aip_uuid = Column(String(36), primary_key=True)
     transfer_uuid = Column(String(36))
     status = Column(Enum(StatusEnum))
     message = Column(String(200), nullable=True)
     start_time = Column(DateTime())
     end_time = Column(DateTime())
+    # When to check the status of the reingest next and how many times it
+    # was checked, to back off from the ones that take long.
+    next_check = Column(DateTime())
+    checks = Column(Integer, nullable=False, default=0, server_default="0")
 
     def __repr__(self):
         return (
@@ -87,7 +107,7 @@ def init(databasefile):
     engine = create_engine(f"sqlite:///{databasefile}", echo=False)
     global Session
     Session = sessionmaker(bind=engine)
-    BASE.metadata.create_all(engine)
+    migrations.create_all(engine, BASE.metadata, MIGRATIONS)
 
 
 def get_items(session, status=None):
@@ -135,6 +155,8 @@ def _set_status(session, status_enum, aip_uuid, transfer_uuid=None, message=None
     if status_enum == StatusEnum.STATUS_IN_PROGRESS and transfer_uuid is not None:
         item.transfer_uuid = transfer_uuid
         item.start_time = datetime.datetime.utcnow()
+        item.next_check = None
+        item.checks = 0
     if status_enum == StatusEnum.STATUS_COMPLETE:
         item.end_time = datetime.datetime.utcnow()
     session.commit()
@@ -188,3 +210,35 @@ def get_items_complete(session):
 def get_items_error(session):
     """Get items in the database that have error status."""
     return get_items(session, StatusEnum.STATUS_ERROR)
+
+
+def get_items_due(session, now=None):
+    """Get items in progress whose status is due to be checked."""
+    now = now or datetime.datetime.utcnow()
+    return (
+        session.query(ReingestUnit)
+        .filter_by(status=StatusEnum.STATUS_IN_PROGRESS)
+        .filter((ReingestUnit.next_check.is_(None)) | (ReingestUnit.next_check <= now))
+        .all()
+    )
+
+
+def get_next_check(session):
+    """Get the time of the next status check of the items in progress, or None
+    if there are none.
+    """
+    items = get_items_in_progress(session)
+    if not items:
+        return None
+    return min(item.next_check or datetime.datetime.min for item in items)
+
+
+def set_next_check(session, aip_uuid, next_check):
+    """Schedule the next status check of an item and count the last one."""
+    item = get_item_by_aip_uuid(session, aip_uuid)
+    if item is None:
+        raise AIPUUIDException("Cannot find item with UUID %s" % aip_uuid)
+    item.next_check = next_check
+    item.checks = (item.checks or 0) + 1
+    session.commit()
+    return item
@@ -8,19 +8,18 @@ import ast
 import atexit
 import base64
 import configparser
+import functools
 import logging
 import os
 import shutil
+import signal
 import subprocess
 import sys
+import threading
 import time
 from os import fsdecode
 from os import fsencode
 
-import requests
-from amclient import AMClient
-from sqlalchemy.orm.exc import NoResultFound
-
 # Allow execution as an executable and the script to be run at package level
 # by ensuring that it can see itself.
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -35,6 +34,9 @@ THIS_DIR = os.path.abspath(os.path.dirname(__file__))
 # Setup module level logging.
 LOGGER = logging.getLogger("transfers")
 
+# Set when a daemonized run has been asked to stop, e.g. on SIGTERM.
+SHUTDOWN = threading.Event()
+
 
 def setup_automation_execution(pid_file):
     """Setup procedures for transfer.py."""
@@ -51,17 +53,53 @@ def manage_automation_execution(pid_file):
 def create_db_session(config_file):
     """Create and return a database session."""
     models.init_session(
-        get_setting(config_file, "databasefile", os.path.join(THIS_DIR, "transfers.db"))
+        get_setting(
+            config_file, "databasefile", os.path.join(THIS_DIR, "transfers.db")
+        ),
+        journal_mode=get_setting(config_file, "journalmode"),
+        synchronous=get_setting(config_file, "synchronous"),
     )
     return models.Session()
 
 
+@functools.lru_cache(maxsize=None)
+def read_config(config_file):
+    """Read and cache the configuration file.
+
+    The parsed file is kept for the life of the process so that a daemonized
+    run does not re-read it on every poll. Call ``read_config.cache_clear()``
+    to pick up changes, e.g. on SIGHUP.
+    """
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    return config
+
+
+def setup_http_client(config_file):
+    """Configure the HTTP client shared by the calls to Archivematica and the
+    Storage Service from the configuration file.
+    """
+    utils.configure_client(
+        timeout=float(
+            get_setting(config_file, "httptimeout", defaults.DEFAULT_HTTP_TIMEOUT)
+        ),
+        retries=int(
+            get_setting(config_file, "httpretries", defaults.DEFAULT_HTTP_RETRIES)
+        ),
+        backoff_factor=float(
+            get_setting(config_file, "httpbackoff", defaults.DEFAULT_HTTP_BACKOFF)
+        ),
+        pool_size=int(
+            get_setting(config_file, "httppoolsize", defaults.DEFAULT_HTTP_POOL_SIZE)
+        ),
+    )
+
+
 def get_setting(config_file, setting, default=None):
     """Get an option value from the configuration file."""
-    config = configparser.ConfigParser()
+    config = read_config(config_file)
     section = "transfers"
     try:
-        config.read(config_file)
         cfg = config.get(section, setting)
         LOGGER.info("Configuration values read for %s: %s", setting, cfg)
         return cfg
@@ -105,7 +143,7 @@ def get_status(
         LOGGER.info("Hiding %s %s in dashboard", unit_type, unit_uuid)
         url = f"{am_url}/api/{unit_type}/{unit_uuid}/delete/"
         LOGGER.debug("Method: DELETE; URL: %s; params: %s;", url, params)
-        response = requests.delete(url, params=params)
+        response = utils.get_client().delete(url, params=params)
         LOGGER.debug("Response: %s", response)
     # If Transfer is complete, get the SIP's status
     if (
@@ -137,12 +175,12 @@ def get_status(
             LOGGER.info("Hiding SIP %s in dashboard", unit.uuid)
             url = f"{am_url}/api/ingest/{unit.uuid}/delete/"
             LOGGER.debug("Method: DELETE; URL: %s; params: %s;", url, params)
-            response = requests.delete(url, params=params)
+            response = utils.get_client().delete(url, params=params)
             LOGGER.debug("Response: %s", response)
         # If complete and SIP status is 'UPLOADED', delete transfer source
         # files
         if delete_on_complete and unit_info and unit_info.get("status") == "COMPLETE":
-            am = AMClient(
+            am = utils.AMClient(
                 ss_url=ss_url,
                 ss_user_name=ss_user,
                 ss_api_key=ss_api_key,
@@ -276,8 +314,9 @@ def get_next_transfer(
     ts_location_uuid,
     path_prefix,
     depth,
-    processed,
-    see_files,
+    processed=None,
+    see_files=False,
+    browse_ttl=0,
 ):
     """
     Helper to find the first directory that doesn't have an associated
@@ -295,25 +334,40 @@ def get_next_transfer(
                              tools in the database. Ideally, relative to the
                              same transfer source location, including the same
                              path_prefix, and at the same depth. Paths include
-                             those currently processing and completed.
+                             those currently processing and completed. If None,
+                             the candidate paths are looked up in the database.
     :param bool see_files:   Return files as well as folders to become
                              transfers.
+    :param int browse_ttl:   Number of seconds the Storage Service listing of
+                             a directory is cached in the database for. The
+                             listing is not cached if 0.
     :returns:                Path relative to TS Location of the new transfer.
     """
-    # Get sorted list from source directory.
-    url = ss_url + "/api/v2/location/" + ts_location_uuid + "/browse/"
-    params = {"username": ss_user, "api_key": ss_api_key}
-    if path_prefix:
-        params["path"] = base64.b64encode(path_prefix)
-    browse_info = utils._call_url_json(url, params)
-    if isinstance(browse_info, int):
-        if errors.error_lookup(browse_info) is not None:
-            LOGGER.error(
-                "Error when browsing location: %s", errors.error_lookup(browse_info)
-            )
-            return None
+    browse_info = None
+    if browse_ttl:
+        browse_info = models.get_browse_listing(
+            ts_location_uuid, path_prefix, browse_ttl
+        )
+        if browse_info is not None:
+            LOGGER.debug("Using cached listing of %s", path_prefix)
     if browse_info is None:
-        return None
+        # Get sorted list from source directory.
+        url = ss_url + "/api/v2/location/" + ts_location_uuid + "/browse/"
+        params = {"username": ss_user, "api_key": ss_api_key}
+        if path_prefix:
+            params["path"] = base64.b64encode(path_prefix)
+        browse_info = utils._call_url_json(url, params)
+        if isinstance(browse_info, int):
+            if errors.error_lookup(browse_info) is not None:
+                LOGGER.error(
+                    "Error when browsing location: %s",
+                    errors.error_lookup(browse_info),
+                )
+                return None
+        if browse_info is None:
+            return None
+        if browse_ttl:
+            models.save_browse_listing(ts_location_uuid, path_prefix, browse_info)
     if see_files:
         entries = browse_info["entries"]
     else:
@@ -325,16 +379,17 @@ def get_next_transfer(
     # If at the correct depth, check if any of these have not been made into
     # transfers yet
     if depth <= 1:
-        # Find the directories that are not already in the DB using sets
-        entries = set(entries) - processed
-        LOGGER.debug("New transfer candidates: %s", entries)
-        LOGGER.info("Unprocessed entries to choose from: %s", len(entries))
-        # Sort, take the first
+        # Sort, take the first that is not already in the DB
         entries = sorted(entries)
-        if not entries:
+        if processed is None:
+            unprocessed = models.get_unprocessed_paths(entries)
+        else:
+            unprocessed = (e for e in entries if e not in processed)
+        target = next(unprocessed, None)
+        if target is None:
             LOGGER.info("All potential transfers in %s have been created.", path_prefix)
             return None
-        target = entries[0]
+        LOGGER.debug("New transfer candidate: %s", target)
         return target
     else:  # if depth > 1
         # Recurse on each directory
@@ -349,6 +404,7 @@ def get_next_transfer(
                 depth=depth - 1,
                 processed=processed,
                 see_files=see_files,
+                browse_ttl=browse_ttl,
             )
             if target:
                 return target
@@ -372,7 +428,7 @@ def call_start_transfer_endpoint(
         "row_ids[]": [""],
     }
     LOGGER.debug("URL: %s; Params: %s; Data: %s", url, params, data)
-    response = requests.post(url, params=params, data=data)
+    response = utils.get_client().post(url, params=params, data=data)
     LOGGER.debug("Response: %s", response)
     try:
         resp_json = response.json()
@@ -432,7 +488,6 @@ def start_transfer(
               error.
     """
     # Retrieve the next transfer to process.
-    processed = models.get_processed_transfer_paths()
     target = get_next_transfer(
         ss_url=ss_url,
         ss_user=ss_user,
@@ -440,8 +495,8 @@ def start_transfer(
         ts_location_uuid=ts_location_uuid,
         path_prefix=ts_path,
         depth=depth,
-        processed=processed,
         see_files=see_files,
+        browse_ttl=int(get_setting(config_file, "browsettl", 0)),
     )
     if not target:
         # Report the location UUID.
@@ -511,7 +566,7 @@ def approve_transfer(dirname, url, am_api_key, am_user):
     """
     LOGGER.info("Approving %s", dirname)
     time.sleep(6)
-    am = AMClient(am_url=url, am_user_name=am_user, am_api_key=am_api_key)
+    am = utils.AMClient(am_url=url, am_user_name=am_user, am_api_key=am_api_key)
     try:
         # Find the waiting transfers available to be approved via the am client
         # interface.
@@ -551,6 +606,239 @@ def approve_transfer(dirname, url, am_api_key, am_user):
     return approved.get("uuid")
 
 
+def poll_unit(
+    unit,
+    am_url,
+    am_user,
+    am_api_key,
+    ss_url,
+    ss_user,
+    ss_api_key,
+    hide_on_complete=False,
+    delete_on_complete=False,
+    config_file=None,
+):
+    """Fetch the status of a unit in flight, running the user-input scripts
+    if it is waiting on a decision. The unit is not updated, so the caller can
+    save the changes to all the units at once, see save_unit_status().
+
+    :param unit: Current unit from the database
+    :returns: Tuple of the status of the unit and the microservice waiting on
+              user input, if any, or None if the status could not be fetched.
+    """
+    LOGGER.info("Current unit: %s", unit)
+    status_info = get_status(
+        am_url,
+        am_user,
+        am_api_key,
+        ss_url,
+        ss_user,
+        ss_api_key,
+        unit.uuid,
+        unit.unit_type,
+        hide_on_complete,
+        delete_on_complete,
+    )
+    LOGGER.info("Status info: %s", status_info)
+    if not status_info:
+        LOGGER.error("Could not fetch status for %s.", unit.uuid)
+        return None
+    try:
+        status = status_info.get("status")
+    except AttributeError as err:
+        LOGGER.error("Cannot read response from server for %s: %s", unit, err)
+        return None
+
+    # If waiting on input, send email
+    if status == "USER_INPUT":
+        LOGGER.info("Waiting on user input, running scripts in user-input directory.")
+        microservice = status_info.get("microservice", "")
+        run_scripts(
+            "user-input",
+            config_file,
+            microservice,  # Current microservice name
+            # String True or False if this is the first time at this prompt
+            str(microservice != unit.microservice),
+            status_info["path"],  # Absolute path
+            status_info["uuid"],  # SIP/Transfer UUID
+            status_info["name"],  # SIP/Transfer name
+            status_info["type"],  # SIP or transfer
+        )
+        return status, microservice
+    return status, None
+
+
+def save_unit_status(unit, status, microservice=None):
+    """Record the status of a unit polled and the microservice it is waiting
+    on, if any.
+    """
+    models.update_unit_status(unit, status)
+    if microservice is not None:
+        models.update_unit_microservice(unit, microservice)
+
+
+def run_once(
+    am_user,
+    am_api_key,
+    ss_user,
+    ss_api_key,
+    ts_uuid,
+    ts_path,
+    depth,
+    am_url,
+    ss_url,
+    transfer_type,
+    see_files,
+    hide_on_complete=False,
+    delete_on_complete=False,
+    config_file=None,
+    max_in_flight=1,
+):
+    """Check the status of the units in flight and start new transfers until
+    ``max_in_flight`` units are being processed.
+
+    Units that are processing, waiting on user input or whose status cannot be
+    fetched keep their slot. Failed, rejected and completed units free it.
+
+    :returns: Exit status of the run, 0 on success.
+    """
+    ret = 0
+    in_flight = 0
+    current_units = models.get_current_units()
+    if not current_units:
+        LOGGER.info("Current unit: unknown.  Assuming new run.")
+    polled = [
+        (
+            unit,
+            poll_unit(
+                unit,
+                am_url,
+                am_user,
+                am_api_key,
+                ss_url,
+                ss_user,
+                ss_api_key,
+                hide_on_complete,
+                delete_on_complete,
+                config_file,
+            ),
+        )
+        for unit in current_units
+    ]
+    # Save the changes to the units in flight in one commit
+    with models.transaction():
+        for unit, result in polled:
+            if result is None:
+                ret = 1
+                in_flight += 1
+                continue
+            status, microservice = result
+            save_unit_status(unit, status, microservice)
+            if status in ("PROCESSING", "USER_INPUT"):
+                in_flight += 1
+            else:
+                # If failed, rejected, completed etc, free the slot
+                models.update_unit_current(unit, False)
+
+    if in_flight >= max_in_flight:
+        LOGGER.info(
+            "%s of %s units still in flight, nothing to do.", in_flight, max_in_flight
+        )
+        return ret
+
+    # Start new transfers until every slot is taken
+    for _ in range(max_in_flight - in_flight):
+        new_transfer = start_transfer(
+            ss_url,
+            ss_user,
+            ss_api_key,
+            ts_uuid,
+            ts_path,
+            depth,
+            am_url,
+            am_user,
+            am_api_key,
+            transfer_type,
+            see_files,
+            config_file,
+        )
+        if not new_transfer:
+            return 1
+    return ret
+
+
+def get_unit_state():
+    """Return a snapshot of the units in flight used to detect progress
+    between two polls.
+    """
+    return tuple(
+        (unit.uuid, unit.unit_type, unit.status, unit.microservice)
+        for unit in models.get_current_units()
+    )
+
+
+def next_poll_interval(interval, changed, poll_interval, max_poll_interval):
+    """Return the number of seconds to wait before the next poll.
+
+    Polling restarts at ``poll_interval`` as soon as something changed, e.g. a
+    unit moved to another microservice or a new transfer was started, and
+    doubles on every idle poll up to ``max_poll_interval``.
+    """
+    if changed:
+        return poll_interval
+    return min(interval * 2, max_poll_interval)
+
+
+def _handle_shutdown(signum, frame):
+    LOGGER.info("Received signal %s, stopping after the current poll", signum)
+    SHUTDOWN.set()
+
+
+def _handle_reload(signum, frame):
+    LOGGER.info("Received signal %s, reloading configuration", signum)
+    read_config.cache_clear()
+
+
+def run_daemon(poll_interval, max_poll_interval, **kwargs):
+    """Keep polling Archivematica until asked to stop.
+
+    The database session and configuration are reused between polls, and the
+    next transfer is started in the same poll in which the current one leaves
+    the PROCESSING state, so the pipeline is never left idle waiting for the
+    next cron tick.
+
+    :param poll_interval: Minimum number of seconds between two polls
+    :param max_poll_interval: Maximum number of seconds between two polls
+    :param kwargs: Arguments passed on to ``run_once``
+    :returns: 0 once stopped.
+    """
+    signal.signal(signal.SIGTERM, _handle_shutdown)
+    signal.signal(signal.SIGINT, _handle_shutdown)
+    signal.signal(signal.SIGHUP, _handle_reload)
+    LOGGER.info(
+        "Running as a daemon, polling every %s to %s seconds",
+        poll_interval,
+        max_poll_interval,
+    )
+    interval = poll_interval
+    state = get_unit_state()
+    while not SHUTDOWN.is_set():
+        try:
+            run_once(**kwargs)
+        except Exception:
+            LOGGER.exception("Unexpected error while polling, retrying later")
+            models.transfer_session.rollback()
+        new_state = get_unit_state()
+        interval = next_poll_interval(
+            interval, new_state != state, poll_interval, max_poll_interval
+        )
+        state = new_state
+        LOGGER.debug("Next poll in %s seconds", interval)
+        SHUTDOWN.wait(interval)
+    LOGGER.info("Automation tools daemon stopped")
+    return 0
+
+
 def main(
     am_user,
     am_api_key,
@@ -567,6 +855,10 @@ def main(
     delete_on_complete=False,
     config_file=None,
     log_level="INFO",
+    daemon=False,
+    poll_interval=defaults.DEFAULT_POLL_INTERVAL,
+    max_poll_interval=defaults.DEFAULT_MAX_POLL_INTERVAL,
+    max_in_flight=1,
 ):
     """Primary entry point for the automation tools script."""
     loggingconfig.setup(
@@ -596,90 +888,32 @@ def main(
     # Create a database session to work with.
     create_db_session(config_file)
 
+    # Share one pool of HTTP connections between every call to the pipeline.
+    setup_http_client(config_file)
+
     # Create the callback to automatically remove pid.lck on script completion.
     setup_automation_execution(pid_file=pid_file)
 
-    # Check status of last unit
-    current_unit = None
-    try:
-        current_unit = models.get_current_unit()
-        unit_uuid = current_unit.uuid
-        unit_type = current_unit.unit_type
-    except NoResultFound:
-        # Assume a new run if no result can be found in the database.
-        LOGGER.debug("No current unit", exc_info=True)
-        unit_uuid = unit_type = ""
-        LOGGER.info("Current unit: unknown.  Assuming new run.")
-        status = "UNKNOWN"
-    else:
-        LOGGER.info("Current unit: %s", current_unit)
-        # Get status
-        status_info = get_status(
-            am_url,
-            am_user,
-            am_api_key,
-            ss_url,
-            ss_user,
-            ss_api_key,
-            unit_uuid,
-            unit_type,
-            hide_on_complete,
-            delete_on_complete,
-        )
-        LOGGER.info("Status info: %s", status_info)
-        if not status_info:
-            LOGGER.error("Could not fetch status for %s. Exiting.", unit_uuid)
-            return 1
-        try:
-            status = status_info.get("status")
-            models.update_unit_status(current_unit, status)
-        except AttributeError as err:
-            LOGGER.error(
-                "Cannot read response from server for %s: %s", current_unit, err
-            )
-            return None
-
-    # If processing, exit
-    if status == "PROCESSING":
-        LOGGER.info("Current transfer still processing, nothing to do.")
-        return 0
-
-    # If waiting on input, send email, exit
-    elif status == "USER_INPUT":
-        LOGGER.info("Waiting on user input, running scripts in user-input directory.")
-        microservice = status_info.get("microservice", "")
-        run_scripts(
-            "user-input",
-            config_file,
-            microservice,  # Current microservice name
-            # String True or False if this is the first time at this prompt
-            str(microservice != current_unit.microservice),
-            status_info["path"],  # Absolute path
-            status_info["uuid"],  # SIP/Transfer UUID
-            status_info["name"],  # SIP/Transfer name
-            status_info["type"],  # SIP or transfer
-        )
-        models.update_unit_microservice(current_unit, microservice)
-        return 0
-
-    # If failed, rejected, completed etc, start new transfer
-    if current_unit:
-        models.update_unit_current(current_unit, False)
-    new_transfer = start_transfer(
-        ss_url,
-        ss_user,
-        ss_api_key,
-        ts_uuid,
-        ts_path,
-        depth,
-        am_url,
-        am_user,
-        am_api_key,
-        transfer_type,
-        see_files,
-        config_file,
-    )
-    return 0 if new_transfer else 1
+    run_args = {
+        "am_user": am_user,
+        "am_api_key": am_api_key,
+        "ss_user": ss_user,
+        "ss_api_key": ss_api_key,
+        "ts_uuid": ts_uuid,
+        "ts_path": ts_path,
+        "depth": depth,
+        "am_url": am_url,
+        "ss_url": ss_url,
+        "transfer_type": transfer_type,
+        "see_files": see_files,
+        "hide_on_complete": hide_on_complete,
+        "delete_on_complete": delete_on_complete,
+        "config_file": config_file,
+        "max_in_flight": max_in_flight,
+    }
+    if daemon:
+        return run_daemon(poll_interval, max_poll_interval, **run_args)
+    return run_once(**run_args)
 
 
 if __name__ == "__main__":
@@ -705,5 +939,9 @@ if __name__ == "__main__":
             delete_on_complete=args.delete_on_complete,
             config_file=args.config_file,
             log_level=log_level,
+            daemon=args.daemon,
+            poll_interval=args.poll_interval,
+            max_poll_interval=args.max_poll_interval,
+            max_in_flight=args.max_in_flight,
         )
     )
@@ -20,6 +20,7 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from transfers import transfer
 from transfers.loggingconfig import set_log_level
 from transfers import models
+from transfers import utils
 from transfers.transferargs import get_parser
 from transfers.transfer import (
     LOGGER,
@@ -56,7 +57,7 @@ def _api_create_package(
         "processing_config": get_setting(config_file, "processingconfig", "default"),
     }
     LOGGER.debug("URL: %s; Headers: %s, Data: %s", url, headers, data)
-    response = requests.post(url, headers=headers, json=data)
+    response = utils.get_client().post(url, headers=headers, json=data)
     response.raise_for_status()
     LOGGER.debug("Response: %s", response)
     resp_json = response.json()
@@ -107,7 +108,6 @@ def _start_transfer(
               error.
     """
     # Start new transfer
-    processed = models.get_processed_transfer_paths()
     target = get_next_transfer(
         ss_url=ss_url,
         ss_user=ss_user,
@@ -115,8 +115,8 @@ def _start_transfer(
         ts_location_uuid=ts_location_uuid,
         path_prefix=ts_path,
         depth=depth,
-        processed=processed,
         see_files=see_files,
+        browse_ttl=int(get_setting(config_file, "browsettl", 0)),
     )
     if not target:
         # Report the location UUID.
@@ -177,5 +177,9 @@ if __name__ == "__main__":
             hide_on_complete=args.hide,
             log_level=set_log_level(args.log_level, args.quiet, args.verbose),
             config_file=args.config_file,
+            daemon=args.daemon,
+            poll_interval=args.poll_interval,
+            max_poll_interval=args.max_poll_interval,
+            max_in_flight=args.max_in_flight,
         )
     )
@@ -4,6 +4,8 @@ from os import fsencode
 
 from transfers.defaults import DEF_AM_URL
 from transfers.defaults import DEF_SS_URL
+from transfers.defaults import DEFAULT_MAX_POLL_INTERVAL
+from transfers.defaults import DEFAULT_POLL_INTERVAL
 
 
 def get_parser(doc):
@@ -112,6 +114,36 @@ def get_parser(doc):
         help="Configuration file(log/db/PID files)",
         default=None,
     )
+    parser.add_argument(
+        "--max-in-flight",
+        metavar="N",
+        help="Number of transfers or ingests to keep running at once in the "
+        "pipeline. Default: 1",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="If set, keep running and polling Archivematica instead of "
+        "exiting after a single check.",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        metavar="SECONDS",
+        help="Minimum number of seconds between two polls in daemon mode. "
+        "Default: %s" % DEFAULT_POLL_INTERVAL,
+        type=float,
+        default=DEFAULT_POLL_INTERVAL,
+    )
+    parser.add_argument(
+        "--max-poll-interval",
+        metavar="SECONDS",
+        help="Maximum number of seconds between two polls in daemon mode. "
+        "Default: %s" % DEFAULT_MAX_POLL_INTERVAL,
+        type=float,
+        default=DEFAULT_MAX_POLL_INTERVAL,
+    )
 
     # Logging
     parser.add_argument(
@@ -1,9 +1,16 @@
 """Where you put stuff when you can't think of a good name for a module."""
+import json
 import logging
+import os
+import threading
 
+import amclient
 import requests
 import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
+from transfers import defaults
 from transfers import errors
 
 
@@ -13,6 +20,147 @@ METHOD_GET = "GET"
 METHOD_POST = "POST"
 METHOD_DELETE = "DELETE"
 
+# Responses worth retrying, usually returned by a proxy in front of the
+# dashboard or the Storage Service while it restarts.
+RETRY_STATUSES = (502, 503, 504)
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class Client(requests.Session):
+    """HTTP session shared by the calls made to Archivematica and the Storage
+    Service.
+
+    Connections are kept alive and pooled, with at most ``pool_size``
+    connections per host. Requests get a default timeout, and are retried with
+    an exponential backoff on connection errors and on 502, 503 and 504
+    responses (only idempotent methods for the latter).
+    """
+
+    def __init__(
+        self,
+        timeout=defaults.DEFAULT_HTTP_TIMEOUT,
+        retries=defaults.DEFAULT_HTTP_RETRIES,
+        backoff_factor=defaults.DEFAULT_HTTP_BACKOFF,
+        pool_size=defaults.DEFAULT_HTTP_POOL_SIZE,
+    ):
+        super().__init__()
+        self.timeout = timeout
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUSES,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            pool_block=True,
+            max_retries=retry,
+        )
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def get_client():
+    """Return the shared HTTP client, creating it with the default settings
+    if ``configure_client`` has not been called.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = Client()
+        return _client
+
+
+def configure_client(**kwargs):
+    """Replace the shared HTTP client with one created with ``kwargs``."""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = Client(**kwargs)
+        return _client
+
+
+class AMClient(amclient.AMClient):
+    """amclient's Archivematica client, making the calls used by these scripts
+    through the shared HTTP client instead of a new connection each time.
+
+    amclient has no way to be given a session, so the methods below repeat
+    its requests, see amclient 1.3.0. The other methods are amclient's.
+    """
+
+    def unapproved_transfers(self):
+        return _call_url_json(f"{self.am_url}/api/transfer/unapproved", self._am_auth())
+
+    def get_transfer_status(self):
+        return _call_url_json(
+            f"{self.am_url}/api/transfer/status/{self.transfer_uuid}/",
+            headers=self._am_auth_headers(),
+        )
+
+    def get_ingest_status(self):
+        return _call_url_json(
+            f"{self.am_url}/api/ingest/status/{self.sip_uuid}/",
+            headers=self._am_auth_headers(),
+        )
+
+    def get_processing_config(self, assume_json=False):
+        return _call_url_json(
+            f"{self.am_url}/api/processing-configuration/{self.processing_config}",
+            headers=self._am_auth_headers(),
+            assume_json=assume_json,
+        )
+
+    def approve_transfer(self):
+        return _call_url_json(
+            f"{self.am_url}/api/transfer/approve/",
+            params={
+                "type": self.transfer_type,
+                "directory": os.fsencode(self.transfer_directory),
+            },
+            method=METHOD_POST,
+            headers=self._am_auth_headers(),
+        )
+
+    def get_pipelines(self):
+        return _call_url_json(
+            f"{self.ss_url}/api/v2/pipeline/", headers=self._ss_auth_headers()
+        )
+
+    def get_package(self, params=None):
+        return _call_url_json(
+            f"{self.ss_url}/api/v2/file/", dict(self._ss_auth(), **(params or {}))
+        )
+
+    def get_next_package_page(self, next_path):
+        return _call_url_json(f"{self.ss_url}{next_path}", {})
+
+    def get_package_details(self):
+        return _call_url_json(
+            f"{self.ss_url}/api/v2/file/{self.package_uuid}",
+            headers=self._ss_auth_headers(),
+        )
+
+    def reingest_aip(self):
+        params = {
+            "pipeline": self.pipeline_uuid,
+            "reingest_type": self.reingest_type,
+            "processing_config": self.processing_config,
+        }
+        return _call_url_json(
+            f"{self.ss_url}/api/v2/file/{self.aip_uuid}/reingest/",
+            params=json.dumps(params),
+            method=METHOD_POST,
+            headers=self._ss_auth_headers(),
+        )
+
 
 def _call_url_json(url, params=None, method=METHOD_GET, headers=None, assume_json=True):
     """Helper to GET a URL where the expected response is 200 with JSON.
@@ -30,9 +178,13 @@ def _call_url_json(url, params=None, method=METHOD_GET, headers=None, assume_jso
     LOGGER.debug("URL: %s; params: %s; method: %s", url, params, method)
     try:
         if method == METHOD_GET or method == METHOD_DELETE:
-            response = requests.request(method, url=url, params=params, headers=headers)
+            response = get_client().request(
+                method, url=url, params=params, headers=headers
+            )
         else:
-            response = requests.request(method, url=url, data=params, headers=headers)
+            response = get_client().request(
+                method, url=url, data=params, headers=headers
+            )
         LOGGER.debug("Response: %s", response)
         LOGGER.debug("type(response.text): %s ", type(response.text))
         LOGGER.debug("Response content-type: %s", response.headers["content-type"])